@@ -44,6 +44,62 @@ wave_dust_em     = 2.5   # rest-frame wavelength in microns
 #   else, must be float: fixed metallicity of SSP models (Z_solar = 0.019)
 metallicity = 0.0077 
 
+# Minimum relative weight of an SSP grid metallicity
+#   SSP metallicities are combined with gaussian weights (0.15 dex width)
+#   Only the grid metallicities whose weight, relative to the largest one,
+#   reaches this value (for the fixed metallicity, or anywhere within the
+#   prior range if metallicity is free) are read in, and for each model
+#   only those reaching it for the model metallicity are combined
+#   If 0, all metallicities of the SSP grid are used
+ssp_met_weight_floor = 1e-3
+
+# Cache of metallicity-collapsed SSP grids (free metallicity only)
+#   If a float, the model metallicity is rounded to this step (in dex)
+#   and the SSP grids collapsed at each rounded metallicity are kept in
+#   memory, up to met_cache_mb megabytes (least recently used are dropped)
+#   If False, the SSP grid is collapsed for every model
+met_cache_step = 0.005
+met_cache_mb = 256
+
+# Binary cache of the SSP grids
+#   Parsed SSP files are stored as memory-mappable arrays in this directory
+#   and reused as long as the source files are unchanged
+#   If None, the ASCII SSP files are parsed on every run
+ssp_cache_dir = 'SSP/cache'
+
+# Compression of the SSP age grid (all SFHs except binned_lsfr)
+#   If a float, adjacent SSP ages are merged (time-weighted) for each galaxy
+#   as long as the merged template reproduces the flux densities of its
+#   members in the fitted filters within this fractional tolerance (e.g., 0.01)
+#   The SFR is still evaluated on the full age grid, so masses are unchanged
+#   If False, the full SSP age grid is used
+ssp_age_tolerance = False
+
+# Truncated SVD basis of the SSP grid
+#   If a float, the SSP spectra are replaced by the fewest basis spectra
+#   that reproduce every template within this fractional (L2 norm)
+#   tolerance (e.g., 1e-3); ages and metallicities are then combined
+#   in the much smaller space of the basis coefficients
+#   If False, the SSP spectra are used directly
+ssp_basis_tolerance = False
+
+# Tabulated dust-attenuated SSP photometry
+#   If a float, the flux densities of every SSP age in the fitted filters
+#   are tabulated for each galaxy on a grid of E(B-V) with this spacing
+#   (e.g., 0.02), and the MCMC interpolates the table instead of building
+#   spectra; the accuracy against the exact model is reported
+#   Only used for photometric fits (no absorption indices) with a dust law
+#   whose only free parameter is E(B-V) (calzetti, reddy, conroy, cardelli)
+#   If False, spectra are built for every model
+dust_table_step = False
+
+# Numerical precision of the model
+#   'float64' or 'float32'
+#   float32 halves the memory (and memory traffic) of the SSP grid and the
+#   filter matrix; the maximum photometric difference from float64 for a
+#   set of reference models is reported at the start of the run
+model_precision = 'float64'
+
 # Nebular Emission Properties
 # The ionization parameter, logU, is held fixed
 logU = -2.5
@@ -51,6 +107,15 @@ logU = -2.5
 # EMCEE parameters
 nwalkers = 100 
 nsteps   = 1000 
+# If True, the spectra and photometry of all walkers in an ensemble are
+# computed together with matrix products (much less Python overhead)
+batch_lnprob = True
+# If True, the sampler only tracks the log probability; the derived
+# parameters (stellar mass, SFR10, SFR100, fPDR, dust mass) are computed
+# after the burn-in, only for the samples that are kept (every
+# derived_params_thin-th step of each walker)
+defer_derived_params = False
+derived_params_thin = 1
 
 # Number of test objects
 nobjects = 5
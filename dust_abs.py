@@ -15,6 +15,58 @@
 import numpy as np
 
 
+def get_cached_curve(curves, wave, law, maxsize=4):
+    ''' Evaluate the wavelength dependence of a dust law once per
+    wavelength grid
+
+    Parameters
+    ----------
+    curves : list
+        (wavelength grid, curve) pairs of the previous calls, most recent
+        last; grids are matched by identity, so the same (unmodified) array
+        must be passed to reuse a curve
+    wave : numpy array (1 dim)
+        wavelength in Angstroms
+    law : function
+        computes the curve for a wavelength grid
+    maxsize : int
+        number of wavelength grids kept
+
+    Returns
+    -------
+    curve : numpy array
+        law(wave)
+    '''
+    for grid, curve in curves:
+        if grid is wave:
+            return curve
+    curve = law(wave)
+    curves.append((wave, curve))
+    if len(curves) > maxsize:
+        curves.pop(0)
+    return curve
+
+
+def uniform_prior_batch(lims, params):
+    ''' Uniform prior of a set of parameter vectors, shared by the prior_batch
+    methods of the dust and star formation history classes
+
+    Parameters
+    ----------
+    lims : list
+        (lower, upper) boundaries of each parameter (see get_param_lims)
+    params : numpy array (2 dim)
+        parameters of each model, dimensions: (models, parameters)
+
+    Returns
+    -------
+    flag : numpy array (1 dim)
+        True for the models strictly within the boundaries
+    '''
+    lims = np.array(lims, dtype=float).reshape(-1, 2)
+    return np.all((params > lims[:, 0]) & (params < lims[:, 1]), axis=1)
+
+
 def calzettilaw(wave, Rv=4.05):
     ''' Calzetti et al. (2000) dust attenuation curve, k(wave)
 
@@ -67,7 +119,8 @@ class calzetti:
         self.EBV = EBV
         self.EBV_lims = EBV_lims
         self.EBV_delta = EBV_delta
-        self.calz = None
+        # k(wave) of recent wavelength grids (see get_cached_curve)
+        self.curves = []
         self.Rv = Rv
         self.EBV_old_young = EBV_old_young
 
@@ -96,6 +149,10 @@ class calzetti:
         EBV_flag = (self.EBV > self.EBV_lims[0])*(self.EBV < self.EBV_lims[1])
         return EBV_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -109,9 +166,12 @@ class calzetti:
         '''
         self.EBV = input_list[start_value]
 
-    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2):
-        ''' Plot Dust Law for given set of parameters '''
-        dust = self.evaluate(wave)
+    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2,
+             dust=None):
+        ''' Plot Dust Law for given set of parameters (or a precomputed
+        curve on wave) '''
+        if dust is None:
+            dust = self.evaluate(wave)
         ax.plot(wave, dust, color=color, alpha=alpha)
 
     def evaluate(self, wave, new_wave=False):
@@ -122,8 +182,8 @@ class calzetti:
         wave : numpy array (1 dim)
             wavelength
         new_wave : bool
-            recompute k(wave), even if already present
-            only used in emission line strengths: finer wavelength grid
+            recompute k(wave) instead of using the curve cached for the
+            wavelength grid (see get_cached_curve)
 
         Returns
         -------
@@ -132,15 +192,36 @@ class calzetti:
             Observed = True * 10**(-0.4 * Av / Rv * k(wave))
             A(wave) = E(B-V) * k(wave) = Av / Rv * k(wave)
         '''
-        if self.calz is None:
-            self.calz = calzettilaw(wave, self.Rv)
         if new_wave:
             kwave = calzettilaw(wave, self.Rv)
         else:
-            kwave = self.calz
+            kwave = get_cached_curve(self.curves, wave,
+                                     lambda w: calzettilaw(w, self.Rv))
         Alam = self.EBV * kwave
         return Alam
 
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength (the curve cached for the wavelength grid is used,
+            see get_cached_curve)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        Alam : numpy array (2 dim)
+            Effective optical depth as a function of wavelength,
+            dimensions: (models, wavelength)
+        '''
+        kwave = get_cached_curve(self.curves, wave,
+                                 lambda w: calzettilaw(w, self.Rv))
+        Alam = params[:, 0:1] * kwave
+        return Alam
+
 
 class noll:
     ''' Prescription for dust law comes from Noll et al. (2009), with constants
@@ -186,7 +267,8 @@ class noll:
         self.EBV_delta = EBV_delta
         self.delta_delta = delta_delta
         self.Eb_delta = Eb_delta
-        self.calz = None
+        # k(wave) of recent wavelength grids (see get_cached_curve)
+        self.curves = []
         self.Rv = Rv
         self.EBV_old_young = EBV_old_young
 
@@ -218,6 +300,10 @@ class noll:
         Eb_flag = (self.Eb > self.Eb_lims[0])*(self.Eb < self.Eb_lims[1])
         return EBV_flag * delta_flag * Eb_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -233,9 +319,12 @@ class noll:
         self.delta = input_list[start_value+1]
         self.Eb = input_list[start_value+2]
 
-    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2):
-        ''' Plot Dust Law for given set of parameters '''
-        dust = self.evaluate(wave)
+    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2,
+             dust=None):
+        ''' Plot Dust Law for given set of parameters (or a precomputed
+        curve on wave) '''
+        if dust is None:
+            dust = self.evaluate(wave)
         ax.plot(wave, dust, color=color, alpha=alpha)
 
     def evaluate(self, wave, new_wave=False):
@@ -246,28 +335,74 @@ class noll:
         wave : numpy array (1 dim)
             wavelength
         new_wave : bool
-            recompute k(wave), even if already present
-            only used in emission line strengths: finer wavelength grid
+            recompute k(wave) instead of using the curve cached for the
+            wavelength grid (see get_cached_curve)
 
         Returns
         -------
         Alam : numpy array (1 dim)
             Effective optical depth as a function of wavelength
         '''
-        dellam = 350.
-        lam0   = 2175.
-        if self.calz is None:
-            self.calz = calzettilaw(wave, self.Rv)
         if new_wave:
-            kwave = calzettilaw(wave, self.Rv)
+            kwave, drude, logwave = self.nollcurves(wave)
         else:
-            kwave = self.calz
+            kwave, drude, logwave = get_cached_curve(self.curves, wave,
+                                                     self.nollcurves)
+
+        Dlam = self.Eb * drude
+        Alam = (self.EBV * (kwave+Dlam)*np.exp(self.delta * logwave))
+        return Alam
+
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength (the curve cached for the wavelength grid is used,
+            see get_cached_curve)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
 
-        Dlam = (self.Eb * (wave*dellam)**2 /
-                          ((wave**2-lam0**2)**2+(wave*dellam)**2))
-        Alam = (self.EBV * (kwave+Dlam)*(wave/5500)**(self.delta))
+        Returns
+        -------
+        Alam : numpy array (2 dim)
+            Effective optical depth as a function of wavelength,
+            dimensions: (models, wavelength)
+        '''
+        kwave, drude, logwave = get_cached_curve(self.curves, wave,
+                                                 self.nollcurves)
+        EBV, delta, Eb = [p[:, np.newaxis] for p in params.T]
+
+        Dlam = Eb * drude
+        Alam = (EBV * (kwave+Dlam)*np.exp(delta * logwave))
         return Alam
 
+    def nollcurves(self, wave):
+        ''' Wavelength dependence of the Noll et al. (2009) law
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength in Angstroms
+        Returns
+        -------
+        kwave : numpy array (1 dim)
+            Calzetti et al. (2000) curve, k(wave)
+        drude : numpy array (1 dim)
+            Drude profile of the 2175A bump per unit Eb, D(wave) / Eb
+        logwave : numpy array (1 dim)
+            ln(wave / 5500), the exponent of the power-law modification
+            per unit delta
+        '''
+        dellam = 350.
+        lam0   = 2175.
+        kwave = calzettilaw(wave, self.Rv)
+        drude = ((wave*dellam)**2 /
+                 ((wave**2-lam0**2)**2+(wave*dellam)**2))
+        logwave = np.log(wave/5500.)
+        return kwave, drude, logwave
+
 
 class reddy:
     '''
@@ -295,7 +430,8 @@ class reddy:
         self.EBV = EBV
         self.EBV_lims = EBV_lims
         self.EBV_delta = EBV_delta
-        self.klam = None
+        # k(wave) of recent wavelength grids (see get_cached_curve)
+        self.curves = []
         self.Rv = Rv
         self.EBV_old_young = EBV_old_young
 
@@ -324,6 +460,10 @@ class reddy:
         EBV_flag = (self.EBV > self.EBV_lims[0])*(self.EBV < self.EBV_lims[1])
         return EBV_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -337,9 +477,12 @@ class reddy:
         '''
         self.EBV = input_list[start_value]
 
-    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2):
-        ''' Plot Dust Law for given set of parameters '''
-        dust = self.evaluate(wave)
+    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2,
+             dust=None):
+        ''' Plot Dust Law for given set of parameters (or a precomputed
+        curve on wave) '''
+        if dust is None:
+            dust = self.evaluate(wave)
         ax.plot(wave, dust, color=color, alpha=alpha)
 
     def reddylaw(self, wave):
@@ -377,8 +520,8 @@ class reddy:
         wave : numpy array (1 dim)
             wavelength
         new_wave : bool
-            recompute k(wave), even if already present
-            only used in emission line strengths: finer wavelength grid
+            recompute k(wave) instead of using the curve cached for the
+            wavelength grid (see get_cached_curve)
 
         Returns
         -------
@@ -387,15 +530,34 @@ class reddy:
             Observed = True * 10**(-0.4 * Av / Rv * k(wave))
             A(wave) = E(B-V) * k(wave) = Av / Rv * k(wave)
         '''
-        if self.klam is None:
-            self.klam = self.reddylaw(wave)
         if new_wave:
             kwave = self.reddylaw(wave)
         else:
-            kwave = self.klam
+            kwave = get_cached_curve(self.curves, wave, self.reddylaw)
         Alam = self.EBV * kwave
         return Alam
 
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength (the curve cached for the wavelength grid is used,
+            see get_cached_curve)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        Alam : numpy array (2 dim)
+            Effective optical depth as a function of wavelength,
+            dimensions: (models, wavelength)
+        '''
+        kwave = get_cached_curve(self.curves, wave, self.reddylaw)
+        Alam = params[:, 0:1] * kwave
+        return Alam
+
 
 class conroy:
     '''
@@ -430,8 +592,8 @@ class conroy:
         self.B = B
         self.EBV_lims = EBV_lims
         self.EBV_delta = EBV_delta
-        self.axlam = None
-        self.bxlam = None
+        # a(x) + b(x) / Rv of recent wavelength grids (see get_cached_curve)
+        self.curves = []
         self.Rv = Rv
         self.EBV_old_young = EBV_old_young
 
@@ -460,6 +622,10 @@ class conroy:
         EBV_flag = (self.EBV > self.EBV_lims[0])*(self.EBV < self.EBV_lims[1])
         return EBV_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -473,9 +639,12 @@ class conroy:
         '''
         self.EBV = input_list[start_value]
 
-    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2):
-        ''' Plot Dust Law for given set of parameters '''
-        dust = self.evaluate(wave)
+    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2,
+             dust=None):
+        ''' Plot Dust Law for given set of parameters (or a precomputed
+        curve on wave) '''
+        if dust is None:
+            dust = self.evaluate(wave)
         ax.plot(wave, dust, color=color, alpha=alpha)
 
     def conroylaw(self, wave):
@@ -564,8 +733,8 @@ class conroy:
         wave : numpy array (1 dim)
             wavelength
         new_wave : bool
-            recompute k(wave), even if already present
-            only used in emission line strengths: finer wavelength grid
+            recompute k(wave) instead of using the curve cached for the
+            wavelength grid (see get_cached_curve)
 
         Returns
         -------
@@ -578,20 +747,44 @@ class conroy:
         if (isinstance(wave, float)) | (isinstance(wave, int)):
             wave = np.array([wave])
 
-        if self.axlam is None:
+        def curve(wave):
             axlam, bxlam = self.conroylaw(wave)
-            self.axlam = axlam
-            self.bxlam = bxlam
+            return axlam + bxlam / self.Rv
         if new_wave:
-            axlam, bxlam = self.conroylaw(wave)
+            kwave = curve(wave)
         else:
-            axlam = self.axlam
-            bxlam = self.bxlam
+            kwave = get_cached_curve(self.curves, wave, curve)
 
         Rv = self.Rv
         Av = Rv * self.EBV
 
-        Alam = Av * ( axlam + bxlam / Rv )
+        Alam = Av * kwave
+        return Alam
+
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength (the curve cached for the wavelength grid is used,
+            see get_cached_curve)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        Alam : numpy array (2 dim)
+            Effective optical depth as a function of wavelength,
+            dimensions: (models, wavelength)
+        '''
+        def curve(wave):
+            axlam, bxlam = self.conroylaw(wave)
+            return axlam + bxlam / self.Rv
+        kwave = get_cached_curve(self.curves, wave, curve)
+
+        Av = self.Rv * params[:, 0:1]
+        Alam = Av * kwave
         return Alam
 
 
@@ -626,8 +819,8 @@ class cardelli:
         self.B = B
         self.EBV_lims = EBV_lims
         self.EBV_delta = EBV_delta
-        self.axlam = None
-        self.bxlam = None
+        # a(x) + b(x) / Rv of recent wavelength grids (see get_cached_curve)
+        self.curves = []
         self.Rv = Rv
         self.EBV_old_young = EBV_old_young
 
@@ -656,6 +849,10 @@ class cardelli:
         EBV_flag = (self.EBV > self.EBV_lims[0])*(self.EBV < self.EBV_lims[1])
         return EBV_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -669,9 +866,12 @@ class cardelli:
         '''
         self.EBV = input_list[start_value]
 
-    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2):
-        ''' Plot Dust Law for given set of parameters '''
-        dust = self.evaluate(wave)
+    def plot(self, ax, wave, color=[0/255., 175/255., 202/255.], alpha=0.2,
+             dust=None):
+        ''' Plot Dust Law for given set of parameters (or a precomputed
+        curve on wave) '''
+        if dust is None:
+            dust = self.evaluate(wave)
         ax.plot(wave, dust, color=color, alpha=alpha)
 
     def cardellilaw(self, wave):
@@ -759,8 +959,8 @@ class cardelli:
         wave : numpy array (1 dim)
             wavelength
         new_wave : bool
-            recompute k(wave), even if already present
-            only used in emission line strengths: finer wavelength grid
+            recompute k(wave) instead of using the curve cached for the
+            wavelength grid (see get_cached_curve)
 
         Returns
         -------
@@ -773,19 +973,43 @@ class cardelli:
         if (isinstance(wave, float)) | (isinstance(wave, int)):
             wave = np.array([wave])
 
-        if self.axlam is None:
+        def curve(wave):
             axlam, bxlam = self.cardellilaw(wave)
-            self.axlam = axlam
-            self.bxlam = bxlam
+            return axlam + bxlam / self.Rv
         if new_wave:
-            axlam, bxlam = self.cardellilaw(wave)
+            kwave = curve(wave)
         else:
-            axlam = self.axlam
-            bxlam = self.bxlam
+            kwave = get_cached_curve(self.curves, wave, curve)
 
         Rv = self.Rv
         Av = Rv * self.EBV
 
-        Alam = Av * ( axlam + bxlam / Rv )
+        Alam = Av * kwave
+        return Alam
+
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength (the curve cached for the wavelength grid is used,
+            see get_cached_curve)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        Alam : numpy array (2 dim)
+            Effective optical depth as a function of wavelength,
+            dimensions: (models, wavelength)
+        '''
+        def curve(wave):
+            axlam, bxlam = self.cardellilaw(wave)
+            return axlam + bxlam / self.Rv
+        kwave = get_cached_curve(self.curves, wave, curve)
+
+        Av = self.Rv * params[:, 0:1]
+        Alam = Av * kwave
         return Alam
 
@@ -7,6 +7,7 @@ Created on Tue Apr  3 11:09:49 2018
 
 import numpy as np
 from scipy.interpolate import LinearNDInterpolator
+from dust_abs import uniform_prior_batch
 import matplotlib.pyplot as plt
 
 
@@ -156,6 +157,10 @@ class DL07:
         else:
             return umin_flag * gamma_flag * qpah_flag * mdust_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -228,3 +233,37 @@ class DL07:
             DustE *= 10**self.mdust 
 
         return np.interp(wave, self.wave, DustE)
+
+    def evaluate_batch(self, wave, params):
+        ''' Evaluate Dust Law (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength in Angstroms
+        params : numpy array (2 dim)
+            parameters of each model (see get_params),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        DustE : numpy array (2 dim)
+            Dust emission spectrum (flux in uJy 10 pc),
+            dimensions: (models, wavelength)
+        '''
+        umin, gamma, qpah = [p[:, np.newaxis] for p in params[:, :3].T]
+        DustE = (self.interpumin(qpah[:, 0], umin[:, 0]) * (1. - gamma) +
+                 self.interpumax(qpah[:, 0], umin[:, 0]) * gamma)
+
+        # Converting to units uJy/M_sun at 10 pc (see evaluate)
+        DustE *= 1.249e24 * np.interp(qpah, self.qpaharray, self.htodarray)
+
+        # Multiplying by total dust mass to get to flux in uJy at 10 pc
+        if not self.assume_energy_balance:
+            DustE *= 10**params[:, 3:4]
+
+        # linear interpolation onto wave (as np.interp) for all models
+        x = np.interp(wave, self.wave, np.arange(len(self.wave)))
+        lo = np.minimum(x.astype(int), len(self.wave) - 2)
+        frac = x - lo
+        return DustE[:, lo] * (1. - frac) + DustE[:, lo + 1] * frac
@@ -10,12 +10,13 @@ import dust_emission
 import metallicity
 import cosmology
 import emcee
+from ssp import make_interpolation_operator
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import corner
 import time
-from scipy.integrate import simps
+from collections import OrderedDict
 from scipy.interpolate import interp1d
 from astropy.constants import c as clight
 import numpy as np
@@ -32,6 +33,46 @@ sns.set_style({"xtick.direction": "in","ytick.direction": "in",
                })
 
 
+class BatchMap:
+    ''' Pool-like object for emcee that evaluates a set of walkers with
+    one call of a batched function, instead of one call per walker
+    '''
+    def __init__(self, batch_function):
+        self.batch_function = batch_function
+
+    def map(self, function, iterable):
+        return self.batch_function(np.array(list(iterable)))
+
+
+class ComponentCache:
+    ''' Least recently used cache of model components, keyed on the
+    parameters they depend on
+    '''
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        ''' Return the entry for key (None if missing) '''
+        value = self.entries.pop(key, None)
+        if value is not None:
+            # move the entry to the end (most recently used)
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        ''' Add an entry, evicting the least recently used beyond maxsize '''
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
 class Mcsed:
     def __init__(self, filter_matrix, ssp_spectra,
                  emlinewave, ssp_emline, ssp_ages, ssp_met, wave, 
@@ -46,7 +87,10 @@ class Mcsed:
                  redshift=None, Dl=None, filter_flag=None, 
                  input_params=None, true_fnu=None, true_spectrum=None, 
                  sigma_m=0.1, nwalkers=40, nsteps=1000, 
-                 chi2=None, tauISM_lam=None, tauIGM_lam=None):
+                 chi2=None, tauISM_lam=None, tauIGM_lam=None,
+                 batch_lnprob=True, dust_table_step=None,
+                 met_weight_floor=0., met_cache_step=None, met_cache_mb=256.,
+                 defer_derived_params=False, derived_params_thin=1):
         ''' Initialize the Mcsed class.
 
         Init
@@ -57,6 +101,7 @@ class Mcsed:
         ssp_spectra : numpy array (3 dim)
             single stellar population spectrum for each age in ssp_ages
             and each metallicity in ssp_met 
+            (coefficients of self.ssp_basis if set, see set_ssp_basis)
         emlinewave : numpy array (1 dim)
             Rest-frame wavelengths of requested emission lines (emline_dict)
             Corresponds to ssp_emline
@@ -170,6 +215,28 @@ class Mcsed:
         tauIGM_lam : numpy array (1 dim)
             Array of effective optical depths as function of wavelength 
             for IGM gas correction
+        batch_lnprob : bool
+            If True, emcee evaluates all walkers of an ensemble at once
+            (see lnprob_batch); otherwise lnprob is called for each walker
+        dust_table_step : float
+            If set, the photometry of the SSP templates is tabulated on an
+            E(B-V) grid with this spacing for the MCMC (see set_dust_table)
+        met_weight_floor : float
+            SSP metallicities whose weight, relative to the largest one, is
+            below this value are skipped (see get_met_weights)
+        met_cache_step : float
+            If set, a free metallicity is rounded to this step (in dex) and
+            the metallicity-collapsed SSP grids are cached
+            (see get_ssp_spectrum)
+        met_cache_mb : float
+            Memory budget of the cache of metallicity-collapsed SSP grids
+        defer_derived_params : bool
+            If True, the sampler only tracks the log probability, and the
+            derived parameters are computed after the burn-in for the
+            retained samples (see get_derived_params_batch)
+        derived_params_thin : int
+            With defer_derived_params, keep every derived_params_thin-th
+            step of each walker after the burn-in
         '''
         # Initialize all argument inputs
         self.filter_matrix = filter_matrix
@@ -205,7 +272,14 @@ class Mcsed:
         self.fluxwv = fluxwv
         self.fluxfn = fluxfn
         self.medianspec = medianspec
+        self.posterior_draws = None
         self.spectrum = None
+        # caches of the dust-free spectra, dust transmissions and dust
+        # emission of the CSP build (see build_rest_csp)
+        self.dustfree_cache = ComponentCache()
+        self.dust_abs_cache = ComponentCache()
+        self.dust_em_cache = ComponentCache()
+        self.dust_wave = None
         self.redshift = redshift
         if self.redshift is not None:
             self.set_new_redshift(self.redshift)
@@ -220,10 +294,105 @@ class Mcsed:
         self.chi2 = chi2
         self.tauISM_lam = tauISM_lam
         self.tauIGM_lam = tauIGM_lam
+        self.batch_lnprob = batch_lnprob
+        self.dust_table_step = dust_table_step
+        self.met_weight_floor = met_weight_floor
+        self.met_cache_step = met_cache_step
+        self.met_cache_mb = met_cache_mb
+        self.defer_derived_params = defer_derived_params
+        self.derived_params_thin = derived_params_thin
+        # least recently used cache of collapsed SSP grids (get_ssp_spectrum)
+        self.ssp_met_cache = ComponentCache()
+        # (rest-frame, observed-frame) slices of self.wave used while
+        # sampling (see set_wave_window); None uses the full grid
+        self.wave_window = None
+        # basis spectra of ssp_spectra (see set_ssp_basis)
+        self.ssp_basis = None
+        # ages of ssp_ages merged in each template (see set_ssp_grid)
+        self.ssp_age_members = None
+        # rest-frame spectrum to model photometry (see set_response_matrix)
+        self.response = None
+        # dust-attenuated SSP photometry (see set_dust_table)
+        self.dust_table = None
+        # band integrals of the absorption indices (see set_absindx_operator)
+        self.absindx_operator = None
+        # modeled emission line fluxes and absorption indices as arrays
+        # (see set_emline_fluxes and measure_absorption_index)
+        self.linefluxCSP = None
+        self.absindxCSP = None
+        self.emline_indices = None
+        # measured emission lines and absorption indices of the source
+        # (see get_lnlike_data)
+        self.lnlike_data = None
 
         # Set up logging
         self.setup_logging()
 
+    def set_ssp_grid(self, ssp_ages, ssp_spectra, ssp_emline,
+                     age_members=None):
+        ''' Replace the SSP grid (e.g., binned or compressed ages)
+
+        Parameters
+        ----------
+        ssp_ages : numpy array (1 dim)
+            ages of the SSP models
+        ssp_spectra : numpy array (3 dim)
+            single stellar population spectrum for each age in ssp_ages
+            (or each merged template) and each metallicity in ssp_met
+        ssp_emline : numpy array (3 dim)
+            emission line SSP grid for each age in ssp_ages
+            (or each merged template) and each metallicity in ssp_met
+        age_members : numpy array (2 dim) or None
+            if the ages are merged (see ssp.compress_ssp_ages), 1 where an
+            age of ssp_ages belongs to a template, dimensions: (ages,
+            templates); the star formation history is evaluated on
+            ssp_ages and the weights of the members of each template are
+            summed (see get_age_weights_batch)
+        '''
+        self.ssp_ages = ssp_ages
+        self.ssp_spectra = ssp_spectra
+        self.ssp_emline = ssp_emline
+        self.ssp_age_members = age_members
+        self.ssp_basis = None
+        # the metallicity-collapsed SSP is cached for a fixed metallicity
+        self.SSP = None
+        self.lineSSP = None
+        self.ssp_met_cache.clear()
+        self.clear_component_caches()
+
+    def set_ssp_basis(self, ssp_basis, ssp_coeffs):
+        ''' Represent the SSP grid by basis spectra (see
+        ssp.decompose_ssp_basis)
+
+        Ages and metallicities are then combined in the space of the
+        coefficients, and the spectrum is only expanded in wavelength once
+        per model in build_csp.
+
+        Parameters
+        ----------
+        ssp_basis : numpy array (2 dim)
+            basis spectra, dimensions: (wavelength, rank)
+        ssp_coeffs : numpy array (3 dim)
+            coefficients of the SSP spectra, dimensions: (rank, age,
+            metallicity); they replace self.ssp_spectra
+        '''
+        self.ssp_basis = ssp_basis
+        self.ssp_spectra = ssp_coeffs
+        self.SSP = None
+        self.ssp_met_cache.clear()
+        self.clear_component_caches()
+
+    def clear_component_caches(self):
+        ''' Empty the caches of the CSP components (see build_rest_csp);
+        needed whenever the SSP grid, the age limits or the wavelength
+        window change
+        '''
+        self.dustfree_cache.clear()
+        self.dust_abs_cache.clear()
+        self.dust_em_cache.clear()
+        # wavelengths of the dust transmissions (see get_dust_transmission)
+        self.dust_wave = None
+
     def set_new_redshift(self, redshift):
         ''' Setting redshift
 
@@ -236,6 +405,7 @@ class Mcsed:
         # Need luminosity distance to adjust spectrum to distance of the source
         self.Dl = cosmology.Cosmology().luminosity_distance(self.redshift)
         self.sfh_class.set_agelim(self.redshift)
+        self.clear_component_caches()
 
     def setup_logging(self):
         '''Setup Logging for MCSED
@@ -298,6 +468,347 @@ class Mcsed:
         self.data_fnu_e = self.data_fnu_e[newflags]
 
 
+    def set_wave_window(self):
+        '''Restrict the model spectrum to the wavelengths needed in the fit
+
+        The observed-frame window covers the filters used in the fit and
+        the absorption index bands; the rest-frame window covers the model
+        wavelengths that are redshifted into it.  Outside of the window,
+        build_csp returns zeros.  The full grid is needed for energy balance.
+
+        Builds
+        ------
+        self.wave_window : tuple or None
+            (rest-frame slice, observed-frame slice) of self.wave
+        '''
+        self.wave_window = None
+        self.clear_component_caches()
+        if self.dust_em_class.assume_energy_balance:
+            return
+        nwave = len(self.wave)
+        sel = np.where(np.any(self.filter_matrix[:, self.filter_flag] > 0.,
+                              axis=1))[0]
+        if not len(sel):
+            return
+        obs_lo, obs_hi = sel[0], sel[-1]
+        if self.use_absorption_indx and len(self.absindx_dict):
+            bands = np.hstack([np.hstack(self.absindx_dict[indx][1:4])
+                               for indx in self.absindx_dict.keys()])
+            obs_lo = min(obs_lo, np.searchsorted(self.wave, bands.min()) - 1)
+            obs_hi = max(obs_hi, np.searchsorted(self.wave, bands.max()) + 2)
+        obs_lo, obs_hi = max(obs_lo, 0), min(obs_hi, nwave - 1)
+        # model wavelengths bracketing the window once redshifted
+        zwave = self.wave * (1. + self.redshift)
+        rest_lo = max(np.searchsorted(zwave, self.wave[obs_lo],
+                                      side='right') - 1, 0)
+        rest_hi = min(np.searchsorted(zwave, self.wave[obs_hi]), nwave - 1)
+        self.wave_window = (slice(rest_lo, rest_hi + 1),
+                            slice(obs_lo, obs_hi + 1))
+
+    def set_response_matrix(self):
+        '''Linear map from the rest-frame model spectrum (see build_rest_csp)
+        to the model flux densities in the filters used in the fit
+
+        For a fixed redshift, the resampling to the observed frame, the
+        (1+z) factor, the IGM/ISM transmission, the luminosity distance and
+        the filter curves combine into one matrix.  The absorption indices
+        are measured on the observed-frame spectrum, so the matrix is not
+        used when they are fit.
+
+        Builds
+        ------
+        self.response : numpy array (2 dim) or None
+            dimensions: (rest-frame wavelengths in the wavelength window,
+            filters used in the fit)
+        '''
+        self.response = None
+        if self.use_absorption_indx and len(self.absindx_dict):
+            return
+        if self.wave_window is None:
+            rest, obs = slice(None), slice(None)
+        else:
+            rest, obs = self.wave_window
+        redshifted = make_interpolation_operator(
+                            self.wave[obs], self.wave[rest] * (1. + self.redshift))
+        filters = self.filter_matrix[obs][:, self.filter_flag] * (
+                                           (1. + self.redshift) / self.Dl**2)
+        if self.tauIGM_lam is not None:
+            filters *= np.exp(-self.tauIGM_lam[obs])[:, np.newaxis]
+        if self.tauISM_lam is not None:
+            filters *= np.exp(-self.tauISM_lam[obs])[:, np.newaxis]
+        self.response = np.asarray(redshifted.T.dot(filters),
+                                   dtype=self.filter_matrix.dtype)
+
+    def set_dust_table(self, nsamples=20):
+        '''Tabulate the dust-attenuated photometry of every SSP template on
+        a grid of E(B-V) (see get_tabulated_photometry)
+
+        Only used for photometric fits (see set_response_matrix) with a dust
+        law whose only free parameter is E(B-V), A(wave) = E(B-V) * k(wave).
+        The diffuse component covers all ages, the birth cloud component
+        the ages up to t_birth at E(B-V) / EBV_old_young.  Under energy
+        balance, the bolometric luminosity is tabulated as an extra column.
+        The weighted sums of the templates are interpolated linearly in log
+        between the grid values (see interpolate_dust_table).  The maximum fractional photometric difference from the exact model
+        for a set of random models is reported.
+
+        Parameters
+        ----------
+        nsamples : int
+            number of random models compared with the exact model
+
+        Builds
+        ------
+        self.dust_table : dict or None
+            'diffuse' and 'birth': (E(B-V) grid, tabulated flux densities,
+            dimensions: (E(B-V), filters, ages, metallicities));
+            'lum0': bolometric luminosity of the unattenuated templates
+        '''
+        self.dust_table = None
+        if self.response is None:
+            self.log.info('Dust table not used: the absorption indices are '
+                          'measured on the full spectrum')
+            return
+        if self.dust_abs_class.get_nparams() != 1:
+            self.log.info('Dust table not used: the dust law has more than '
+                          'one free parameter')
+            return
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+
+        # attenuation curve per unit E(B-V)
+        EBV = self.dust_abs_class.EBV
+        self.dust_abs_class.EBV = 1.
+        k = self.dust_abs_class.evaluate(self.wave)[rest]
+        self.dust_abs_class.EBV = EBV
+
+        # number of templates (merged ages, see set_ssp_grid)
+        nage = self.ssp_spectra.shape[1]
+        nbirth = min(np.searchsorted(self.ssp_ages, self.t_birth) + 1,
+                     len(self.ssp_ages))
+        if self.ssp_age_members is not None:
+            nbirth = np.nonzero(
+                       self.ssp_age_members[:nbirth].any(axis=0))[0][-1] + 1
+
+        columns = self.response
+        lum0 = None
+        if self.dust_em_class.assume_energy_balance:
+            dnu = self.dnu[rest][:, np.newaxis]
+            columns = np.hstack([columns, dnu])
+            lum0 = self.tabulate_ssp_photometry(dnu, k, np.zeros(1),
+                                                nage)[0, 0]
+        lo, hi = self.dust_abs_class.EBV_lims
+        grid = np.linspace(lo, hi, int(np.ceil((hi - lo) /
+                                               self.dust_table_step)) + 1)
+        grid_birth = grid / self.dust_abs_class.EBV_old_young
+        self.dust_table = {'lum0': lum0}
+        for name, egrid, ntemp in [('diffuse', grid, nage),
+                                   ('birth', grid_birth, nbirth)]:
+            table = self.tabulate_ssp_photometry(columns, k, egrid, ntemp)
+            self.dust_table[name] = (egrid, table)
+
+        # Accuracy for random models (the random state is left unchanged)
+        theta = self.get_params()
+        state = np.random.get_state()
+        thetas = self.get_init_walker_values(kind='uniform', num=nsamples)
+        np.random.set_state(state)
+        exact = np.dot(self.response.T, self.build_rest_csp_batch(thetas)[0])
+        diff = np.abs(self.get_tabulated_photometry_batch(thetas)[0] - exact)
+        sel = np.abs(exact) > 0.
+        error = np.max(diff[sel] / np.abs(exact[sel])) if sel.any() else 0.
+        self.set_class_parameters(theta)
+        self.log.info('Dust table of %i E(B-V) values, maximum photometric '
+                      'difference from the exact model: %0.2e'
+                      % (len(grid), error))
+
+    def tabulate_ssp_photometry(self, columns, k, grid, nage):
+        '''Photometry of the SSP templates attenuated by E(B-V) * k(wave)
+
+        Parameters
+        ----------
+        columns : numpy array (2 dim)
+            rest-frame response of each column (see set_response_matrix),
+            dimensions: (rest-frame wavelength, columns)
+        k : numpy array (1 dim)
+            attenuation per unit E(B-V) at the rest-frame wavelengths
+        grid : numpy array (1 dim)
+            values of E(B-V)
+        nage : int
+            number of (youngest) SSP ages included
+
+        Returns
+        -------
+        table : numpy array (4 dim)
+            dimensions: (E(B-V), columns, ages, metallicities), with a
+            single metallicity if the metallicity is fixed
+        '''
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        # attenuated responses, dimensions: (E(B-V) * columns, wavelength)
+        att = (columns.T[np.newaxis] *
+               10**(-0.4 * grid[:, np.newaxis, np.newaxis] * k))
+        att = att.reshape(-1, len(k))
+        if self.met_class.fix_met:
+            # collapse the metallicities once
+            ssp = self.get_ssp_spectrum()[0][:, :nage, np.newaxis]
+        else:
+            ssp = self.ssp_spectra[:, :nage]
+        if self.ssp_basis is not None:
+            att = np.dot(att, self.ssp_basis[rest])
+        else:
+            ssp = ssp[rest]
+        table = np.dot(att, ssp.reshape(ssp.shape[0], -1))
+        return table.reshape((len(grid), columns.shape[1]) + ssp.shape[1:])
+
+    def interpolate_dust_table(self, table, EBV, weight, wei):
+        '''Weighted sum of the tabulated SSP photometry for a set of models,
+        interpolated linearly in log between the E(B-V) grid values
+
+        The models sharing a grid value are summed with one matrix product.
+
+        Parameters
+        ----------
+        table : tuple
+            (E(B-V) grid, table), see set_dust_table
+        EBV : numpy array (1 dim)
+            color excess of each model
+        weight : numpy array (2 dim)
+            weights of the SSP ages (see get_age_weights_batch),
+            dimensions: (models, ages)
+        wei : numpy array (2 dim)
+            weights of the SSP metallicities (see get_met_weights_batch),
+            dimensions: (metallicities, models)
+
+        Returns
+        -------
+        phot : numpy array (2 dim)
+            weighted photometry of each column of the table,
+            dimensions: (columns, models)
+        '''
+        grid, table = table
+        nmodel = len(EBV)
+        i = np.clip(np.searchsorted(grid, EBV) - 1, 0, len(grid) - 2)
+        t = (EBV - grid[i]) / (grid[i+1] - grid[i])
+
+        # weights of the templates, dimensions: (ages * metallicities, models)
+        weights = (weight[:, :table.shape[2], np.newaxis] *
+                   wei.T[:, np.newaxis, :]).reshape(nmodel, -1).T
+
+        # weighted sums at the grid values below and above each E(B-V)
+        nodes = np.hstack([i, i + 1])
+        models = np.hstack([np.arange(nmodel)] * 2)
+        phot = np.zeros((table.shape[1], 2 * nmodel))
+        for node in np.unique(nodes):
+            sel = np.nonzero(nodes == node)[0]
+            phot[:, sel] = np.dot(table[node].reshape(table.shape[1], -1),
+                                  weights[:, models[sel]])
+        tiny = np.finfo(float).tiny
+        logphot = np.log(np.maximum(phot, tiny))
+        return np.exp((1. - t) * logphot[:, :nmodel] + t * logphot[:, nmodel:])
+
+    def get_tabulated_photometry(self):
+        '''Model flux densities from the dust table for the current
+        parameters (see get_tabulated_photometry_batch)
+
+        In addition to the returns it also modifies a lineflux dictionary
+
+        Returns
+        -------
+        model_y : numpy array (1 dim)
+            model flux densities in the filters used in the fit
+        mass : float
+            Mass for csp given the SFH input
+        mdust_eb : float or None
+            Dust mass under energy balance
+        '''
+        theta = np.array([self.get_params()])
+        model_y, mass, mdust_eb, linespec = \
+                                  self.get_tabulated_photometry_batch(theta)
+        if linespec is not None:
+            self.set_emline_fluxes(linespec[:, 0])
+        if mdust_eb is not None:
+            mdust_eb = mdust_eb[0]
+        return model_y[:, 0], mass[0], mdust_eb
+
+    def get_tabulated_photometry_batch(self, thetas):
+        '''Model flux densities from the dust table (see set_dust_table) for
+        a set of parameter vectors
+
+        The dust law is only evaluated at the emission line wavelengths,
+        and only if the emission lines are fit.
+
+        Parameters
+        ----------
+        thetas : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        model_y : numpy array (2 dim)
+            model flux densities in the filters used in the fit,
+            dimensions: (filters, models)
+        mass : numpy array (1 dim)
+            Mass of each model
+        mdust_eb : numpy array (1 dim) or None
+            Dust mass of each model under energy balance
+        linespec : numpy array (2 dim) or None
+            dust-attenuated emission line fluxes at 10 pc of each model
+            (see set_emline_fluxes), dimensions: (emission line wavelength,
+            models); None if the emission lines are not fit
+        '''
+        params = self.get_class_parameters_batch(thetas)
+        nmodel = len(thetas)
+        sfh_params = params['sfh_class']
+        sfr = self.sfh_class.evaluate_batch(self.ssp_ages, sfh_params)
+        weight, weight_birth, mass = self.get_age_weights_batch(
+                              sfr, self.sfh_class.get_age_batch(sfh_params))
+        if self.met_class.fix_met:
+            wei = self.get_met_weights()[:, np.newaxis].repeat(nmodel, axis=1)
+            # a fixed metallicity is collapsed in the table
+            table_wei = np.ones((1, nmodel))
+        else:
+            wei = self.get_met_weights_batch(params['met_class'][:, 0])
+            table_wei = wei
+        EBV = params['dust_abs_class'][:, 0]
+        phot = (self.interpolate_dust_table(self.dust_table['diffuse'], EBV,
+                                            weight, table_wei) +
+                self.interpolate_dust_table(self.dust_table['birth'],
+                                 EBV / self.dust_abs_class.EBV_old_young,
+                                 weight_birth, table_wei))
+
+        # Dust emission
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        dust_em = self.get_dust_emission_batch(params['dust_em_class'])
+        if self.dust_em_class.assume_energy_balance:
+            L_bol = (np.einsum('az,zm,ma->m', self.dust_table['lum0'],
+                               table_wei, weight + weight_birth) - phot[-1])
+            mdust_eb = L_bol / np.dot(self.dnu[rest], dust_em)
+            dust_em = mdust_eb * dust_em
+        else:
+            mdust_eb = None
+        nfilt = self.response.shape[1]
+        model_y = phot[:nfilt] + np.dot(self.response.T, dust_em)
+
+        # Modeled emission line fluxes (birth cloud component)
+        if not self.use_emline_flux:
+            return model_y, mass, mdust_eb, None
+        Alam = self.dust_abs_class.evaluate_batch(self.emlinewave,
+                                                  params['dust_abs_class']).T
+        trans_emline = np.exp(-0.4 * np.log(10.) * Alam /
+                              self.dust_abs_class.EBV_old_young)
+        weights = (weight_birth[:, :, np.newaxis] *
+                   wei.T[:, np.newaxis, :]).reshape(nmodel, -1).T
+        linespec = np.dot(self.ssp_emline.reshape(len(self.emlinewave), -1),
+                          weights) * trans_emline
+        return model_y, mass, mdust_eb, linespec
+
     def get_filter_wavelengths(self):
         '''Get central wavelengths of photometric filters 
         '''
@@ -319,58 +830,139 @@ class Mcsed:
         return f_nu
 
 
+    def set_absindx_operator(self):
+        '''Compile the absorption index definitions (self.absindx_dict) into
+        band integrals over the model wavelength grid
+
+        Each band covers the grid points nearest to its limits (at least
+        two points); the conversion of the spectrum to f_lambda is folded
+        into the integration weights, so only the wavelengths touched by
+        the bands are read.
+
+        Builds
+        ------
+        self.absindx_operator : dict
+            'names', 'units' : index names and units
+            'cont' : (pixels, first pixel of each band, weights) of the blue
+                and red continuum bands (bands 0..n-1 blue, n..2n-1 red)
+            'cont_wave' : central wavelengths of the blue and red bands
+            'index' : (pixels, index number, first pixel of each index,
+                weights, wavelengths, f_lambda factor) of the index bands
+            'width' : width of each index band
+        '''
+        wave = self.wave
+        factor = clight.to('Angstrom/s').value / wave**2.
+
+        def band(limits):
+            lo = np.argmin(abs(wave-limits[0]))
+            hi = max(np.argmin(abs(wave-limits[1])), lo + 2)
+            return np.arange(lo, hi - 1), np.diff(wave[lo:hi])
+
+        names = list(self.absindx_dict.keys())
+        nindx = len(names)
+        units = np.zeros(nindx, dtype=int)
+        cont_wave = np.zeros((2, nindx))
+        cont = [[], [], []]
+        index = [[], [], [], []]
+        width = np.zeros(nindx)
+        # mean f_lambda over the blue and red continuum bands
+        # (all blue bands first; the pixels of each band are contiguous)
+        for j in range(2):
+            for i, indx in enumerate(names):
+                limits = self.absindx_dict[indx][2 + j]
+                cont_wave[j, i] = np.median(limits)
+                pix, dw = band(limits)
+                cont[1].append(sum(len(p) for p in cont[0]))
+                cont[0].append(pix)
+                cont[2].append(factor[pix] * dw / dw.sum())
+        for i, indx in enumerate(names):
+            wht, wave_indx, wave_blue, wave_red, unit = self.absindx_dict[indx]
+            units[i] = unit
+            pix, dw = band(wave_indx)
+            index[2].append(sum(len(p) for p in index[0]))
+            index[0].append(pix)
+            index[1].append(np.full(len(pix), i))
+            index[3].append(dw)
+            width[i] = dw.sum()
+        cont = [np.hstack(c) for c in cont]
+        index = [np.hstack(c) for c in index]
+        index += [wave[index[0]], factor[index[0]]]
+        self.absindx_operator = {'names': names, 'units': units,
+                                 'cont': cont, 'cont_wave': cont_wave,
+                                 'index': index, 'width': width}
+
+    def get_absorption_indices(self, spectra):
+        '''
+        Absorption indices of one or more spectra
+        (see set_absindx_operator)
+
+        Parameters
+        ----------
+        spectra : numpy array (1 or 2 dim)
+            spectra on self.wave, dimensions: (wavelength[, models])
+
+        Returns
+        -------
+        value : numpy array (1 or 2 dim)
+            absorption indices in the order of self.absindx_operator['names'],
+            dimensions: (indices[, models])
+        '''
+        if self.absindx_operator is None:
+            self.set_absindx_operator()
+        op = self.absindx_operator
+        nindx = len(op['names'])
+        spec = spectra.reshape(len(spectra), -1)
+
+        # estimate continuum in the index (line through the mean
+        # f_lambda of the blue and red bands)
+        pix, start, wht = op['cont']
+        fw = np.add.reduceat(spec[pix] * wht[:, np.newaxis], start, axis=0)
+        fw_blue, fw_red = fw[:nindx], fw[nindx:]
+        wave_blue, wave_red = op['cont_wave'][:, :, np.newaxis]
+        slope = (fw_red - fw_blue) / (wave_red - wave_blue)
+        pix, num, start, dw, wave, factor = op['index']
+        cont_index = (fw_blue[num] + slope[num] *
+                      (wave[:, np.newaxis] - wave_blue[num]))
+
+        # flux ratio of index and continuum, integrated over the index
+        spec_index = spec[pix] * factor[:, np.newaxis] / cont_index
+        integral = np.add.reduceat(spec_index * dw[:, np.newaxis], start,
+                                   axis=0)
+
+        units = op['units'][:, np.newaxis]
+        width = op['width'][:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = np.select(
+                [units==0, units==1, units==2],
+                # equivalent width (Angstroms), magnitudes, and flux
+                # density ratio (red / blue)
+                [width - integral,
+                 -2.5 * np.log10(integral / width),
+                 fw_red / fw_blue])
+        return value.reshape((nindx,) + spectra.shape[1:])
+
     def measure_absorption_index(self):
         '''
         measure absorption indices using current spectrum
+        (see get_absorption_indices)
         '''
         self.absindxCSPdict = {}
-        if self.use_absorption_indx:
-            # convert the spectrum from units of specific frequency to specific wavelength
-            wave = self.wave.copy()
-            factor = clight.to('Angstrom/s').value / wave**2.
-            spec = self.spectrum * factor
-
-            for indx in self.absindx_dict.keys():
-                wht, wave_indx, wave_blue, wave_red, unit = self.absindx_dict[indx]
-
-                # select appropriate data ranges for blue/red continuum and index
-                sel_index = np.array([False]*len(wave))
-                sel_index[np.argmin(abs(wave-wave_indx[0])):np.argmin(abs(wave-wave_indx[1]))] = True
-                if abs(np.argmin(abs(wave-wave_indx[0]))-np.argmin(abs(wave-wave_indx[1])))<2:
-                    sel_index[np.argmin(abs(wave-wave_indx[0])):np.argmin(abs(wave-wave_indx[0]))+2] = True
-                sel_blue = np.array([False]*len(wave))
-                sel_blue[np.argmin(abs(wave-wave_blue[0])):np.argmin(abs(wave-wave_blue[1]))] = True
-                if abs(np.argmin(abs(wave-wave_blue[0]))-np.argmin(abs(wave-wave_blue[1])))<2:
-                    sel_blue[np.argmin(abs(wave-wave_blue[0])):np.argmin(abs(wave-wave_blue[0]))+2] = True
-                sel_red = np.array([False]*len(wave))
-                sel_red[np.argmin(abs(wave-wave_red[0])):np.argmin(abs(wave-wave_red[1]))] = True
-                if abs(np.argmin(abs(wave-wave_red[0]))-np.argmin(abs(wave-wave_red[1])))<2:
-                    sel_red[np.argmin(abs(wave-wave_red[0])):np.argmin(abs(wave-wave_red[0]))+2] = True
-
-                # estimate continuum in the index:
-                fw_blue  = np.dot(spec[sel_blue][0:-1], np.diff(wave[sel_blue])) 
-                fw_blue /= np.diff(wave[sel_blue][[0,-1]])
-                fw_red   = np.dot(spec[sel_red][0:-1],  np.diff(wave[sel_red]))  
-                fw_red  /= np.diff(wave[sel_red][[0,-1]])
-                cont_waves = [np.median(wave_blue), np.median(wave_red)]
-                cont_fw    = [fw_blue, fw_red]
-                coeff = np.polyfit( cont_waves, cont_fw, 1)
-                cont_index = coeff[0] * wave[sel_index] + coeff[1]
-
-                # flux ratio of index and continuum
-                spec_index = spec[sel_index] / cont_index
-
-                if unit==0: # return measurement in equivalent width (Angstroms)
-                    value = np.dot( 1. - spec_index[0:-1], np.diff(wave[sel_index]) )
-
-                if unit==1: # return measurement in magnitudes
-                    integral = np.dot( spec_index[0:-1], np.diff(wave[sel_index]) )
-                    value = -2.5 * np.log10( integral / np.diff(wave[sel_index][[0,-1]]) ) 
-
-                if unit==2: # return measurement as a flux density ratio (red / blue)
-                    value = fw_red / fw_blue
-
-                self.absindxCSPdict[indx] = float(value)
+        if self.use_absorption_indx and len(self.absindx_dict):
+            self.set_absorption_indices(
+                                self.get_absorption_indices(self.spectrum))
+
+    def set_absorption_indices(self, value):
+        '''Update the modeled absorption indices (self.absindxCSP and the
+        dictionary self.absindxCSPdict)
+
+        Parameters
+        ----------
+        value : numpy array (1 dim)
+            absorption indices (see get_absorption_indices)
+        '''
+        self.absindxCSP = value
+        self.absindxCSPdict = dict(zip(self.absindx_operator['names'],
+                                       [float(v) for v in value]))
 
 
     def set_class_parameters(self, theta):
@@ -405,6 +997,73 @@ class Mcsed:
         start_value += self.dust_em_class.get_nparams()
 
 
+    def get_class_parameters_batch(self, thetas):
+        ''' Split a set of parameter vectors into the parameters of each
+        class (see set_class_parameters)
+
+        Input
+        -----
+        thetas : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        params : dict
+            for each of self.param_classes, the parameters of that class,
+            dimensions: (models, class parameters)
+        '''
+        thetas = np.asarray(thetas, dtype=float)
+        params = {}
+        start_value = 0
+        for par_cl in self.param_classes:
+            nparams = getattr(self, par_cl).get_nparams()
+            params[par_cl] = thetas[:, start_value:start_value+nparams]
+            start_value += nparams
+        return params
+
+    def get_met_weights(self):
+        '''
+        Weights of the SSP grid metallicities (self.ssp_met) for the current
+        stellar metallicity (self.met_class.met), see get_met_weights_batch
+
+        Returns
+        -------
+        wei : 1-d array
+            normalized weight of each metallicity in self.ssp_met
+        '''
+        return self.get_met_weights_batch(np.array([self.met_class.met]))[:, 0]
+
+    def get_met_weights_batch(self, met):
+        '''
+        Weights of the SSP grid metallicities (self.ssp_met) for a set of
+        stellar metallicities
+
+        A free metallicity is rounded to self.met_cache_step, if set, and
+        weights below self.met_weight_floor times the largest weight are
+        set to zero.
+
+        Parameters
+        ----------
+        met : numpy array (1 dim)
+            stellar metallicity of each model (in log solar units)
+
+        Returns
+        -------
+        wei : 2-d array
+            normalized weight of each metallicity in self.ssp_met,
+            dimensions: (metallicities, models)
+        '''
+        Z = np.log10(self.ssp_met)
+        Zsolar = 0.019
+        if self.met_cache_step and not self.met_class.fix_met:
+            met = np.round(met / self.met_cache_step) * self.met_cache_step
+        z = met + np.log10(Zsolar)
+        X = Z[:, np.newaxis] - z
+        wei = np.exp(-(X)**2 / (2. * 0.15**2))
+        wei[wei < self.met_weight_floor * wei.max(axis=0)] = 0.
+        wei /= wei.sum(axis=0)
+        return wei
+
     def get_ssp_spectrum(self):
         '''
         Calculate SSP for an arbitrary metallicity (self.met_class.met) given a
@@ -416,10 +1075,15 @@ class Mcsed:
         the SSP grid of metallicities (self.ssp_met) assumes values of Z
         (as opposed to log solar values)
 
+        Only the metallicities with nonzero weight are combined.  If
+        self.met_cache_step is set, the results for a free metallicity are
+        kept in a least recently used cache within self.met_cache_mb.
+
         Returns
         -------
         SSP : 2-d array
             Single stellar population models for each age in self.ages
+            (coefficients of self.ssp_basis if set)
         lineSSP : 2-d array
             Single stellar population line fluxes for each age in self.ages
 
@@ -427,39 +1091,77 @@ class Mcsed:
         if self.met_class.fix_met:
             if self.SSP is not None:
                 return self.SSP, self.lineSSP
-        Z = np.log10(self.ssp_met)
-        Zsolar = 0.019
-        z = self.met_class.met + np.log10(Zsolar)
-        X = Z - z
-        wei = np.exp(-(X)**2 / (2. * 0.15**2))
-        wei /= wei.sum()
-        self.SSP = np.dot(self.ssp_spectra, wei)
+        use_cache = self.met_cache_step and not self.met_class.fix_met
+        if use_cache:
+            key = int(np.round(self.met_class.met / self.met_cache_step))
+            cached = self.ssp_met_cache.get(key)
+            if cached is not None:
+                self.SSP, self.lineSSP = cached
+                return self.SSP, self.lineSSP
+        wei = self.get_met_weights()
+        sel = np.nonzero(wei)[0]
+        lo, hi = sel[0], sel[-1] + 1
+        self.SSP = np.dot(self.ssp_spectra[:, :, lo:hi],
+                          wei[lo:hi].astype(self.ssp_spectra.dtype))
         if self.use_emline_flux:
-            self.lineSSP = np.dot(self.ssp_emline, wei)
+            self.lineSSP = np.dot(self.ssp_emline[:, :, lo:hi], wei[lo:hi])
         else:
             self.lineSSP = self.ssp_emline[:,:,0]
+        if use_cache:
+            size = float(self.SSP.nbytes + self.lineSSP.nbytes)
+            self.ssp_met_cache.maxsize = max(
+                                int(self.met_cache_mb * 2**20 / size), 1)
+            self.ssp_met_cache.put(key, (self.SSP, self.lineSSP))
         return self.SSP, self.lineSSP
 
-    def build_csp(self, sfr=None):
-        '''Build a composite stellar population model for a given star
-        formation history, dust attenuation law, and dust emission law.
-
-        In addition to the returns it also modifies a lineflux dictionary
+    def get_age_weights(self, sfr=None):
+        '''Weights of the SSP ages for the current star formation history
+        (see get_age_weights_batch)
 
         Returns
         -------
-        csp : numpy array (1 dim)
-            Composite stellar population model (micro-Jy) at self.redshift
+        weight : numpy array (1 dim)
+            weights of the SSP ages older than the birth cloud
+        weight_birth : numpy array (1 dim)
+            weights of the SSP ages within the birth cloud
         mass : float
             Mass for csp given the SFH input
         '''
-        # Collapse for metallicity
-        SSP, lineSSP = self.get_ssp_spectrum()
-
         # Need star formation rate from observation back to formation
         if sfr is None:
             sfr = self.sfh_class.evaluate(self.ssp_ages)
-        ageval = 10**self.sfh_class.age # Gyr
+        weight, weight_birth, mass = self.get_age_weights_batch(
+                       sfr[np.newaxis, :], np.array([self.sfh_class.age]))
+        return weight[0], weight_birth[0], mass[0]
+
+    def get_age_weights_batch(self, sfr, age):
+        '''Weights of the SSP ages for a set of star formation histories
+
+        The weight of each SSP age is the star formation rate times the
+        linear time between ages, split into the diffuse and birth cloud
+        components.
+
+        Parameters
+        ----------
+        sfr : numpy array (2 dim)
+            star formation rate at each SSP age, dimensions: (models, ages)
+        age : numpy array (1 dim)
+            age of each model in log Gyr
+
+        Returns
+        -------
+        weight : numpy array (2 dim)
+            weights of the SSP ages older than the birth cloud,
+            dimensions: (models, ages), or (models, templates) for merged
+            ages (see set_ssp_grid)
+        weight_birth : numpy array (2 dim)
+            weights of the SSP ages within the birth cloud,
+            dimensions: (models, ages), or (models, templates)
+        mass : numpy array (1 dim)
+            Mass for csp given the SFH input
+        '''
+        ages = self.ssp_ages
+        ageval = 10**np.asarray(age, dtype=float) # Gyr
 
         # Treat the birth cloud and diffuse component separately
         age_birth = self.t_birth 
@@ -467,115 +1169,357 @@ class Mcsed:
         # Get dust-free CSPs, properly accounting for ages
         # ageval sets limit on ssp_ages that are useable in model calculation
         # age_birth separates birth cloud and diffuse components
-        sel = (self.ssp_ages > age_birth) & (self.ssp_ages <= ageval)
-        sel_birth = (self.ssp_ages <= age_birth) & (self.ssp_ages <= ageval)
-        sel_age = self.ssp_ages <= ageval
-
         # The weight is the linear time between ages of each SSP
-        weight = np.diff(np.hstack([0, self.ssp_ages])) * 1e9 * sfr
-        weight_orig = weight.copy()
-        weight_birth = weight.copy()
-        weight_age = weight.copy()
-        weight[~sel] = 0
-        weight_birth[~sel_birth] = 0
-        weight_age[~sel_age] = 0
+        weight_age = np.diff(np.hstack([0, ages])) * 1e9 * sfr
+        weight_age[ages > ageval[:, np.newaxis]] = 0
+        weight = np.where(ages > age_birth, weight_age, 0.)
+        weight_birth = np.where(ages <= age_birth, weight_age, 0.)
 
         # Cover the two cases where ssp_ages contains ageval and when not
         # A: index of last acceptable SSP age
-        A = np.nonzero(self.ssp_ages <= ageval)[0][-1]
-        # indices of SSP ages that are too old
-        select_too_old = np.nonzero(self.ssp_ages >= ageval)[0]
-        if len(select_too_old):
-            # B: index of first SSP that is too old
-            B = select_too_old[0]
-            # only adjust weight if ageval falls between two SSP age gridpoints
-            if A != B:
-                lw = ageval - self.ssp_ages[A]
-                wei = lw * 1e9 * np.interp(ageval, self.ssp_ages, sfr)
-                if ageval > age_birth:
-                    weight[B] = wei
-                if ageval <= age_birth:
-                    weight_birth[B] = wei
-                weight_age[B] = wei
+        # B: index of first SSP that is too old
+        A = np.searchsorted(ages, ageval, side='right') - 1
+        B = np.searchsorted(ages, ageval, side='left')
+        # only adjust weight if ageval falls between two SSP age gridpoints
+        rows = np.nonzero((A >= 0) & (B < len(ages)) & (A != B))[0]
+        if len(rows):
+            A, B, val = A[rows], B[rows], ageval[rows]
+            lw = val - ages[A]
+            slope = (sfr[rows, B] - sfr[rows, A]) / (ages[B] - ages[A])
+            wei = lw * 1e9 * (slope * lw + sfr[rows, A])
+            diffuse = val > age_birth
+            weight[rows[diffuse], B[diffuse]] = wei[diffuse]
+            weight_birth[rows[~diffuse], B[~diffuse]] = wei[~diffuse]
+            weight_age[rows, B] = wei
 
         # Cover two cases where ssp_ages contains age_birth and when not
-        # A: index of last acceptable SSP age
-        A = np.nonzero(self.ssp_ages <= age_birth)[0][-1]
-        # indices of SSP ages that are too old
-        select_too_old = np.nonzero(self.ssp_ages >= age_birth)[0]
-        if (len(select_too_old)>0): 
-            # B: index of first SSP that is too old
-            B = select_too_old[0]
-            if A != B:
-                lw = age_birth - self.ssp_ages[A]
-                wei = lw * 1e9 * np.interp(age_birth, self.ssp_ages, sfr)
-                if ageval > age_birth:
-                    weight[B] = weight_age[B] - wei
-                if ageval >= age_birth:
-                    weight_birth[B] = wei
-                else:
-                    weight_birth[B] = weight_age[B]
+        A = np.searchsorted(ages, age_birth, side='right') - 1
+        B = np.searchsorted(ages, age_birth, side='left')
+        if (A >= 0) and (B < len(ages)) and (A != B):
+            lw = age_birth - ages[A]
+            slope = (sfr[:, B] - sfr[:, A]) / (ages[B] - ages[A])
+            wei = lw * 1e9 * (slope * lw + sfr[:, A])
+            weight[:, B] = np.where(ageval > age_birth,
+                                    weight_age[:, B] - wei, weight[:, B])
+            weight_birth[:, B] = np.where(ageval >= age_birth, wei,
+                                          weight_age[:, B])
+
+        # Sum the weights of the ages merged in each template
+        if self.ssp_age_members is not None:
+            weight = np.dot(weight, self.ssp_age_members)
+            weight_birth = np.dot(weight_birth, self.ssp_age_members)
+
+        return weight, weight_birth, np.sum(weight_age, axis=1)
 
-        # Finally, do the matrix multiplication using the weights
-        spec_dustfree = np.dot(self.SSP, weight)
-        spec_birth_dustfree = np.dot(self.SSP, weight_birth)
-        linespec_dustfree = np.dot(self.lineSSP, weight_birth)
-        mass = np.sum(weight_age)
+    def build_csp(self, sfr=None):
+        '''Build a composite stellar population model for a given star
+        formation history, dust attenuation law, and dust emission law.
 
-        # Need to correct spectrum for dust attenuation
-        Alam = self.dust_abs_class.evaluate(self.wave)
-        spec_dustobscured = spec_dustfree * 10**(-0.4 * Alam)
+        In addition to the returns it also modifies a lineflux dictionary
 
-        # Correct the corresponding birth cloud spectrum separately
-        Alam_birth = Alam / self.dust_abs_class.EBV_old_young
-        spec_birth_dustobscured = spec_birth_dustfree * 10**(-0.4 * Alam_birth)
+        Returns
+        -------
+        csp : numpy array (1 dim)
+            Composite stellar population model (micro-Jy) at self.redshift
+        mass : float
+            Mass for csp given the SFH input
+        '''
+        spec_dustobscured, mass, mdust_eb = self.build_rest_csp(sfr)
 
-        # Combine the young and old components
-        spec_dustfree += spec_birth_dustfree
-        spec_dustobscured += spec_birth_dustobscured
+        # Redshift the spectrum to the observed frame
+        if self.wave_window is None:
+            rest, obs = slice(None), slice(None)
+        else:
+            rest, obs = self.wave_window
+        csp = np.zeros(len(self.wave), dtype=spec_dustobscured.dtype)
+        csp[obs] = np.interp(self.wave[obs],
+                             self.wave[rest] * (1. + self.redshift),
+                             spec_dustobscured * (1. + self.redshift))
 
-        # Compute attenuation for emission lines
-        Alam_emline = (self.dust_abs_class.evaluate(self.emlinewave,new_wave=True)
-                       / self.dust_abs_class.EBV_old_young)
-        linespec_dustobscured = linespec_dustfree * 10**(-0.4*Alam_emline)
+        # Correct for ISM and/or IGM (or neither)
+        if self.tauIGM_lam is not None:
+            csp[obs] *= np.exp(-self.tauIGM_lam[obs])
+        if self.tauISM_lam is not None:
+            csp[obs] *= np.exp(-self.tauISM_lam[obs])
 
+        # Correct spectra from 10pc to redshift of the source
+        csp /= self.Dl**2
+        if self.dust_em_class.assume_energy_balance:
+            return csp, mass, mdust_eb
+        else:
+            return csp, mass
+
+    def build_rest_csp(self, sfr=None):
+        '''Build the rest-frame composite stellar population model (before
+        redshifting and the IGM/ISM corrections) within the rest-frame
+        wavelength window (see set_wave_window)
+
+        In addition to the returns it also modifies a lineflux dictionary
+
+        Returns
+        -------
+        spec : numpy array (1 dim)
+            Rest-frame model (micro-Jy at 10 pc)
+        mass : float
+            Mass for csp given the SFH input
+        mdust_eb : float or None
+            Dust mass under energy balance
+        '''
+        # Wavelength window of the model (see set_wave_window)
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+
+        # Dust-free spectra (cached on the SFH and metallicity parameters)
+        spec_dustfree, spec_birth_dustfree, linespec_dustfree, mass = (
+                                                 self.get_dustfree_spectra(sfr))
+
+        # Need to correct spectrum for dust attenuation; the corresponding
+        # birth cloud spectrum is corrected separately
+        trans, trans_birth, trans_emline = self.get_dust_transmission()
+        spec_dustobscured = (spec_dustfree * trans +
+                             spec_birth_dustfree * trans_birth)
+
+        # Combine the young and old components
+        # (the cached dust-free spectra are not modified in place)
+        spec_dustfree = spec_dustfree + spec_birth_dustfree
+
+        dust_em = self.get_dust_emission()
         if self.dust_em_class.assume_energy_balance:
             # Bolometric luminosity of dust attenuation (for energy balance)
-            L_bol = (np.dot(self.dnu, spec_dustfree) - np.dot(self.dnu, spec_dustobscured)) 
-            dust_em = self.dust_em_class.evaluate(self.wave)
-            L_dust = np.dot(self.dnu,dust_em)
+            dnu = self.dnu[rest]
+            L_bol = (np.dot(dnu, spec_dustfree) - np.dot(dnu, spec_dustobscured)) 
+            L_dust = np.dot(dnu,dust_em)
             mdust_eb = L_bol/L_dust 
             spec_dustobscured += mdust_eb * dust_em
         else:
-            spec_dustobscured += self.dust_em_class.evaluate(self.wave)
+            mdust_eb = None
+            spec_dustobscured += dust_em
 
-        # Redshift the spectrum to the observed frame
-        csp = np.interp(self.wave, self.wave * (1. + self.redshift),
-                        spec_dustobscured * (1. + self.redshift))
+        # Update dictionary of modeled emission line fluxes
+        self.set_emline_fluxes(linespec_dustfree * trans_emline)
 
-        # Correct for ISM and/or IGM (or neither)
-        if self.tauIGM_lam is not None:
-            csp *= np.exp(-self.tauIGM_lam)
-        if self.tauISM_lam is not None:
-            csp *= np.exp(-self.tauISM_lam)
+        return spec_dustobscured, mass, mdust_eb
+
+    def get_dustfree_spectra(self, sfr=None):
+        '''Dust-free rest-frame spectra of the diffuse and birth cloud
+        components within the rest-frame wavelength window
+
+        The results for the current star formation history and metallicity
+        are kept in a least recently used cache (not used for an input sfr)
+
+        Parameters
+        ----------
+        sfr : numpy array (1 dim) or None
+            star formation rate at each SSP age (see get_age_weights)
+
+        Returns
+        -------
+        spec_dustfree : numpy array (1 dim)
+            dust-free spectrum of the diffuse component
+        spec_birth_dustfree : numpy array (1 dim)
+            dust-free spectrum of the birth cloud component
+        linespec_dustfree : numpy array (1 dim)
+            dust-free emission line fluxes (birth cloud component)
+        mass : float
+            Mass for csp given the SFH input
+        '''
+        if sfr is None:
+            key = (tuple(self.sfh_class.get_params()) +
+                   (getattr(self.sfh_class, 'age', None),
+                    self.met_class.met))
+            cached = self.dustfree_cache.get(key)
+            if cached is not None:
+                return cached
+
+        # Collapse for metallicity
+        SSP, lineSSP = self.get_ssp_spectrum()
+
+        # Wavelength window of the model (see set_wave_window)
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        if self.ssp_basis is None:
+            SSP = SSP[rest]
+
+        # Time weights of the SSP ages (diffuse and birth cloud components)
+        weight, weight_birth, mass = self.get_age_weights(sfr)
+
+        # Finally, do the matrix multiplication using the weights
+        # (spectra are kept in the precision of the SSP grid)
+        dtype = SSP.dtype
+        spec_dustfree = np.dot(SSP, weight.astype(dtype, copy=False))
+        spec_birth_dustfree = np.dot(SSP,
+                                     weight_birth.astype(dtype, copy=False))
+        if self.ssp_basis is not None:
+            # expand from the coefficients of the basis spectra
+            basis = self.ssp_basis[rest]
+            spec_dustfree = np.dot(basis, spec_dustfree)
+            spec_birth_dustfree = np.dot(basis, spec_birth_dustfree)
+        linespec_dustfree = np.dot(lineSSP, weight_birth)
+
+        spectra = (spec_dustfree, spec_birth_dustfree, linespec_dustfree, mass)
+        if sfr is None:
+            self.dustfree_cache.put(key, spectra)
+        return spectra
+
+    def get_dust_transmission(self):
+        '''Dust transmission of the diffuse and birth cloud components
+        within the rest-frame wavelength window, and of the emission lines
+        (birth cloud component)
+
+        The results are kept in a least recently used cache on the dust
+        attenuation parameters.  The dust law is evaluated on one grid
+        holding the rest-frame window and the emission line wavelengths
+        (its wavelength dependence is cached per grid, see
+        dust_abs.get_cached_curve), and the three transmissions come from
+        a single exponential.
+
+        Returns
+        -------
+        trans : numpy array (1 dim)
+            transmission of the diffuse component
+        trans_birth : numpy array (1 dim)
+            transmission of the birth cloud component
+        trans_emline : numpy array (1 dim)
+            transmission of the emission lines
+        '''
+        key = tuple(self.dust_abs_class.get_params())
+        cached = self.dust_abs_cache.get(key)
+        if cached is not None:
+            return cached
+        transmission = tuple(trans[:, 0] for trans in
+                             self.get_dust_transmission_batch(np.array([key])))
+        self.dust_abs_cache.put(key, transmission)
+        return transmission
+
+    def get_dust_transmission_batch(self, params):
+        '''Dust transmissions (see get_dust_transmission) for a set of
+        dust attenuation parameter vectors
+
+        Parameters
+        ----------
+        params : numpy array (2 dim)
+            dust attenuation parameters of each model,
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        trans : numpy array (2 dim)
+            transmission of the diffuse component,
+            dimensions: (wavelength, models)
+        trans_birth : numpy array (2 dim)
+            transmission of the birth cloud component,
+            dimensions: (wavelength, models)
+        trans_emline : numpy array (2 dim)
+            transmission of the emission lines,
+            dimensions: (emission line wavelength, models)
+        '''
+        if self.dust_wave is None:
+            if self.wave_window is None:
+                rest = slice(None)
+            else:
+                rest = self.wave_window[0]
+            self.dust_wave = np.hstack([self.wave[rest], self.emlinewave])
+        nrest = len(self.dust_wave) - len(self.emlinewave)
+        Alam = self.dust_abs_class.evaluate_batch(self.dust_wave, params).T
+        # diffuse (rest-frame window), birth cloud and emission lines
+        Alam = np.vstack([Alam[:nrest],
+                          Alam / self.dust_abs_class.EBV_old_young])
+        trans = np.exp(-0.4 * np.log(10.) * Alam)
+        dtype = self.ssp_spectra.dtype
+        return (trans[:nrest].astype(dtype, copy=False),
+                trans[nrest:2*nrest].astype(dtype, copy=False),
+                trans[2*nrest:])
+
+    def get_dust_emission(self):
+        '''Dust emission spectrum within the rest-frame wavelength window
+        (kept in a least recently used cache on the dust emission
+        parameters)
+
+        Returns
+        -------
+        dust_em : numpy array (1 dim)
+            dust emission spectrum (micro-Jy at 10 pc)
+        '''
+        key = tuple(self.dust_em_class.get_params())
+        cached = self.dust_em_cache.get(key)
+        if cached is not None:
+            return cached
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        dust_em = self.dust_em_class.evaluate(self.wave[rest])
+        self.dust_em_cache.put(key, dust_em)
+        return dust_em
+
+    def get_dust_emission_batch(self, params):
+        '''Dust emission spectra (see get_dust_emission) for a set of dust
+        emission parameter vectors
+
+        Parameters
+        ----------
+        params : numpy array (2 dim)
+            dust emission parameters of each model,
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        dust_em : numpy array (2 dim)
+            dust emission spectra (micro-Jy at 10 pc), dimensions:
+            (wavelength, models), or (wavelength, 1) for a fixed dust
+            emission spectrum
+        '''
+        if self.dust_em_class.fixed:
+            return self.get_dust_emission()[:, np.newaxis]
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        return self.dust_em_class.evaluate_batch(self.wave[rest], params).T
+
+    def set_emline_fluxes(self, linespec_dustobscured):
+        '''Update the modeled emission line fluxes (self.linefluxCSP at
+        each wavelength of self.emlinewave, and the dictionary
+        self.linefluxCSPdict)
+
+        Parameters
+        ----------
+        linespec_dustobscured : numpy array (1 dim)
+            dust-attenuated emission line fluxes at 10 pc
+            (see get_dustfree_spectra and get_dust_transmission)
+        '''
+        # flux is given in ergs / s / cm2 at 10 pc
+        # Correct flux from 10pc to redshift of source
+        self.linefluxCSP = linespec_dustobscured / self.Dl**2
 
-        # Update dictionary of modeled emission line fluxes
         linefluxCSPdict = {}
         if self.use_emline_flux:
-            for emline in self.emline_dict.keys():
-                indx = np.argmin(np.abs(self.emlinewave 
-                                        - self.emline_dict[emline][0]))
-                # flux is given in ergs / s / cm2 at 10 pc
-                flux = linespec_dustobscured[indx]
-                # Correct flux from 10pc to redshift of source
-                linefluxCSPdict[emline] = linespec_dustobscured[indx] / self.Dl**2
+            names, indx = self.get_emline_indices()
+            linefluxCSPdict = dict(zip(names, self.linefluxCSP[indx]))
         self.linefluxCSPdict = linefluxCSPdict
 
-        # Correct spectra from 10pc to redshift of the source
-        if self.dust_em_class.assume_energy_balance:
-            return csp / self.Dl**2, mass, mdust_eb
-        else:
-            return csp / self.Dl**2, mass
+    def get_emline_indices(self):
+        '''Names of the emission lines (self.emline_dict) and their nearest
+        wavelengths in self.emlinewave (computed on the first call)
+
+        Returns
+        -------
+        names : list
+            emission line names
+        indx : numpy array (1 dim)
+            index of each emission line in self.emlinewave
+        '''
+        if self.emline_indices is None:
+            names = list(self.emline_dict.keys())
+            indx = np.array([np.argmin(np.abs(self.emlinewave
+                                              - self.emline_dict[emline][0]))
+                             for emline in names], dtype=int)
+            self.emline_indices = (names, indx)
+        return self.emline_indices
 
     def lnprior(self):
         ''' Simple, uniform prior for input variables
@@ -592,6 +1536,24 @@ class Mcsed:
         else:
             return 0.0
 
+    def lnprior_batch(self, params):
+        ''' Simple, uniform prior (see lnprior) for a set of models
+
+        Parameters
+        ----------
+        params : dict
+            parameters of each class (see get_class_parameters_batch)
+
+        Returns
+        -------
+        flag : numpy array (1 dim)
+            True for the models with all parameters in bounds
+        '''
+        flag = True
+        for par_cl in self.param_classes:
+            flag = flag & getattr(self, par_cl).prior_batch(params[par_cl])
+        return flag
+
     def lnlike(self):
         ''' Calculate the log likelihood and return the value and stellar mass
         of the model as well as other derived parameters
@@ -603,74 +1565,170 @@ class Mcsed:
             The mass comes from building of the composite stellar population
             The parameters sfr10, sfr100, fpdr, mdust_eb are derived in get_derived_params(self)
         '''
-        if self.dust_em_class.assume_energy_balance:
-            self.spectrum, mass, mdust_eb = self.build_csp()
+        if self.dust_table is not None:
+            model_y, mass, mdust_eb = self.get_tabulated_photometry()
+        elif self.response is not None:
+            # photometry straight from the rest-frame spectrum
+            spec, mass, mdust_eb = self.build_rest_csp()
+            model_y = np.dot(spec, self.response)
         else:
-            self.spectrum, mass = self.build_csp()
-            mdust_eb = None
+            if self.dust_em_class.assume_energy_balance:
+                self.spectrum, mass, mdust_eb = self.build_csp()
+            else:
+                self.spectrum, mass = self.build_csp()
+                mdust_eb = None
+            model_y = self.get_filter_fluxdensities()
 
-        sfr10,sfr100,fpdr = self.get_derived_params()
+        if self.defer_derived_params:
+            sfr10, sfr100, fpdr = None, None, None
+        else:
+            sfr10,sfr100,fpdr = self.get_derived_params()
 
-        # likelihood contribution from the photometry
-        model_y = self.get_filter_fluxdensities()
-        inv_sigma2 = 1.0 / (self.data_fnu_e**2 + (model_y * self.sigma_m)**2)
-        chi2_term = -0.5 * np.sum((self.data_fnu - model_y)**2 * inv_sigma2)
-        parm_term = -0.5 * np.sum(np.log(1 / inv_sigma2))
+        return (self.get_lnlike(model_y), mass,sfr10,sfr100,fpdr,mdust_eb)
 
-        # calculate the degrees of freedom and store the current chi2 value
-        if not self.chi2:
-            dof_wht = list(np.ones(len(self.data_fnu)))
+    def get_lnlike(self, model_y):
+        ''' Log likelihood of the current model (self.spectrum and
+        self.linefluxCSP), see get_lnlike_batch
 
-        # likelihood contribution from the absorption line indices
+        Parameters
+        ----------
+        model_y : numpy array (1 dim)
+            model flux densities in the filters used in the fit
+
+        Returns
+        -------
+        log likelihood : float
+            The log likelihood includes a chi2_term and a parameters term.
+        '''
         self.measure_absorption_index()
-        if self.use_absorption_indx:
-            for indx in self.absindx_dict.keys():
-                unit = self.absindx_dict[indx][-1]
-                # if null value, ignore it (null = -99)
-                if (self.data_absindx['%s_INDX' % indx]+99 > 1e-10):
-                    indx_weight = self.absindx_dict[indx][0]
-                    model_indx = self.absindxCSPdict[indx]
-                    if unit == 1: # magnitudes
-                        model_err = 2.5*np.log10(1.+self.sigma_m)
-                    else:
-                        model_err = model_indx * self.sigma_m
-                    obs_indx = self.data_absindx['%s_INDX' % indx]
-                    obs_indx_e = self.data_absindx_e['%s_Err' % indx]
-                    sigma2 = obs_indx_e**2. + model_err**2.
-                    chi2_term += (-0.5 * (model_indx - obs_indx)**2 /
-                                  sigma2) * indx_weight
-                    parm_term += -0.5 * np.log(indx_weight * sigma2)
-                    if not self.chi2:
-                        dof_wht.append(indx_weight) 
+        lineflux, absindx = None, None
+        if self.linefluxCSP is not None:
+            lineflux = self.linefluxCSP[:, np.newaxis]
+        if self.absindxCSPdict:
+            absindx = self.absindxCSP[:, np.newaxis]
+        return self.get_lnlike_batch(model_y[:, np.newaxis], lineflux,
+                                     absindx)[0]
+
+    def get_lnlike_batch(self, model_y, lineflux, absindx):
+        ''' Log likelihood of a set of models
+
+        The chi2 and degrees of freedom of the last model are recorded in
+        self.chi2.
+
+        Parameters
+        ----------
+        model_y : numpy array (2 dim)
+            model flux densities in the filters used in the fit,
+            dimensions: (filters, models)
+        lineflux : numpy array (2 dim) or None
+            modeled emission line fluxes (see set_emline_fluxes),
+            dimensions: (emission line wavelength, models)
+        absindx : numpy array (2 dim) or None
+            modeled absorption indices (see get_absorption_indices),
+            dimensions: (indices, models)
+
+        Returns
+        -------
+        log likelihood : numpy array (1 dim)
+            The log likelihood includes a chi2_term and a parameters term.
+        '''
+        # likelihood contribution from the photometry
+        data_fnu = self.data_fnu[:, np.newaxis]
+        data_fnu_e = self.data_fnu_e[:, np.newaxis]
+        inv_sigma2 = 1.0 / (data_fnu_e**2 + (model_y * self.sigma_m)**2)
+        chi2_term = -0.5 * np.sum((data_fnu - model_y)**2 * inv_sigma2,
+                                  axis=0)
+        parm_term = -0.5 * np.sum(np.log(1 / inv_sigma2), axis=0)
+
+        # weights of the measurements for the degrees of freedom
+        dof_wht = [np.ones(len(self.data_fnu))]
+        data = self.lnlike_data
+        if data is None:
+            data = self.get_lnlike_data()
+
+        # likelihood contribution from the absorption line indices
+        if data['absindx'] is not None:
+            sel, obs_indx, obs_indx_e, indx_weight, mag = [
+                        col[:, np.newaxis] for col in data['absindx']]
+            model_indx = absindx[sel[:, 0]]
+            # magnitudes or other units
+            model_err = np.where(mag, 2.5*np.log10(1.+self.sigma_m),
+                                 model_indx * self.sigma_m)
+            sigma2 = obs_indx_e**2. + model_err**2.
+            chi2_term += np.sum((-0.5 * (model_indx - obs_indx)**2 /
+                                 sigma2) * indx_weight, axis=0)
+            parm_term += -0.5 * np.sum(np.log(indx_weight * sigma2), axis=0)
+            dof_wht.append(indx_weight[:, 0])
 
         # likelihood contribution from the emission lines
-        if self.use_emline_flux:
-            # if all lines have null line strengths, ignore 
-            if not min(self.data_emline) == max(self.data_emline) == -99:
-                for emline in self.emline_dict.keys():
-                    if self.data_emline['%s_FLUX' % emline] > -99: # null value
-                        emline_wave, emline_weight = self.emline_dict[emline]
-                        model_lineflux = self.linefluxCSPdict[emline]
-                        model_err = model_lineflux * self.sigma_m
-                        lineflux  = self.data_emline['%s_FLUX' % emline]
-                        elineflux = self.data_emline_e['%s_ERR' % emline]
-                        sigma2 = elineflux**2. + model_err**2.
-                        chi2_term += (-0.5 * (model_lineflux - lineflux)**2 /
-                                      sigma2) * emline_weight
-                        parm_term += -0.5 * np.log(emline_weight * sigma2)
-                        if not self.chi2:
-                            dof_wht.append(emline_weight)
+        if data['emline'] is not None:
+            indx, fluxes, elineflux, emline_weight = [
+                        col[:, np.newaxis] for col in data['emline']]
+            model_lineflux = lineflux[indx[:, 0]]
+            model_err = model_lineflux * self.sigma_m
+            sigma2 = elineflux**2. + model_err**2.
+            chi2_term += np.sum((-0.5 * (model_lineflux - fluxes)**2 /
+                                 sigma2) * emline_weight, axis=0)
+            parm_term += -0.5 * np.sum(np.log(emline_weight * sigma2), axis=0)
+            dof_wht.append(emline_weight[:, 0])
 
         # record current chi2 and degrees of freedom
         if not self.chi2:
             self.chi2 = {}
-            dof_wht = np.array(dof_wht)
+            dof_wht = np.hstack(dof_wht)
             npt = ( sum(dof_wht)**2. - sum(dof_wht**2.) ) / sum(dof_wht) + 1
             self.chi2['dof'] = npt - self.nfreeparams 
-        self.chi2['chi2']  = -2. * chi2_term
+        self.chi2['chi2']  = -2. * chi2_term[-1]
         self.chi2['rchi2'] = self.chi2['chi2'] / (self.chi2['dof'] - 1.)
 
-        return (chi2_term + parm_term, mass,sfr10,sfr100,fpdr,mdust_eb)
+        return chi2_term + parm_term
+
+    def get_lnlike_data(self):
+        '''Compile the measured emission line fluxes and absorption indices
+        of the source into arrays aligned with the modeled ones
+        (self.linefluxCSP and self.absindxCSP)
+
+        Null values (-99) are dropped.  fit_model compiles them once per
+        source (self.lnlike_data); otherwise get_lnlike compiles them on
+        each call.
+
+        Returns
+        -------
+        data : dict
+            'absindx' : None or (index in self.absindxCSP, measurements,
+                errors, weights, flag of indices in magnitudes)
+            'emline' : None or (index in self.linefluxCSP, fluxes,
+                errors, weights)
+        '''
+        data = {'absindx': None, 'emline': None}
+        if self.use_absorption_indx and len(self.absindx_dict):
+            if self.absindx_operator is None:
+                self.set_absindx_operator()
+            rows = []
+            for i, indx in enumerate(self.absindx_operator['names']):
+                obs_indx = self.data_absindx['%s_INDX' % indx]
+                # if null value, ignore it (null = -99)
+                if (obs_indx+99 > 1e-10):
+                    rows.append((i, obs_indx,
+                                 self.data_absindx_e['%s_Err' % indx],
+                                 self.absindx_dict[indx][0],
+                                 self.absindx_dict[indx][-1] == 1))
+            if rows:
+                data['absindx'] = [np.array(col) for col in zip(*rows)]
+
+        # if all lines have null line strengths, ignore
+        if (self.use_emline_flux and
+                not min(self.data_emline) == max(self.data_emline) == -99):
+            rows = []
+            for emline, indx in zip(*self.get_emline_indices()):
+                lineflux = self.data_emline['%s_FLUX' % emline]
+                if lineflux > -99: # null value
+                    rows.append((indx, lineflux,
+                                 self.data_emline_e['%s_ERR' % emline],
+                                 self.emline_dict[emline][1]))
+            if rows:
+                data['emline'] = [np.array(col) for col in zip(*rows)]
+        return data
 
     def lnprob(self, theta):
         ''' Calculate the log probabilty and return the value and stellar mass 
@@ -682,26 +1740,268 @@ class Mcsed:
             The log probability is just the sum of the logs of the prior and
             likelihood.  The mass comes from the building of the composite
             stellar population. The other derived parameters are calculated in get_derived_params()
+            With self.defer_derived_params, only the log probability is
+            returned.
         '''
         self.set_class_parameters(theta)
         lp = self.lnprior()
         if np.isfinite(lp):
             lnl,mass,sfr10,sfr100,fpdr,mdust_eb = self.lnlike()
-            if not self.dust_em_class.fixed:
-                if self.dust_em_class.assume_energy_balance:
-                    return lp + lnl, np.array([mass,sfr10,sfr100,fpdr,mdust_eb])
-                else:
-                    return lp + lnl, np.array([mass, sfr10, sfr100, fpdr])
+            if self.defer_derived_params:
+                return lp + lnl
+            return lp + lnl, self.get_blob(mass,sfr10,sfr100,fpdr,mdust_eb)
+        else:
+            if self.defer_derived_params:
+                return -np.inf
+            return -np.inf, self.get_blob(-np.inf, -np.inf, -np.inf, -np.inf,
+                                          -np.inf)
+
+    def get_blob(self, mass, sfr10, sfr100, fpdr, mdust_eb):
+        ''' Derived parameters stored with each step of the chain
+
+        Returns
+        -------
+        blob : numpy array (1 dim)
+            [mass,sfr10,sfr100,fpdr,mdust_eb], where fpdr is only included
+            if the dust emission is fit and mdust_eb only under energy balance
+        '''
+        if not self.dust_em_class.fixed:
+            if self.dust_em_class.assume_energy_balance:
+                return np.array([mass, sfr10, sfr100, fpdr, mdust_eb])
+            else:
+                return np.array([mass, sfr10, sfr100, fpdr])
+        else:
+            return np.array([mass, sfr10, sfr100])
+
+    def lnprob_batch(self, thetas):
+        ''' Calculate lnprob for a set of walkers at once
+
+        The priors, SFR weights, dust curves, spectra, photometry,
+        likelihoods and derived parameters of all walkers are computed
+        together with array operations and matrix products (see
+        build_csp_batch, or get_tabulated_photometry_batch with the dust
+        table).  The line fluxes, absorption indices and chi2 of
+        the last walker are kept, as with lnprob.
+
+        Parameters
+        ----------
+        thetas : numpy array (2 dim)
+            parameters of each walker, dimensions: (walkers, parameters)
+
+        Returns
+        -------
+        results : list
+            (log probability, derived parameters) of each walker, as
+            returned by lnprob
+        '''
+        thetas = np.atleast_2d(thetas)
+        if self.defer_derived_params:
+            results = [-np.inf] * len(thetas)
+        else:
+            results = [(-np.inf, self.get_blob(-np.inf, -np.inf, -np.inf,
+                                               -np.inf, -np.inf))] * len(thetas)
+        params = self.get_class_parameters_batch(thetas)
+        valid = np.nonzero(self.lnprior_batch(params))[0]
+        if not len(valid):
+            return results
+
+        absindx = None
+        if self.dust_table is not None:
+            # photometry from the dust table (no spectra are built)
+            model_y, masses, mdust_eb, linespec = \
+                          self.get_tabulated_photometry_batch(thetas[valid])
+        elif self.response is not None:
+            # photometry straight from the rest-frame spectra
+            spectra, masses, mdust_eb, linespec = \
+                                      self.build_rest_csp_batch(thetas[valid])
+            model_y = np.dot(self.response.T, spectra)
+        else:
+            spectra, masses, mdust_eb, linespec = self.build_csp_batch(
+                                                               thetas[valid])
+            model_y = np.dot(self.filter_matrix[:, self.filter_flag].T,
+                             spectra)
+            if self.use_absorption_indx and len(self.absindx_dict):
+                absindx = self.get_absorption_indices(spectra)
+        lineflux = None
+        if linespec is not None:
+            lineflux = linespec / self.Dl**2
+        lnl = self.get_lnlike_batch(model_y, lineflux, absindx)
+
+        # keep the modeled lines and indices of the last walker
+        if linespec is not None:
+            self.set_emline_fluxes(linespec[:, -1])
+        self.absindxCSPdict = {}
+        if absindx is not None:
+            self.set_absorption_indices(absindx[:, -1])
+
+        if self.defer_derived_params:
+            for j, i in enumerate(valid):
+                results[i] = lnl[j]
+            return results
+        blobs = self.get_blob_batch(
+                        dict((par_cl, p[valid]) for par_cl, p in params.items()),
+                        masses, mdust_eb)
+        for j, i in enumerate(valid):
+            results[i] = (lnl[j], blobs[j])
+        return results
+
+    def build_csp_batch(self, thetas):
+        ''' Build the composite stellar populations (see build_csp) for a
+        set of parameter vectors with matrix products
+
+        Parameters
+        ----------
+        thetas : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        csp : numpy array (2 dim)
+            Composite stellar population models (micro-Jy) at self.redshift,
+            dimensions: (wavelength, models)
+        mass : numpy array (1 dim)
+            Mass of each model
+        mdust_eb : numpy array (1 dim) or None
+            Dust mass of each model under energy balance
+        linespec : numpy array (2 dim)
+            dust-attenuated emission line fluxes at 10 pc of each model
+            (see set_emline_fluxes), dimensions: (emission line wavelength,
+            models)
+        '''
+        spec_dustobscured, mass, mdust_eb, linespec = \
+                                           self.build_rest_csp_batch(thetas)
+
+        # Redshift the spectra to the observed frame
+        if self.wave_window is None:
+            rest, obs = slice(None), slice(None)
+        else:
+            rest, obs = self.wave_window
+        redshifted = make_interpolation_operator(
+                            self.wave[obs], self.wave[rest] * (1. + self.redshift))
+        csp = np.zeros((len(self.wave), len(thetas)),
+                       dtype=spec_dustobscured.dtype)
+        csp[obs] = redshifted.dot(spec_dustobscured * (1. + self.redshift))
+
+        # Correct for ISM and/or IGM (or neither)
+        if self.tauIGM_lam is not None:
+            csp[obs] *= np.exp(-self.tauIGM_lam[obs])[:, np.newaxis]
+        if self.tauISM_lam is not None:
+            csp[obs] *= np.exp(-self.tauISM_lam[obs])[:, np.newaxis]
+
+        # Correct spectra from 10pc to redshift of the source
+        csp /= self.Dl**2
+        return csp, mass, mdust_eb, linespec
+
+    def build_rest_csp_batch(self, thetas):
+        ''' Build the rest-frame composite stellar populations (see
+        build_rest_csp) for a set of parameter vectors with matrix products
+
+        Parameters
+        ----------
+        thetas : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        spec : numpy array (2 dim)
+            Rest-frame models (micro-Jy at 10 pc) within the rest-frame
+            wavelength window, dimensions: (wavelength, models)
+        mass : numpy array (1 dim)
+            Mass of each model
+        mdust_eb : numpy array (1 dim) or None
+            Dust mass of each model under energy balance
+        linespec : numpy array (2 dim)
+            dust-attenuated emission line fluxes at 10 pc of each model
+            (see set_emline_fluxes), dimensions: (emission line wavelength,
+            models)
+        '''
+        # Wavelength window of the model (see set_wave_window)
+        if self.wave_window is None:
+            rest = slice(None)
+        else:
+            rest = self.wave_window[0]
+        nmodel = len(thetas)
+        nage, nmet = self.ssp_spectra.shape[1:]
+        fix_met = self.met_class.fix_met
+        dtype = self.ssp_spectra.dtype
+        params = self.get_class_parameters_batch(thetas)
+
+        # Weights of the SSP ages of all models
+        # (columns: diffuse components, then birth cloud components)
+        sfh_params = params['sfh_class']
+        sfr = self.sfh_class.evaluate_batch(self.ssp_ages, sfh_params)
+        weight, weight_birth, mass = self.get_age_weights_batch(
+                              sfr, self.sfh_class.get_age_batch(sfh_params))
+        weights = np.vstack([weight, weight_birth]).T
+
+        # Dust curves of all models
+        trans, trans_birth, trans_emline = self.get_dust_transmission_batch(
+                                                   params['dust_abs_class'])
+        dust_em = self.get_dust_emission_batch(params['dust_em_class'])
+
+        # Dust-free spectra of all models
+        if self.met_cache_step and not fix_met:
+            # one matrix product for each cached metallicity-collapsed grid
+            # (see get_ssp_spectrum), shared by the models rounding to it
+            if self.ssp_basis is None:
+                nrows = len(self.wave[rest])
             else:
-                return lp + lnl, np.array([mass, sfr10, sfr100])
+                nrows = self.ssp_spectra.shape[0]
+            spec = np.zeros((nrows, 2*nmodel), dtype=dtype)
+            linespec_dustfree = np.zeros((len(self.emlinewave), nmodel))
+            met = params['met_class'][:, 0]
+            keys = np.round(met / self.met_cache_step).astype(int)
+            for key in np.unique(keys):
+                models = np.nonzero(keys == key)[0]
+                columns = np.hstack([models, nmodel + models])
+                self.met_class.met = met[models[0]]
+                SSP, lineSSP = self.get_ssp_spectrum()
+                if self.ssp_basis is None:
+                    SSP = SSP[rest]
+                spec[:, columns] = np.dot(SSP,
+                                          weights[:, columns].astype(dtype))
+                linespec_dustfree[:, models] = np.dot(
+                                        lineSSP, weights[:, nmodel + models])
         else:
-            if not self.dust_em_class.fixed:
-                if self.dust_em_class.assume_energy_balance:
-                    return -np.inf, np.array([-np.inf, -np.inf, -np.inf, -np.inf, -np.inf])
-                else:
-                    return -np.inf, np.array([-np.inf, -np.inf, -np.inf, -np.inf])
+            # one matrix product for all models
+            if fix_met:
+                SSP, lineSSP = self.get_ssp_spectrum()
             else:
-                return -np.inf, np.array([-np.inf, -np.inf, -np.inf])
+                metweights = self.get_met_weights_batch(
+                                                  params['met_class'][:, 0])
+                SSP = self.ssp_spectra.reshape(self.ssp_spectra.shape[0], -1)
+                lineSSP = self.ssp_emline.reshape(self.ssp_emline.shape[0], -1)
+                weights = (weights[:, np.newaxis, :] *
+                           np.hstack([metweights, metweights])[np.newaxis])
+                weights = weights.reshape(nage * nmet, -1)
+            if self.ssp_basis is None:
+                SSP = SSP[rest]
+            spec = np.dot(SSP, weights.astype(dtype))
+            linespec_dustfree = np.dot(lineSSP, weights[:, nmodel:])
+        if self.ssp_basis is not None:
+            spec = np.dot(self.ssp_basis[rest], spec)
+        spec_dustfree = spec[:, :nmodel]
+        spec_birth_dustfree = spec[:, nmodel:]
+
+        # Dust attenuation of the young and old components
+        spec_dustobscured = (spec_dustfree * trans +
+                             spec_birth_dustfree * trans_birth)
+        spec_dustfree = spec_dustfree + spec_birth_dustfree
+
+        if self.dust_em_class.assume_energy_balance:
+            # Bolometric luminosity of dust attenuation (for energy balance)
+            dnu = self.dnu[rest]
+            L_bol = np.dot(dnu, spec_dustfree) - np.dot(dnu, spec_dustobscured)
+            mdust_eb = L_bol / np.dot(dnu, dust_em)
+            spec_dustobscured += mdust_eb * dust_em
+        else:
+            mdust_eb = None
+            spec_dustobscured += dust_em
+
+        # Modeled emission line fluxes of each model
+        linespec_dustobscured = linespec_dustfree * trans_emline
+
+        return spec_dustobscured, mass, mdust_eb, linespec_dustobscured
 
     def get_init_walker_values(self, kind='ball', num=None):
         ''' Before running emcee, this function generates starting points
@@ -787,13 +2087,26 @@ class Mcsed:
             if getattr(self, var) is None:
                 self.error('The variable %s must be set first' % var)
 
+        self.posterior_draws = None
         pos = self.get_init_walker_values(kind='ball')
         ndim = pos.shape[1]
         start = time.time()
+        # emcee passes the walkers of an ensemble through pool.map
+        pool = BatchMap(self.lnprob_batch) if self.batch_lnprob else None
         sampler = emcee.EnsembleSampler(self.nwalkers, ndim, self.lnprob,
-                                        a=2.0)
-        # Do real run
+                                        a=2.0, pool=pool)
+        # Do real run (on the wavelengths constraining the fit only)
+        self.lnlike_data = self.get_lnlike_data()
+        self.set_wave_window()
+        self.set_response_matrix()
+        if self.dust_table_step:
+            self.set_dust_table()
         sampler.run_mcmc(pos, self.nsteps, rstate0=np.random.get_state())
+        self.wave_window = None
+        self.clear_component_caches()
+        self.response = None
+        self.dust_table = None
+        self.lnlike_data = None
         end = time.time()
         elapsed = end - start
         self.log.info("Total time taken: %0.2f s" % elapsed)
@@ -815,36 +2128,37 @@ class Mcsed:
                 numderpar = 5
             else:
                 numderpar = 4
-        new_chain = np.zeros((self.nwalkers, self.nsteps, ndim+numderpar+1))
-        new_chain[:, :, :-(numderpar+1)] = sampler.chain
         self.chain = sampler.chain
-        for i in xrange(len(sampler.blobs)):
-            for j in xrange(len(sampler.blobs[0])):
-                for k in xrange(len(sampler.blobs[0][0])):
-                    x = sampler.blobs[i][j][k]
-                    # stellar mass and dust mass
-                    if k==0 or k==4: 
-                        new_chain[j, i, -(numderpar+1)+k] = np.where((np.isfinite(x)) * (x > 10.),
-                                               np.log10(x), -99.)
-                    # other derived parameters 
-                    else: 
-                        new_chain[j, i, -(numderpar+1)+k] = np.where((np.isfinite(x)),np.log10(x), -99.) 
-        new_chain[:, :, -1] = sampler.lnprobability
-        self.samples = new_chain[:, burnin_step:, :].reshape((-1, ndim+numderpar+1))
+        if self.defer_derived_params:
+            # derived parameters of the retained (thinned) samples only
+            thin = max(int(self.derived_params_thin), 1)
+            chain = sampler.chain[:, burnin_step::thin, :].reshape((-1, ndim))
+            lnprob = sampler.lnprobability[:, burnin_step::thin]
+            derived = self.get_derived_params_batch(chain)
+            self.samples = np.hstack([chain,
+                                      self.get_log_derived_params(derived),
+                                      lnprob.reshape((-1, 1))])
+        else:
+            new_chain = np.zeros((self.nwalkers, self.nsteps, ndim+numderpar+1))
+            new_chain[:, :, :-(numderpar+1)] = sampler.chain
+            # blobs: (steps, walkers, derived parameters)
+            blobs = np.array(sampler.blobs, dtype=float).reshape(
+                                                   (self.nsteps, -1, numderpar))
+            derived = blobs.swapaxes(0, 1).reshape((-1, numderpar))
+            new_chain[:, :, -(numderpar+1):-1] = self.get_log_derived_params(
+                          derived).reshape((self.nwalkers, self.nsteps, -1))
+            new_chain[:, :, -1] = sampler.lnprobability
+            self.samples = new_chain[:, burnin_step:, :].reshape((-1, ndim+numderpar+1))
 
 
     def get_derived_params(self):
         ''' These are not free parameters in the model, but are instead
         calculated from free parameters
         '''
-        # Lookback times for past 10 and 100 Myr (avoid t=0 for log purposes)
-        t_sfr100 = np.linspace(1.0e-9,0.1,num=251)
-        t_sfr10 = np.linspace(1.0e-9,0.01,num=251)
-        # Time-averaged SFR over the past 10 and 100 Myr 
-        sfrarray = self.sfh_class.evaluate(t_sfr100)
-        sfr100 = simps(sfrarray,x=t_sfr100)/(t_sfr100[-1]-t_sfr100[0])
-        sfrarray = self.sfh_class.evaluate(t_sfr10)
-        sfr10 = simps(sfrarray,x=t_sfr10)/(t_sfr10[-1]-t_sfr10[0])
+        # Time-averaged SFR over the past 10 and 100 Myr
+        # (lookback times from 1e-9 Gyr: avoid t=0 for log purposes)
+        sfr100 = self.sfh_class.average_sfr(1.0e-9, 0.1)
+        sfr10 = self.sfh_class.average_sfr(1.0e-9, 0.01)
 
         if self.dust_em_class.fixed:
             fpdr = None
@@ -858,11 +2172,152 @@ class Mcsed:
 
         return sfr10,sfr100,fpdr
 
+    def get_derived_params_batch(self, thetas):
+        ''' Derived parameters of a set of samples (see get_blob), used
+        when they are not tracked during the sampling
+        (self.defer_derived_params)
+
+        Under energy balance, the dust masses need the spectra, which are
+        built for self.nwalkers samples at a time (see build_rest_csp_batch).
+
+        Parameters
+        ----------
+        thetas : numpy array (2 dim)
+            parameters of each sample, dimensions: (samples, parameters)
+
+        Returns
+        -------
+        derived : numpy array (2 dim)
+            [mass,sfr10,sfr100,fpdr,mdust_eb] of each sample, with the
+            columns of get_blob
+        '''
+        params = self.get_class_parameters_batch(thetas)
+        if self.dust_em_class.assume_energy_balance:
+            nsample = len(thetas)
+            mass, mdust_eb = np.zeros(nsample), np.zeros(nsample)
+            for lo in range(0, nsample, self.nwalkers):
+                hi = min(lo + self.nwalkers, nsample)
+                spec, mass[lo:hi], mdust_eb[lo:hi], linespec = \
+                                    self.build_rest_csp_batch(thetas[lo:hi])
+        else:
+            sfh_params = params['sfh_class']
+            sfr = self.sfh_class.evaluate_batch(self.ssp_ages, sfh_params)
+            mass = self.get_age_weights_batch(
+                             sfr, self.sfh_class.get_age_batch(sfh_params))[2]
+            mdust_eb = None
+        return self.get_blob_batch(params, mass, mdust_eb)
+
+    def get_blob_batch(self, params, mass, mdust_eb):
+        ''' Derived parameters (see get_derived_params and get_blob) of a
+        set of models
+
+        Parameters
+        ----------
+        params : dict
+            parameters of each class (see get_class_parameters_batch)
+        mass : numpy array (1 dim)
+            Mass of each model
+        mdust_eb : numpy array (1 dim) or None
+            Dust mass of each model under energy balance
+
+        Returns
+        -------
+        blobs : numpy array (2 dim)
+            [mass,sfr10,sfr100,fpdr,mdust_eb] of each model, with the
+            columns of get_blob
+        '''
+        # Time-averaged SFR over the past 10 and 100 Myr
+        # (lookback times from 1e-9 Gyr: avoid t=0 for log purposes)
+        sfh_params = params['sfh_class']
+        sfr10 = self.sfh_class.average_sfr_batch(1.0e-9, 0.01, sfh_params)
+        sfr100 = self.sfh_class.average_sfr_batch(1.0e-9, 0.1, sfh_params)
+        blobs = [mass, sfr10, sfr100]
+        if not self.dust_em_class.fixed:
+            umin, gamma = params['dust_em_class'][:, :2].T
+            umax = 1.0e6
+            fpdr = gamma*np.log(umax/100.) / ((1.-gamma)*(1.-umin/umax) + gamma*np.log(umax/umin))
+            blobs.append(fpdr)
+            if self.dust_em_class.assume_energy_balance:
+                blobs.append(mdust_eb)
+        return np.array(blobs, dtype=float).T
+
+    def get_log_derived_params(self, derived):
+        ''' Derived parameters as stored in self.samples
+
+        Parameters
+        ----------
+        derived : numpy array (2 dim)
+            [mass,sfr10,sfr100,fpdr,mdust_eb] of each sample (see get_blob)
+
+        Returns
+        -------
+        logderived : numpy array (2 dim)
+            log10 of the derived parameters; -99 for non-finite values and
+            for stellar and dust masses below 10 solar masses
+        '''
+        valid = np.isfinite(derived)
+        # stellar mass and dust mass
+        for k in [0, 4]:
+            if k < derived.shape[1]:
+                valid[:, k] &= derived[:, k] > 10.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(valid, np.log10(derived), -99.)
+
+
+    def set_posterior_draws(self, rndsamples=200, lnprobcut=7.5):
+        ''' Draw random posterior samples and build their spectra,
+        photometry, SFH and dust attenuation curves once, for the median fit
+        and the plots (the draws are kept until the next fit_model)
+
+        Input
+        -----
+        rndsamples : int
+            number of random samples
+        lnprobcut : float
+            cut in log probability space with respect to the maximum
+            probability (see set_median_fit)
+
+        Builds
+        ------
+        self.posterior_draws : dict
+            'rndsamples', 'lnprobcut': settings of the draws
+            'index': indices of the draws in self.samples
+            'spectrum': spectra, dimensions: (draws, wavelength)
+            'fnu': filter flux densities, dimensions: (draws, filters)
+            'sfh': SFH curves (see sfh_class.get_plot_curve) of each draw
+            'dust': dust attenuation curves on self.wave of each draw
+        '''
+        draws = self.posterior_draws
+        if ((draws is not None) and (draws['rndsamples'] == rndsamples) and
+                (draws['lnprobcut'] == lnprobcut)):
+            return
+        chi2sel = np.where(self.samples[:, -1] >
+                           (np.max(self.samples[:, -1], axis=0) - lnprobcut))[0]
+        index = chi2sel[np.random.randint(0, len(chi2sel), rndsamples)]
+        thetas = self.samples[index, :]
+
+        # Spectra of the draws, built in batches of nwalkers models
+        spectrum = np.zeros((rndsamples, len(self.wave)))
+        for k in np.arange(0, rndsamples, self.nwalkers):
+            csp = self.build_csp_batch(thetas[k:k+self.nwalkers])[0]
+            spectrum[k:k+self.nwalkers] = csp.T
+        fnu = np.dot(spectrum, self.filter_matrix[:, self.filter_flag])
+
+        sfh, dust = ([], [])
+        for theta in thetas:
+            self.set_class_parameters(theta)
+            sfh.append(self.sfh_class.get_plot_curve())
+            dust.append(self.dust_abs_class.evaluate(self.wave))
+        self.posterior_draws = {'rndsamples': rndsamples,
+                                'lnprobcut': lnprobcut, 'index': index,
+                                'spectrum': spectrum, 'fnu': fnu,
+                                'sfh': sfh, 'dust': np.array(dust)}
 
     def set_median_fit(self,rndsamples=200,lnprobcut=7.5):
         '''
         set attributes
         median spectrum and filter flux densities for rndsamples random samples
+        (see set_posterior_draws)
 
         Input
         -----
@@ -883,24 +2338,10 @@ class Mcsed:
         self.medianspec : list (1d)
             median spectrum
         '''
-        chi2sel = (self.samples[:, -1] >
-                   (np.max(self.samples[:, -1], axis=0) - lnprobcut))
-        nsamples = self.samples[chi2sel, :]
-        wv = self.get_filter_wavelengths()
-        sp, fn = ([], [])
-        for i in np.arange(rndsamples):
-            ind = np.random.randint(0, nsamples.shape[0])
-            self.set_class_parameters(nsamples[ind, :])
-            if self.dust_em_class.assume_energy_balance:
-                self.spectrum, mass, mdust_eb = self.build_csp()
-            else:
-                self.spectrum, mass = self.build_csp()
-            fnu = self.get_filter_fluxdensities()
-            sp.append(self.spectrum * 1.)
-            fn.append(fnu * 1.)
-        self.medianspec = np.median(np.array(sp), axis=0)
-        self.fluxwv = wv
-        self.fluxfn = np.median(np.array(fn), axis=0)
+        self.set_posterior_draws(rndsamples, lnprobcut)
+        self.medianspec = np.median(self.posterior_draws['spectrum'], axis=0)
+        self.fluxwv = self.get_filter_wavelengths()
+        self.fluxfn = np.median(self.posterior_draws['fnu'], axis=0)
 
 
     def spectrum_plot(self, ax, color=[0.996, 0.702, 0.031], alpha=0.1):
@@ -957,15 +2398,17 @@ class Mcsed:
         ax3.set_xlabel(r'Wavelength [$\mu$m]')
         ax3.set_ylabel(r'$F_{\nu}$ [$\mu$Jy]')
 
-    def add_subplots(self, ax1, ax2, ax3, nsamples, rndsamples=200):
-        ''' Add Subplots to Triangle plot below '''
-        sp, fn = ([], []) 
-        for i in np.arange(rndsamples):
-            ind = np.random.randint(0, nsamples.shape[0])
-            self.set_class_parameters(nsamples[ind, :])
-            self.sfh_class.plot(ax1, alpha=0.1)
-            self.dust_abs_class.plot(ax2, self.wave, alpha=0.1)
-            self.spectrum_plot(ax3, alpha=0.1)
+    def add_subplots(self, ax1, ax2, ax3, rndsamples=200, lnprobcut=7.5):
+        ''' Add Subplots to Triangle plot below (from the posterior draws,
+        see set_posterior_draws) '''
+        self.set_posterior_draws(rndsamples, lnprobcut)
+        draws = self.posterior_draws
+        for curve, dust, spectrum in zip(draws['sfh'], draws['dust'],
+                                         draws['spectrum']):
+            self.sfh_class.plot(ax1, alpha=0.1, curve=curve)
+            self.dust_abs_class.plot(ax2, self.wave, alpha=0.1, dust=dust)
+            ax3.plot(self.wave, spectrum, color=[0.996, 0.702, 0.031],
+                     alpha=0.1)
 
         ax3.plot(self.wave, self.medianspec, color='dimgray')
         ax3.scatter(self.fluxwv, self.fluxfn, marker='x', s=200,
@@ -1068,7 +2511,7 @@ class Mcsed:
         self.add_sfr_plot(ax1)
         self.add_dust_plot(ax2)
         self.add_spec_plot(ax3)
-        self.add_subplots(ax1, ax2, ax3, nsamples)
+        self.add_subplots(ax1, ax2, ax3, lnprobcut=lnprobcut)
 
         for ax_loc in fig.axes:
             ax_loc.minorticks_on() 
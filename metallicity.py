@@ -6,6 +6,9 @@ module for handling the free or fixed stellar metallicity parameter
 
 """
 
+import numpy as np
+
+
 class stellar_metallicity:
     '''
     Define the stellar metallicity class
@@ -72,6 +75,24 @@ class stellar_metallicity:
         flag = (self.met >= self.met_lims[0]) * (self.met <= self.met_lims[1])
         return flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors
+
+        Parameters
+        ----------
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        flag : numpy array (1 dim)
+            True for the models within the boundaries
+        '''
+        if self.fix_met:
+            return np.ones(len(params), dtype=bool)
+        met = params[:, 0]
+        return (met >= self.met_lims[0]) & (met <= self.met_lims[1])
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
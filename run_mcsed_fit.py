@@ -12,7 +12,8 @@ import os.path as op
 import logging
 import config
 import ism_igm
-from ssp import read_ssp_fsps, bin_ssp_ages
+from ssp import (read_ssp_fsps, bin_ssp_ages, get_ssp_photometry,
+                 compress_ssp_ages, decompose_ssp_basis)
 from astropy.io import fits
 from astropy.table import Table, vstack
 from mcsed import Mcsed
@@ -186,7 +187,11 @@ def parse_args(argv=None):
                   'emline_list_dict', 'emline_factor', 'use_input_data',
                   'absorption_index_dict',
                   'output_dict', 'param_percentiles', 'reserved_cores', 
-                  'assume_energy_balance', 'ISM_correct_coords', 'IGM_correct']
+                  'assume_energy_balance', 'ISM_correct_coords', 'IGM_correct',
+                  'ssp_met_weight_floor', 'ssp_cache_dir', 'model_precision',
+                  'ssp_age_tolerance', 'ssp_basis_tolerance', 'batch_lnprob',
+                  'dust_table_step', 'met_cache_step', 'met_cache_mb',
+                  'defer_derived_params', 'derived_params_thin']
     for arg_i in arg_inputs:
         try:
             if getattr(args, arg_i) in [None, 0]:
@@ -271,11 +276,15 @@ def parse_args(argv=None):
     return args
 
 
-def build_filter_matrix(args, wave):
+def build_filter_matrix(args, wave, filter_matrix=None):
     '''Build a filter matrix with each row being an index of wave and
     each column being a unique filter.  This makes computation from spectra
     to magnitudes quick and easy.
 
+    If a previously built filter matrix is given (e.g., the one shared by
+    run_mcsed_parallel.py), its columns are reused and only the filters
+    beyond its last column are read from the FILTERS directory.
+
     Parameters
     ----------
     args : class
@@ -284,6 +293,9 @@ def build_filter_matrix(args, wave):
     wave : numpy array
         The wave array corresponds to the wavelengths of the SSP models being
         used.
+    filter_matrix : numpy array (2 dim) or None
+        filter matrix built for the same wave array and the first columns
+        of args.filt_dict
 
     Returns
     -------
@@ -292,8 +304,15 @@ def build_filter_matrix(args, wave):
         columns for each filter in args.filt_dict/config.filt_dict
     '''
     nfilters = len(args.filt_dict)
+    nbuilt = 0
+    if filter_matrix is not None:
+        nbuilt = min(filter_matrix.shape[1], nfilters)
+        if nbuilt == nfilters:
+            return filter_matrix[:, :nfilters]
     Fil_matrix = np.zeros((len(wave), nfilters))
-    for i in np.arange(nfilters):
+    if nbuilt:
+        Fil_matrix[:, :nbuilt] = filter_matrix[:, :nbuilt]
+    for i in np.arange(nbuilt, nfilters):
         wv, through = np.loadtxt(op.join('FILTERS', args.filt_dict[i]),
                                  unpack=True)
         new_through = np.interp(wave, wv, through, 0.0, 0.0)
@@ -394,6 +413,36 @@ def get_max_ssp_age(args, z=None):
     return (maxage_lo, maxage_hi)
 
 
+def compress_model_ages(args, mcsed_model, ages, SSP, lineSSP):
+    '''Merge SSP ages for the current galaxy, wherever the photometry in
+    the filters used in the fit is reproduced within args.ssp_age_tolerance
+    (see ssp.compress_ssp_ages)
+
+    Parameters
+    ----------
+    args : class
+        The args class is carried from function to function with information
+        from command line input and config.py
+    mcsed_model : class
+        Mcsed instance with the redshift and filter_flag of the galaxy set
+    ages, SSP, lineSSP : numpy arrays
+        full SSP age grid, spectra and emission line grid
+    '''
+    phot = get_ssp_photometry(mcsed_model.wave, SSP,
+                              mcsed_model.filter_matrix[:,
+                                                        mcsed_model.filter_flag],
+                              mcsed_model.redshift)
+    members, new_spec, new_linespec, max_error = compress_ssp_ages(
+                        ages, SSP, lineSSP, phot, mcsed_model.t_birth,
+                        args.ssp_age_tolerance)
+    mcsed_model.set_ssp_grid(ages, new_spec, new_linespec,
+                             age_members=members)
+    args.log.info('SSP ages compressed from %i to %i (ratio %0.1f), '
+                  'maximum photometric error %0.2e'
+                  % (len(ages), members.shape[1], float(len(ages)) /
+                     members.shape[1], max_error))
+
+
 def read_input_file(args):
     '''This function reads a very specific input file and joins it with
     archived 3dhst catalogs.  The input file should have the following columns:
@@ -707,10 +756,184 @@ def mock_data(args, mcsed_model, nsamples=5, phot_error=0.05):
     return y, yerr, zobs, params, true_y
 
 
-def main(argv=None, ssp_info=None):
+def build_mcsed_model(args, ssp_info, filter_matrix):
+    '''Build an instance of Mcsed with the model settings in args
+
+    Parameters
+    ----------
+    args : class
+        The args class is carried from function to function with information
+        from command line input and config.py
+    ssp_info : list
+        ages, wave, SSP, met, linewave, lineSSP (see ssp.read_ssp_fsps)
+    filter_matrix : numpy array (2 dim)
+        filter matrix built for the SSP wavelength grid
+
+    Returns
+    -------
+    mcsed_model : class
+        Mcsed instance (the data and redshift are set for each galaxy)
+    '''
+    ages, wave, SSP, met, linewave, lineSSP = ssp_info
+    mcsed_model = Mcsed(filter_matrix, SSP, linewave, lineSSP, ages, 
+                        met, wave, args.sfh,
+                        args.dust_law, args.dust_em, nwalkers=args.nwalkers,
+                        nsteps=args.nsteps,sigma_m=args.model_floor_error,
+                        batch_lnprob=args.batch_lnprob,
+                        dust_table_step=args.dust_table_step,
+                        met_weight_floor=args.ssp_met_weight_floor,
+                        met_cache_step=args.met_cache_step,
+                        met_cache_mb=args.met_cache_mb,
+                        defer_derived_params=args.defer_derived_params,
+                        derived_params_thin=args.derived_params_thin)
+
+    # Communicate emission line measurement preferences
+    mcsed_model.use_emline_flux = args.use_emline_flux
+    mcsed_model.emline_dict = args.emline_list_dict
+    mcsed_model.use_absorption_indx = args.use_absorption_indx
+    mcsed_model.absindx_dict = args.absorption_index_dict
+
+    # Adjust Rv in the dust attenuation model, if specified in config file
+    # (otherwise, use the default value for the requested dust law)
+    if args.Rv >= 0:
+        mcsed_model.dust_abs_class.Rv = args.Rv
+    else:
+        args.Rv = mcsed_model.dust_abs_class.Rv
+
+    # Adjust the relative attenuation between young/old populations in the dust model
+    # E(B-V)_diffuse = EBV_old_young * E(B-V)_birthcloud
+    mcsed_model.dust_abs_class.EBV_old_young = args.EBV_old_young
+
+    # Specify the age of the birth cloud (suffer different attenuation)
+    mcsed_model.t_birth = 10**(args.t_birth-9.) # Gyr
+
+    # Specify whether metallicity is fixed 
+    if args.metallicity:
+        mcsed_model.met_class.fix_met = True
+        Zsolar = 0.019
+        mcsed_model.met_class.met = np.log10(args.metallicity/Zsolar)
+    else:
+        mcsed_model.met_class.fix_met = False
+
+    # Specify whether dust emission is fixed
+    if (not args.fit_dust_em) | (args.test):
+        mcsed_model.dust_em_class.fixed = True
+    else:
+        mcsed_model.dust_em_class.fixed = False
+
+    # Specify whether energy balance is assumed
+    if args.assume_energy_balance:
+        if args.fit_dust_em:
+            mcsed_model.dust_em_class.assume_energy_balance = True
+        else:
+            mcsed_model.dust_em_class.assume_energy_balance = False
+    else:
+        mcsed_model.dust_em_class.assume_energy_balance = False
+
+    return mcsed_model
+
+
+def set_model_precision(args, ssp_info, filter_matrix):
+    '''Cast the SSP grid and filter matrix to args.model_precision
+
+    The emission line grid is small and is kept in double precision.
+
+    Returns
+    -------
+    ssp_info : list
+        ages, wave, SSP, met, linewave, lineSSP
+    filter_matrix : numpy array (2 dim)
+    '''
+    dtype = np.dtype(args.model_precision)
+    ssp_info = list(ssp_info)
+    ssp_info[2] = ssp_info[2].astype(dtype, copy=False)
+    return ssp_info, filter_matrix.astype(dtype, copy=False)
+
+
+def validate_model_precision(args, ssp_info, filter_matrix, nsamples=20):
+    '''Compare the photometry of the reduced precision model with the
+    double precision model for a reference set of random models
+
+    The reference models are drawn uniformly within the parameter limits
+    and the redshift range args.test_zrange (the state of the random number
+    generator is restored afterwards).
+
+    Parameters
+    ----------
+    args : class
+        The args class is carried from function to function with information
+        from command line input and config.py
+    ssp_info : list
+        ages, wave, SSP, met, linewave, lineSSP in double precision
+    filter_matrix : numpy array (2 dim)
+        filter matrix in double precision
+    nsamples : int
+        number of reference models
+
+    Returns
+    -------
+    maxdiff : float
+        maximum fractional difference of the filter flux densities
+    '''
+    models = [build_mcsed_model(args, ssp_info, filter_matrix),
+              build_mcsed_model(args, *set_model_precision(args, ssp_info,
+                                                           filter_matrix))]
+    zmin, zmax = args.test_zrange
+    state = np.random.get_state()
+    maxdiff = 0.
+    for i in np.arange(nsamples):
+        z = zmin + (zmax - zmin) * np.random.rand()
+        fnu = []
+        for model in models:
+            model.filter_flag = np.ones(filter_matrix.shape[1], dtype=bool)
+            model.set_new_redshift(z)
+            if not len(fnu):
+                theta = model.get_init_walker_values(kind='uniform', num=1)[0]
+            model.set_class_parameters(theta)
+            model.spectrum = model.build_csp()[0]
+            fnu.append(model.get_filter_fluxdensities())
+        sel = fnu[0] > 0.
+        if sel.any():
+            maxdiff = max(maxdiff, np.max(np.abs(fnu[1][sel] - fnu[0][sel])
+                                          / fnu[0][sel]))
+    np.random.set_state(state)
+    args.log.info('Model precision %s: maximum fractional difference of the '
+                  'photometry from float64 is %0.2e (%i reference models)'
+                  % (args.model_precision, maxdiff, nsamples))
+    return maxdiff
+
+
+def decompose_model_ssp(args, mcsed_model):
+    '''Replace the SSP grid of the model by its truncated SVD basis, with
+    templates reproduced within args.ssp_basis_tolerance
+    (see ssp.decompose_ssp_basis)
+
+    Parameters
+    ----------
+    args : class
+        The args class is carried from function to function with information
+        from command line input and config.py
+    mcsed_model : class
+        Mcsed instance holding the final (binned or compressed) SSP grid
+    '''
+    basis, coeffs, max_error = decompose_ssp_basis(mcsed_model.ssp_spectra,
+                                                   args.ssp_basis_tolerance)
+    args.log.info('SSP grid of %i templates decomposed into %i basis spectra, '
+                  'maximum fractional residual %0.2e'
+                  % (np.prod(coeffs.shape[1:]), basis.shape[1], max_error))
+    if basis.shape[1] >= coeffs.shape[1]:
+        args.log.warning('The SSP basis is not smaller than the age grid; '
+                         'consider a larger ssp_basis_tolerance')
+    mcsed_model.set_ssp_basis(basis, coeffs)
+
+
+def main(argv=None, ssp_info=None, filter_matrix=None):
     '''
     Execute the main functionality of MCSED
 
+    When called from run_mcsed_parallel.py, ssp_info and filter_matrix hold
+    the SSP grid and filter matrix loaded once by the parent process.
+
     Test mode: "python run_mcsed_fit.py -t"
 
     Live mode: "python run_mcsed_fit.py -f test_data.dat"
@@ -760,57 +983,21 @@ def main(argv=None, ssp_info=None):
         tauISMf = ism_igm.get_tauISMf()
 
     # Build Filter Matrix
-    filter_matrix = build_filter_matrix(args, wave)
+    filter_matrix = build_filter_matrix(args, wave,
+                                        filter_matrix=filter_matrix)
+
+    # Reduced precision model (the photometric difference is reported once)
+    ssp_info = (ages, wave, SSP, met, linewave, lineSSP)
+    if args.model_precision != 'float64':
+        if not args.already_parallel:
+            validate_model_precision(args, ssp_info, filter_matrix)
+        ssp_info, filter_matrix = set_model_precision(args, ssp_info,
+                                                      filter_matrix)
+        SSP = ssp_info[2]
 
     # Make one instance of Mcsed for speed on initialization
     # (relevant variables are reassigned for each galaxy)
-    mcsed_model = Mcsed(filter_matrix, SSP, linewave, lineSSP, ages, 
-                        met, wave, args.sfh,
-                        args.dust_law, args.dust_em, nwalkers=args.nwalkers,
-                        nsteps=args.nsteps,sigma_m=args.model_floor_error)
-
-    # Communicate emission line measurement preferences
-    mcsed_model.use_emline_flux = args.use_emline_flux
-    mcsed_model.emline_dict = args.emline_list_dict
-    mcsed_model.use_absorption_indx = args.use_absorption_indx
-    mcsed_model.absindx_dict = args.absorption_index_dict
-
-    # Adjust Rv in the dust attenuation model, if specified in config file
-    # (otherwise, use the default value for the requested dust law)
-    if args.Rv >= 0:
-        mcsed_model.dust_abs_class.Rv = args.Rv
-    else:
-        args.Rv = mcsed_model.dust_abs_class.Rv
-
-    # Adjust the relative attenuation between young/old populations in the dust model
-    # E(B-V)_diffuse = EBV_old_young * E(B-V)_birthcloud
-    mcsed_model.dust_abs_class.EBV_old_young = args.EBV_old_young
-
-    # Specify the age of the birth cloud (suffer different attenuation)
-    mcsed_model.t_birth = 10**(args.t_birth-9.) # Gyr
-
-    # Specify whether metallicity is fixed 
-    if args.metallicity:
-        mcsed_model.met_class.fix_met = True
-        Zsolar = 0.019
-        mcsed_model.met_class.met = np.log10(args.metallicity/Zsolar)
-    else:
-        mcsed_model.met_class.fix_met = False
-
-    # Specify whether dust emission is fixed
-    if (not args.fit_dust_em) | (args.test):
-        mcsed_model.dust_em_class.fixed = True
-    else:
-        mcsed_model.dust_em_class.fixed = False
-
-    # Specify whether energy balance is assumed
-    if args.assume_energy_balance:
-        if args.fit_dust_em:
-            mcsed_model.dust_em_class.assume_energy_balance = True
-        else:
-            mcsed_model.dust_em_class.assume_energy_balance = False
-    else:
-        mcsed_model.dust_em_class.assume_energy_balance = False
+    mcsed_model = build_mcsed_model(args, ssp_info, filter_matrix)
 
     # Build names for parameters and labels for table
     names = mcsed_model.get_param_names()
@@ -871,6 +1058,14 @@ def main(argv=None, ssp_info=None):
                 mcsed_model.remove_waverange_filters(args.wave_dust_em*1e4,1e10,
                                                      restframe=True)
 
+            # Merge SSP ages with indistinguishable photometry, if requested
+            if args.ssp_age_tolerance and (args.sfh != 'binned_lsfr'):
+                compress_model_ages(args, mcsed_model, ages, SSP, lineSSP)
+
+            # Basis spectra of the (new) SSP grid, if requested
+            if args.ssp_basis_tolerance and (mcsed_model.ssp_basis is None):
+                decompose_model_ssp(args, mcsed_model)
+
             mcsed_model.fit_model()
             mcsed_model.set_median_fit()
             if args.output_dict['sample plot']:
@@ -939,9 +1134,8 @@ def main(argv=None, ssp_info=None):
                 binned_ssp = bin_ssp_ages(ages, SSP, lineSSP, sfh_ages_Gyr,
                                           maxage_Gyr, mcsed_model.t_birth)
                 binned_ages, binned_spec, binned_linespec = binned_ssp
-                mcsed_model.ssp_ages = binned_ages
-                mcsed_model.ssp_spectra = binned_spec
-                mcsed_model.ssp_emline = binned_linespec
+                mcsed_model.set_ssp_grid(binned_ages, binned_spec,
+                                         binned_linespec)
 
             # Remove filters containing Lyman-alpha (and those blueward)
             mcsed_model.remove_waverange_filters(0., args.blue_wave_cutoff, restframe=True)
@@ -950,6 +1144,14 @@ def main(argv=None, ssp_info=None):
                 mcsed_model.remove_waverange_filters(args.wave_dust_em*1e4,1e10, 
                                                      restframe=True)
 
+            # Merge SSP ages with indistinguishable photometry, if requested
+            if args.ssp_age_tolerance and (args.sfh != 'binned_lsfr'):
+                compress_model_ages(args, mcsed_model, ages, SSP, lineSSP)
+
+            # Basis spectra of the (new) SSP grid, if requested
+            if args.ssp_basis_tolerance and (mcsed_model.ssp_basis is None):
+                decompose_model_ssp(args, mcsed_model)
+
             # Only relevant if there is a nonzero E(B-V) Milky Way value to be fit
             if ebvi>1.0e-12: 
                 tauISM_lam = ebvi*tauISMf(mcsed_model.wave)/1.086
@@ -11,13 +11,61 @@ from astropy.table import Table, vstack
 from multiprocessing import cpu_count, Manager, Process
 from distutils.dir_util import mkpath
 import run_mcsed_fit
+import ssp_cache
+from ssp import read_ssp_fsps
 run_mcsed_ind = run_mcsed_fit.main
 parse_args = run_mcsed_fit.parse_args
+build_filter_matrix = run_mcsed_fit.build_filter_matrix
+
+# names of the arrays shared with the workers (ssp_info order + filter matrix)
+SHARED_NAMES = ['ages', 'wave', 'spec', 'metallicities', 'linewave',
+                'linespec', 'filter_matrix']
+
+
+def share_ssp_info(args):
+    ''' Load the SSP grid and filter matrix once and publish them
+
+    The arrays are written to shared memory (see ssp_cache.publish_arrays)
+    so that every worker maps the same read-only pages instead of reading
+    and processing its own copy of the SSP grid.
+
+    Returns
+    -------
+    shared_dir : str
+        directory holding the shared arrays
+    '''
+    args.log.info('Reading in SSP model')
+    ssp_info = read_ssp_fsps(args)
+    filter_matrix = build_filter_matrix(args, ssp_info[1])
+    # share the arrays in the precision of the model
+    if args.model_precision != 'float64':
+        run_mcsed_fit.validate_model_precision(args, ssp_info, filter_matrix)
+        ssp_info, filter_matrix = run_mcsed_fit.set_model_precision(
+                                      args, ssp_info, filter_matrix)
+    arrays = dict(zip(SHARED_NAMES, list(ssp_info) + [filter_matrix]))
+    return ssp_cache.publish_arrays(arrays, prefix='mcsed_ssp_')
+
+
+def attach_ssp_info(shared_dir):
+    ''' Attach to the arrays published by share_ssp_info
+
+    Returns
+    -------
+    ssp_info : list
+        ages, wave, SSP, met, linewave, lineSSP (read-only memory maps)
+    filter_matrix : numpy array (2 dim)
+    '''
+    arrays = ssp_cache.attach_arrays(shared_dir, SHARED_NAMES)
+    return arrays[:-1], arrays[-1]
+
 
 def worker(f, i, chunk, ssp_info, out_q, err_q, kwargs):
     ''' Simple design to catch exceptions from the given call '''
     try:
-        result = f(argv=chunk, ssp_info=ssp_info)
+        if isinstance(ssp_info, str):
+            ssp_info, filter_matrix = attach_ssp_info(ssp_info)
+            kwargs = dict(kwargs, filter_matrix=filter_matrix)
+        result = f(argv=chunk, ssp_info=ssp_info, **kwargs)
     except Exception as e:
         err_q.put(e)
         return
@@ -43,13 +91,18 @@ def parallel_map(func, argv, args, ncpu, ssp_info, clean=True, **kwargs):
         Built arguments from argv
     ncpu : int
         Number of parallelized cpus
-    ssp_info : list
-        SSP data for spectra, ages, metallicities, etc.
+    ssp_info : list, str or None
+        SSP data for spectra, ages, metallicities, etc., or the directory
+        of the arrays published by share_ssp_info
     clean : bool
         Remove temporary files
     '''
     if isinstance(ncpu, (int, np.integer)) and ncpu == 1:
-        return [func(0, argv, **kwargs)]
+        if isinstance(ssp_info, str):
+            ssp_info, filter_matrix = attach_ssp_info(ssp_info)
+            kwargs = dict(kwargs, filter_matrix=filter_matrix)
+        return [func(argv=argv + ['--already_parallel'], ssp_info=ssp_info,
+                     **kwargs)]
 
     manager = Manager()
     out_q = manager.Queue()
@@ -120,12 +173,16 @@ def main_parallel(argv=None):
         argv = argv + ['--parallel'] 
 
     args = parse_args(argv=argv)
-    ssp_info = None
 
     NCPU = cpu_count()
     ncpu = np.max([1, NCPU - args.reserved_cores])
 
-    results = parallel_map(run_mcsed_ind, argv, args, ncpu, ssp_info)
+    # Load the SSP grid once; the workers attach to it in shared memory
+    ssp_info = share_ssp_info(args)
+    try:
+        results = parallel_map(run_mcsed_ind, argv, args, ncpu, ssp_info)
+    finally:
+        ssp_cache.release_arrays(ssp_info)
     table = vstack([result[0] for result in results])
     if args.output_dict['parameters']:
         table.write('output/%s' % args.output_filename,
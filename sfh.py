@@ -14,7 +14,37 @@
 """
 
 import numpy as np
+from scipy.special import erf
 from cosmology import Cosmology
+from dust_abs import uniform_prior_batch
+
+
+def average_quadrature(t_lo, t_hi, num=251):
+    ''' Lookback times and weights of the composite Simpson's rule for
+    averaging a function over the time interval [t_lo, t_hi]
+
+    Parameters
+    ----------
+    t_lo : float
+        start of the time interval in lookback time (Gyr)
+    t_hi : float
+        end of the time interval in lookback time (Gyr)
+    num : int
+        number of (evenly spaced) times, odd
+
+    Returns
+    -------
+    t : numpy array (1 dim)
+        lookback times in Gyr
+    weights : numpy array (1 dim)
+        weights of each time (they sum to one)
+    '''
+    t = np.linspace(t_lo, t_hi, num=num)
+    weights = np.ones(num)
+    weights[1:-1:2] = 4.
+    weights[2:-1:2] = 2.
+    weights /= weights.sum()
+    return t, weights
 
 
 class constant:
@@ -78,6 +108,10 @@ class constant:
         age_flag = (self.age > self.age_lims[0])*(self.age < self.age_lims[1])
         return logsfr_flag * age_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -92,10 +126,16 @@ class constant:
         self.logsfr = input_list[start_value]
         self.age = input_list[start_value+1]
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = np.logspace(self.age_lims[0], self.age)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.plot(t, sfr, color=color, alpha=alpha)
 
     def evaluate(self, t, force_params=False):
@@ -123,6 +163,68 @@ class constant:
         msfr = 10**self.logsfr * np.ones(t.shape)
         return msfr
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged constant SFH
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        return 10**self.logsfr
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        logsfr = params[:, 0:1]
+        msfr = 10**logsfr * np.ones(t.shape)
+        return msfr
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return params[:, 1]
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        return 10**params[:, 0]
+
 class burst:
     ''' The burst star formation history '''
     def __init__(self, logsfr=1.0, age=-.5, burst_age=7.2, burst_sigma=0.4,
@@ -227,6 +329,10 @@ class burst:
             flag *= (temp > templims[0]) * (temp < templims[1])
         return flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -244,10 +350,16 @@ class burst:
         # self.burst_sigma = input_list[start_value+3]
         self.burst_strength = input_list[start_value+3]
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = np.logspace(self.age_lims[0], self.age)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.plot(t, sfr, color=color, alpha=alpha)
 
     def evaluate(self, t, force_params=False):
@@ -281,6 +393,106 @@ class burst:
         msfr = 10**logsfr * np.ones(t.shape)
         return msfr + gauss
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged burst SFH
+
+        The burst is a Gaussian in log time, so its integral over time is
+        a difference of error functions.
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        logsfr, age, burst_age, burst_strength = self.get_params()
+        burst_sigma = self.burst_sigma
+
+        nage = burst_age - 9.
+        norm = (burst_strength * 10**logsfr /
+                np.sqrt(2. * np.pi * burst_sigma))
+        # substituting t = 10**u, the integrand is a Gaussian in u
+        # with its center shifted by burst_sigma**2 * ln(10)
+        ln10 = np.log(10.)
+        center = nage + burst_sigma**2 * ln10
+        z = ((np.log10([t_lo, t_hi]) - center) /
+             (np.sqrt(2.) * burst_sigma))
+        integral = (norm * ln10 * burst_sigma * np.sqrt(np.pi / 2.) *
+                    np.exp(ln10 * nage + 0.5 * (burst_sigma * ln10)**2) *
+                    (erf(z[1]) - erf(z[0])))
+        return 10**logsfr + integral / (t_hi - t_lo)
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        logsfr, age, burst_age, burst_strength = [p[:, np.newaxis]
+                                                  for p in params.T]
+        burst_sigma = self.burst_sigma
+
+        nage = burst_age - 9.
+        norm = (burst_strength * 10**logsfr /
+                np.sqrt(2. * np.pi * burst_sigma))
+        gauss = norm * np.exp(-0.5 * (np.log10(t) - nage)**2 / burst_sigma**2)
+        msfr = 10**logsfr * np.ones(t.shape)
+        return msfr + gauss
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return params[:, 1]
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        logsfr, age, burst_age, burst_strength = params.T
+        burst_sigma = self.burst_sigma
+
+        nage = burst_age - 9.
+        norm = (burst_strength * 10**logsfr /
+                np.sqrt(2. * np.pi * burst_sigma))
+        ln10 = np.log(10.)
+        center = nage + burst_sigma**2 * ln10
+        z_lo, z_hi = [(np.log10(t) - center) / (np.sqrt(2.) * burst_sigma)
+                      for t in (t_lo, t_hi)]
+        integral = (norm * ln10 * burst_sigma * np.sqrt(np.pi / 2.) *
+                    np.exp(ln10 * nage + 0.5 * (burst_sigma * ln10)**2) *
+                    (erf(z_hi) - erf(z_lo)))
+        return 10**logsfr + integral / (t_hi - t_lo)
+
 class polynomial:
     ''' The polynomial star formation history '''
     def __init__(self, age_locs=[6.5, 7.5, 8.5], age=-.5,
@@ -314,6 +526,8 @@ class polynomial:
         self.age = age
         self.age_lims = age_lims
         self.age_delta = age_delta
+        # quadrature of each averaging interval (see average_sfr)
+        self.quadrature = {}
 
     def set_agelim(self, redshift):
         ''' Set the Age limit based on age of the universe '''
@@ -369,6 +583,10 @@ class polynomial:
         #age_flag = (self.age > self.age_lims[0])*(self.age < self.age_lims[1])
         return flag #* age_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -384,10 +602,16 @@ class polynomial:
             setattr(self, 'p_' + str(i), input_list[start_value + i - 1])
         #self.age = input_list[int(self.nums[-1]) + start_value]
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = np.logspace(self.age_lims[0], self.age)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.plot(t, sfr, color=color, alpha=alpha)
 
     def evaluate(self, t, force_params=False):
@@ -418,6 +642,78 @@ class polynomial:
         msfr = 10**(np.polyval(sol, np.log10(t) - self.middle_age + 9.))
         return msfr
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged polynomial SFH
+
+        There is no closed form, so the SFH is averaged with Simpson's
+        rule on times cached for each interval (see average_quadrature).
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        if (t_lo, t_hi) not in self.quadrature:
+            self.quadrature[(t_lo, t_hi)] = average_quadrature(t_lo, t_hi)
+        t, weights = self.quadrature[(t_lo, t_hi)]
+        return np.dot(weights, self.evaluate(t))
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        sol = np.linalg.lstsq(self.matrix, params.T)[0]
+        x = np.log10(t) - self.middle_age + 9.
+        msfr = 10**(np.polyval(sol, x[:, np.newaxis]).T)
+        return msfr
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return np.full(len(params), float(self.age))
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        if (t_lo, t_hi) not in self.quadrature:
+            self.quadrature[(t_lo, t_hi)] = average_quadrature(t_lo, t_hi)
+        t, weights = self.quadrature[(t_lo, t_hi)]
+        return np.dot(self.evaluate_batch(t, params), weights)
+
 class exponential:
     ''' The exponential star formation history '''
     def __init__(self, logsfr=1.0, age=-1.0, tau=-1.5, logsfr_lims=[-3., 3.],
@@ -498,6 +794,26 @@ class exponential:
         tau_flag = (self.tau > self.tau_lims[0])*(self.tau < self.age)
         return logsfr_flag * age_flag * tau_flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors
+
+        Parameters
+        ----------
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        flag : numpy array (1 dim)
+            True for the models within the boundaries
+        '''
+        lims = np.array(self.get_param_lims(), dtype=float)
+        flag = (params > lims[:, 0]) & (params < lims[:, 1])
+        # tau is bounded above by the age
+        flag[:, 2] = (params[:, 2] > self.tau_lims[0]) & (params[:, 2] <
+                                                           params[:, 1])
+        return np.all(flag, axis=1)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -513,10 +829,16 @@ class exponential:
         self.age = input_list[start_value+1]
         self.tau = input_list[start_value+2]
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = np.logspace(self.age_lims[0], self.age)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.plot(t, sfr, color=color, alpha=alpha)
 
     def evaluate(self, t, force_params=False):
@@ -550,6 +872,97 @@ class exponential:
         msfr = 10**logsfr * np.exp(-1. * var / 10**tau)
         return msfr
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged exponential SFH
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        logsfr, age, tau = self.get_params()
+        t1 = 10**tau
+        if self.sign > 0.0:
+            integral = (t1 * np.exp(-t_lo / t1) *
+                        -np.expm1(-(t_hi - t_lo) / t1))
+        else:
+            # exponential rise until the age, constant before
+            t_age = 10**age
+            t_mid = min(max(t_age, t_lo), t_hi)
+            integral = (t1 * np.exp((t_mid - t_age) / t1) *
+                        -np.expm1(-(t_mid - t_lo) / t1) +
+                        (t_hi - t_mid))
+        return 10**logsfr * integral / (t_hi - t_lo)
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        logsfr, age, tau = [p[:, np.newaxis] for p in params.T]
+
+        if self.sign > 0.0:
+            var = t
+        else:
+            var = np.maximum(10**age - t, 0.)
+        msfr = 10**logsfr * np.exp(-1. * var / 10**tau)
+        return msfr
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return params[:, 1]
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        logsfr, age, tau = params.T
+        t1 = 10**tau
+        if self.sign > 0.0:
+            integral = (t1 * np.exp(-t_lo / t1) *
+                        -np.expm1(-(t_hi - t_lo) / t1))
+        else:
+            # exponential rise until the age, constant before
+            t_age = 10**age
+            t_mid = np.clip(t_age, t_lo, t_hi)
+            integral = (t1 * np.exp((t_mid - t_age) / t1) *
+                        -np.expm1(-(t_mid - t_lo) / t1) +
+                        (t_hi - t_mid))
+        return 10**logsfr * integral / (t_hi - t_lo)
+
 
 class double_powerlaw:
     ''' The double powerlaw function provides a good description for the
@@ -604,6 +1017,8 @@ class double_powerlaw:
         self.c_delta = c_delta
         self.age_delta = age_delta
         self.age_lims = age_lims
+        # quadrature of each averaging interval (see average_sfr)
+        self.quadrature = {}
 
     def set_agelim(self, redshift):
         ''' Set the Age limit based on age of the universe '''
@@ -643,6 +1058,10 @@ class double_powerlaw:
         return tau_flag * a_flag * b_flag * c_flag * age_flag
 
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
 
@@ -660,10 +1079,16 @@ class double_powerlaw:
         self.c = input_list[start_value+3]
         self.age = input_list[start_value+4]
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = np.logspace(self.age_lims[0], self.age)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.plot(t, sfr, color=color, alpha=alpha)
 
     def evaluate(self, t, force_params=False):
@@ -694,6 +1119,80 @@ class double_powerlaw:
                                 (t / t1)**(-c))**(-1))
         return msfr
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged double power law SFH
+
+        There is no closed form, so the SFH is averaged with Simpson's
+        rule on times cached for each interval (see average_quadrature).
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        if (t_lo, t_hi) not in self.quadrature:
+            self.quadrature[(t_lo, t_hi)] = average_quadrature(t_lo, t_hi)
+        t, weights = self.quadrature[(t_lo, t_hi)]
+        return np.dot(weights, self.evaluate(t))
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        tau, a, b, c, age = [p[:, np.newaxis] for p in params.T]
+
+        t1 = 10**tau
+        msfr = (10**(a) * ((t / t1)**b +
+                                (t / t1)**(-c))**(-1))
+        return msfr
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return params[:, 4]
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        if (t_lo, t_hi) not in self.quadrature:
+            self.quadrature[(t_lo, t_hi)] = average_quadrature(t_lo, t_hi)
+        t, weights = self.quadrature[(t_lo, t_hi)]
+        return np.dot(self.evaluate_batch(t, params), weights)
+
 class binned_lsfr:
     ''' 
     The binned_lsfr SFH includes 6 bins of SFR at discrete time intervals
@@ -783,6 +1282,10 @@ class binned_lsfr:
             flag *= ((val > lims[0]) * (val < lims[1]))
         return flag
 
+    def prior_batch(self, params):
+        ''' Uniform prior (see prior) of a set of parameter vectors '''
+        return uniform_prior_batch(self.get_param_lims(), params)
+
     def set_parameters_from_list(self, input_list, start_value):
         ''' Set parameters from a list and a start_value
         Parameters
@@ -796,10 +1299,16 @@ class binned_lsfr:
         for num in self.nums:
             setattr(self, 'sfr_' + str(num), input_list[start_value + num - 1])
 
-    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2):
-        ''' Plot SFH for given set of parameters '''
+    def get_plot_curve(self):
+        ''' Lookback times (Gyr) and SFR of the SFH for plotting '''
         t = 10**(np.array([6] + self.ages) - 9.)
-        sfr = self.evaluate(t)
+        return t, self.evaluate(t)
+
+    def plot(self, ax, color=[238/255., 90/255., 18/255.], alpha=0.2,
+             curve=None):
+        ''' Plot SFH for given set of parameters (or a precomputed curve,
+        see get_plot_curve) '''
+        t, sfr = self.get_plot_curve() if curve is None else curve
         ax.step(t, sfr, where='pre', color=color, alpha=alpha)
 
 
@@ -844,5 +1353,88 @@ class binned_lsfr:
         sfr[ sel_too_old ] = 1e-99
         return sfr
 
+    def average_sfr(self, t_lo, t_hi):
+        ''' Time-averaged binned_lsfr SFH (exact sum over the overlap
+        of each time bin with the interval)
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+
+        Returns
+        -------
+        sfr : float
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        sfr_bin = 10. ** np.array(self.get_params())
+        # (lookback) time bins in Gyr
+        edges = np.hstack([0., 10.**(np.array(self.ages) - 9.)])
+        overlap = (np.clip(edges[1:], t_lo, t_hi) -
+                   np.clip(edges[:-1], t_lo, t_hi))
+        return np.dot(sfr_bin, overlap) / (t_hi - t_lo)
+
+    def evaluate_batch(self, t, params):
+        ''' Evaluate the SFH (see evaluate) for a set of parameter vectors
+
+        Parameters
+        ----------
+        t : numpy array (1 dim)
+            lookback time in Gyr (time = 0 is observation of galaxy)
+        params : numpy array (2 dim)
+            parameters of each model (same order as in get_params() method),
+            dimensions: (models, parameters)
+
+        Returns
+        -------
+        msfr : numpy array (2 dim)
+            Star formation rate at given time in time array,
+            dimensions: (models, times)
+        '''
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        # linear SFR in each SFH time bin
+        sfr_bin = 10. ** params
+        # Ensure that self.ages, t are both in units of log years
+        t_logyr = np.log10( t * 1e9 )
+
+        bin_indx = np.searchsorted(self.ages, t_logyr, side="left")
+        # adjust any times falling beyond the last SFH age bin
+        sel_too_old = bin_indx > sfr_bin.shape[1]-1
+        bin_indx[ sel_too_old ] = sfr_bin.shape[1]-1
+        sfr = sfr_bin[:, bin_indx]
+        sfr[:, sel_too_old] = 1e-99
+        return sfr
+
+    def get_age_batch(self, params):
+        ''' Age of the galaxy (log Gyr) of a set of parameter vectors '''
+        return np.full(len(params), float(self.age))
+
+    def average_sfr_batch(self, t_lo, t_hi, params):
+        ''' Time-averaged SFH (see average_sfr) of a set of parameter
+        vectors
+
+        Parameters
+        ----------
+        t_lo : float
+            start of the time interval in lookback time (Gyr)
+        t_hi : float
+            end of the time interval in lookback time (Gyr)
+        params : numpy array (2 dim)
+            parameters of each model, dimensions: (models, parameters)
+
+        Returns
+        -------
+        sfr : numpy array (1 dim)
+            Star formation rate averaged between t_lo and t_hi
+        '''
+        sfr_bin = 10. ** params
+        # (lookback) time bins in Gyr
+        edges = np.hstack([0., 10.**(np.array(self.ages) - 9.)])
+        overlap = (np.clip(edges[1:], t_lo, t_hi) -
+                   np.clip(edges[:-1], t_lo, t_hi))
+        return np.dot(sfr_bin, overlap) / (t_hi - t_lo)
+
 
 
@@ -13,7 +13,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os.path as op
 import scipy.interpolate as scint
-from astropy.convolution import Gaussian1DKernel, convolve
+import scipy.sparse as sparse
+import ssp_cache
+from metallicity import stellar_metallicity
+from astropy.convolution import Gaussian1DKernel
 
 plt.ioff() 
 
@@ -89,54 +92,277 @@ def bin_ssp_ages(ssp_ages, ssp_spec, ssp_linespec, sfh_ages, galaxy_age, t_birth
     nwave_linessp = ssp_linespec.shape[0]
     nmet          = ssp_spec.shape[2]
 
-    binned_spec     = np.zeros((nwave_ssp,     len(binned_ages), nmet))
-    binned_linespec = np.zeros((nwave_linessp, len(binned_ages), nmet))
+    # the binned grids keep the precision of the input grids
+    binned_spec     = np.zeros((nwave_ssp,     len(binned_ages), nmet),
+                               dtype=ssp_spec.dtype)
+    binned_linespec = np.zeros((nwave_linessp, len(binned_ages), nmet),
+                               dtype=ssp_linespec.dtype)
 
     for i in np.arange(len(binned_ages)):
         sel = np.where( (ssp_ages > agebin[i]) * (ssp_ages <= agebin[i+1]) )[0]
         wht = np.diff(np.hstack([0., 1e9 * ssp_ages[sel]]))
         wht[0] = np.diff( 1e9 * np.array([agebin[i], ssp_ages[sel][0]]) )
+        swht = (wht / wht.sum()).astype(ssp_spec.dtype)
         for imet in np.arange(nmet):
-            binned_spec[:,i,imet] = np.dot(ssp_spec[:,sel,imet],wht) / wht.sum()
+            binned_spec[:,i,imet] = np.dot(ssp_spec[:,sel,imet],swht)
             binned_linespec[:,i,imet] = np.dot(ssp_linespec[:,sel,imet],wht) / wht.sum()
 
     return binned_ages, binned_spec, binned_linespec
 
 
-def get_coarser_wavelength_fsps(wave, spec, redwave=1e5):
+def get_ssp_photometry(wave, spec, filter_matrix, redshift):
     '''
-    smooth the spectrum with a gaussian kernel to improve 
-    computational efficiency
+    Observed-frame filter flux densities of each SSP template
 
-    only affects the wavelength grid
-    (the age and metallicity grids remain unchanged)
+    Parameters
+    ----------
+    wave : numpy array (1d)
+        SSP wavelength grid
+    spec : numpy array (3d)
+        SSP spectra, dimensions: (wavelengths, ages, metallicities)
+    filter_matrix : numpy array (2d)
+        filter matrix (rows of wavelength, columns for each filter)
+    redshift : float
+        redshift of the source
+
+    Returns
+    -------
+    phot : numpy array (3d)
+        flux densities (at 10 pc), dimensions: (ages, metallicities, filters)
+    '''
+    redshifted = make_interpolation_operator(wave, wave * (1. + redshift))
+    nspec = redshifted.dot(spec.reshape(spec.shape[0], -1)) * (1. + redshift)
+    phot = np.dot(filter_matrix.T, nspec)
+    return np.moveaxis(phot.reshape((filter_matrix.shape[1],) +
+                                    spec.shape[1:]), 0, 2)
+
+
+def get_merge_error(phot, dt):
+    '''
+    Maximum fractional photometric difference between each SSP template and
+    the time-weighted average of the templates
+
+    Parameters
+    ----------
+    phot : numpy array (3d)
+        flux densities of the templates, (ages, metallicities, filters)
+    dt : numpy array (1d)
+        time spanned by each SSP age
+
+    Returns
+    -------
+    error : float
+    '''
+    merged = np.tensordot(dt / dt.sum(), phot, axes=(0, 0))
+    diff = np.abs(phot - merged)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = np.where(diff > 0., diff / np.abs(merged), 0.)
+    return np.max(error)
+
+
+def compress_ssp_ages(ssp_ages, ssp_spec, ssp_linespec, phot, t_birth,
+                      tolerance):
+    '''
+    Merge adjacent SSP ages wherever the merged template reproduces the
+    filter flux densities of each of its members within a tolerance
+
+    The templates are combined with the same time weighting as
+    bin_ssp_ages().  The star formation history is still evaluated on the
+    full age grid, and the weights of the members of each merged template
+    are summed (see Mcsed.set_ssp_grid), so the stellar mass is unchanged
+    and the photometry of any model is reproduced within the tolerance.
+    Ages are not merged across the age of the birth cloud, and the youngest
+    age is kept so that the youngest model ages remain resolved.
+
+    Parameters
+    ----------
+    ssp_ages : 1d array
+        SSP age grid in Gyr
+    ssp_spec : 3d array
+        SSP spectra, dimensions: (wavelengths, ages, metallicities)
+    ssp_linespec : 3d array
+        SSP emission line fluxes, dimensions: (lines, ages, metallicities)
+    phot : 3d array
+        flux densities of the templates, (ages, metallicities, filters),
+        see get_ssp_photometry()
+    t_birth : float
+        age of the birth cloud in Gyr
+    tolerance : float
+        maximum fractional difference in any filter between a template
+        and the merged template that replaces it
+
+    Returns
+    -------
+    members : 2d array
+        1 where an age of ssp_ages belongs to a merged template, else 0,
+        dimensions: (ages, merged templates)
+    merged_spec : 3d array
+        new ssp_spec
+    merged_linespec : 3d array
+        new ssp_linespec
+    max_error : float
+        maximum fractional photometric difference introduced
+    '''
+    dt = np.diff(np.hstack([0., ssp_ages]))
+    groups = [[0]]
+    max_error = 0.
+    young = np.arange(1, len(ssp_ages))
+    for seg in [young[ssp_ages[1:] <= t_birth], young[ssp_ages[1:] > t_birth]]:
+        start = 0
+        while start < len(seg):
+            stop = start + 1
+            error = 0.
+            while stop < len(seg):
+                members = seg[start:stop+1]
+                new_error = get_merge_error(phot[members], dt[members])
+                if new_error > tolerance:
+                    break
+                error = new_error
+                stop += 1
+            groups.append(list(seg[start:stop]))
+            max_error = max(max_error, error)
+            start = stop
+
+    # merge matrix: time weights of the members of each merged age
+    merge = np.zeros((len(ssp_ages), len(groups)))
+    members = np.zeros((len(ssp_ages), len(groups)))
+    for i, group in enumerate(groups):
+        merge[group, i] = dt[group] / dt[group].sum()
+        members[group, i] = 1.
+    merged_spec = np.moveaxis(np.tensordot(ssp_spec,
+                                           merge.astype(ssp_spec.dtype),
+                                           axes=(1, 0)), 2, 1)
+    merged_linespec = np.moveaxis(np.tensordot(ssp_linespec,
+                                               merge.astype(ssp_linespec.dtype),
+                                               axes=(1, 0)), 2, 1)
+    return members, merged_spec, merged_linespec, max_error
+
+
+def decompose_ssp_basis(ssp_spec, tolerance):
+    '''
+    Truncated singular value decomposition of the SSP grid
+
+    Each template is approximated as a linear combination of a small number
+    of basis spectra, ssp_spec[:, i, j] ~ dot(basis, coeffs[:, i, j]).  The
+    rank is the smallest one for which every template is reproduced within
+    a fractional (L2 norm) tolerance.
+
+    Parameters
+    ----------
+    ssp_spec : 3d array
+        SSP spectra, dimensions: (wavelengths, ages, metallicities)
+    tolerance : float
+        maximum fractional L2 residual of any template
+
+    Returns
+    -------
+    basis : 2d array
+        basis spectra, dimensions: (wavelengths, rank)
+    coeffs : 3d array
+        coefficients of the templates, dimensions: (rank, ages, metallicities)
+    max_error : float
+        maximum fractional L2 residual of the truncated decomposition
+    '''
+    nwave = ssp_spec.shape[0]
+    X = np.asarray(ssp_spec, dtype=float).reshape(nwave, -1)
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+
+    # residual of every template as a function of the rank
+    power = (s[:, np.newaxis] * Vt)**2
+    norm2 = power.sum(axis=0)
+    norm2[norm2 <= 0.] = 1.
+    resid = np.sqrt(np.clip(norm2 - np.cumsum(power, axis=0), 0., None)
+                    / norm2).max(axis=1)
+    good = np.nonzero(resid <= tolerance)[0]
+    rank = good[0] + 1 if len(good) else len(s)
+
+    basis = U[:, :rank].astype(ssp_spec.dtype)
+    coeffs = (s[:rank, np.newaxis] * Vt[:rank]).reshape(
+                                     (rank,) + ssp_spec.shape[1:])
+    return basis, coeffs.astype(ssp_spec.dtype), resid[rank-1]
+
+
+def make_coarser_wavelength_operator(wave, redwave=1e5, stddev=25,
+                                     ndw=12.):
+    '''
+    Build the linear operator that smooths the finely sampled part of the
+    SSP wavelength grid with a gaussian kernel and rebins it to a coarser
+    grid (see get_coarser_wavelength_fsps)
+
+    The smoothing reproduces astropy.convolution.convolve (normalized
+    kernel, zero-filled boundaries) and the rebinning averages the smoothed
+    spectrum within each bin.  Wavelengths outside the finely sampled part
+    are passed through unchanged.
 
     Parameters
     ----------
     wave : numpy array (1d)
         initial wavelength grid
-    spec : numpy array
-        initial SSP grid over (wave, age, metallicity)
     redwave : float
         red wavelength cutoff (in Angstroms)
+    stddev : float
+        standard deviation of the gaussian kernel (in pixels)
+    ndw : float
+        width of the coarser wavelength bins (in Angstroms)
+
+    Returns
+    -------
+    nwave : numpy array (1d)
+        coarser wavelength grid
+    operator : scipy.sparse matrix (len(nwave), len(wave))
+        operator.dot(spec) gives the coarser spectra
     '''
+    nwave_in = len(wave)
     sel = np.where((wave > 500) * (wave < redwave))[0]
-    spec = spec[sel, :]
     wave = wave[sel]
-    G = Gaussian1DKernel(25)
     nsel = np.where(np.abs(np.diff(wave)-0.9) < 0.5)[0]
-    for i in np.arange(spec.shape[1]):
-        spec[nsel, i] = convolve(spec[nsel, i], G)
-    ndw = 12.
+    G = Gaussian1DKernel(stddev).array
+    G = G / G.sum()
+    mid = len(G) // 2
+    smooth = sparse.diags(list(G), np.arange(-mid, mid + 1),
+                          shape=(len(nsel), len(nsel)), format='csr')
     nw = np.arange(wave[nsel[0]], wave[nsel[-1]+1], ndw)
     nwb = np.hstack([nw, wave[nsel[-1]+1]])
+    # bin of each finely sampled wavelength (np.histogram convention)
+    ibin = np.searchsorted(nwb, wave[nsel], side='right') - 1
+    ibin[wave[nsel] == nwb[-1]] = len(nw) - 1
+    inside = (ibin >= 0) & (ibin < len(nw))
+    counts = np.bincount(ibin[inside], minlength=len(nw))
+    rebin = sparse.csr_matrix((1. / counts[ibin[inside]],
+                               (ibin[inside], np.where(inside)[0])),
+                              shape=(len(nw), len(nsel)))
+    nlo = nsel[0]
+    nhi = len(wave) - (nsel[-1] + 1)
+    operator = sparse.block_diag([sparse.identity(nlo), rebin.dot(smooth),
+                                  sparse.identity(nhi)], format='csr')
+    # map the columns of the selected wavelength range to the input grid
+    operator = sparse.csr_matrix((operator.data, sel[operator.indices],
+                                  operator.indptr),
+                                 shape=(operator.shape[0], nwave_in))
     nwave = np.hstack([wave[:nsel[0]], nw, wave[(nsel[-1]+1):]])
-    nspec = np.zeros((len(nwave), spec.shape[1]))
-    for i, sp in enumerate(spec.swapaxes(0, 1)):
-        hsp = (np.histogram(wave[nsel], nwb, weights=sp[nsel])[0] /
-               np.histogram(wave[nsel], nwb)[0])
-        nspec[:, i] = np.hstack([sp[:nsel[0]], hsp, sp[(nsel[-1]+1):]])
-    return nwave, nspec
+    return nwave, operator
+
+
+def get_coarser_wavelength_fsps(wave, spec, redwave=1e5):
+    '''
+    smooth the spectrum with a gaussian kernel to improve 
+    computational efficiency
+
+    only affects the wavelength grid
+    (the age and metallicity grids remain unchanged)
+
+    Parameters
+    ----------
+    wave : numpy array (1d)
+        initial wavelength grid
+    spec : numpy array
+        initial SSP grid over (wave, age[, metallicity])
+    redwave : float
+        red wavelength cutoff (in Angstroms)
+    '''
+    nwave, operator = make_coarser_wavelength_operator(wave, redwave=redwave)
+    nspec = operator.dot(spec.reshape(len(wave), -1))
+    return nwave, nspec.reshape((len(nwave),) + spec.shape[1:])
 
 
 def read_fsps_neb(filename):
@@ -174,19 +400,18 @@ def read_fsps_neb(filename):
     return Z, Age, logU, spec, wave
 
 
-def read_fsps_file(args, metallicity):
-    '''Read in the stellar population models from fsps for a given isochrone
-    and metallicity.
+def parse_fsps_file(filename):
+    '''Parse an fsps SSP file (ASCII) for a given isochrone and metallicity
 
     Parameters
     ----------
-    args : class
-        The args class from mcsed.parse_args()
+    filename : str
+        fsps SSP file, e.g., SSP/fsps_padova_0.0190.spec
 
     Returns
     -------
     ages : numpy array (1 dim)
-        ages of each SPS (Gyr)
+        ages of each SPS (log years), including non-physical ages
     wave : numpy array (1 dim)
         wavelength grid for each spectrum in units of Angstroms
     spec : numpy array (2 dim)
@@ -194,18 +419,6 @@ def read_fsps_file(args, metallicity):
     '''
     pc10 = 10. * 3.08567758e18
     solar_microjansky = 3.826e33 * 1e29 / (4. * np.pi * pc10**2)
-    filename = op.join('SSP', 'fsps_%s_%0.4f.spec' % (args.isochrone,
-                                                           metallicity))
-    if not op.exists(filename):
-        print('Tried to open %s' % filename)
-        print('Metallicity entered, %0.4f, does not match any of the %s '
-              'isochrones of the %s models' % (args.metallicity,
-                                               args.isochrone, args.ssp))
-        print('Metallicity options [')
-        for met in args.metallicity_dict[args.ssp][args.isochrone]:
-            print('%0.4f ' % met)
-        print(']')
-        sys.exit(1)
 
     # Interpret the file
     cnt = 0
@@ -225,6 +438,91 @@ def read_fsps_file(args, metallicity):
     # convert from solar bolometric luminosity per Hz to micro-Jy at 10 pc
     spec = np.array(spec).swapaxes(0, 1) * solar_microjansky
     ages = np.array(ages)
+    return ages, wave, spec
+
+
+def load_fsps_file(filename, cache_dir=None):
+    '''Load an fsps SSP file, using the binary cache when possible
+
+    The parsed arrays are stored as memory-mappable .npy files in
+    cache_dir/parsed/<file name>/ together with a manifest recording the size,
+    modification time and SHA-1 digest of the ASCII source file.  The full
+    age grid is cached, so the same entry serves every max_ssp_age.
+
+    Parameters
+    ----------
+    filename : str
+        fsps SSP file, e.g., SSP/fsps_padova_0.0190.spec
+    cache_dir : str or None
+        directory of the binary cache; if None, always parse the ASCII file
+
+    Returns
+    -------
+    ages, wave, spec : see parse_fsps_file()
+    '''
+    if cache_dir is None:
+        return parse_fsps_file(filename)
+
+    names = ['ages', 'wave', 'spec']
+    entry_dir = op.join(cache_dir, 'parsed', op.basename(filename))
+    manifest = ssp_cache.read_manifest(entry_dir)
+    if (manifest is not None) and ssp_cache.signature_matches(manifest,
+                                                               filename):
+        arrays = ssp_cache.load_entry(entry_dir, names)
+        if arrays is not None:
+            source = ssp_cache.get_file_signature(filename, with_hash=False)
+            if source['mtime'] != manifest['source']['mtime']:
+                # contents unchanged (verified by hash): avoid rehashing
+                manifest['source']['mtime'] = source['mtime']
+                try:
+                    ssp_cache.write_manifest(entry_dir, manifest)
+                except (IOError, OSError):
+                    pass
+            return tuple(arrays)
+
+    ages, wave, spec = parse_fsps_file(filename)
+    manifest = {'source': ssp_cache.get_file_signature(filename),
+                'filename': op.basename(filename)}
+    ssp_cache.save_entry(entry_dir, dict(zip(names, [ages, wave, spec])),
+                         manifest)
+    return ages, wave, spec
+
+
+def read_fsps_file(args, metallicity):
+    '''Read in the stellar population models from fsps for a given isochrone
+    and metallicity.
+
+    Parameters
+    ----------
+    args : class
+        The args class from mcsed.parse_args()
+
+    Returns
+    -------
+    ages : numpy array (1 dim)
+        ages of each SPS (Gyr)
+    wave : numpy array (1 dim)
+        wavelength grid for each spectrum in units of Angstroms
+    spec : numpy array (2 dim)
+        Spectra in f_nu (micro Janskies, i.e., 1e-29 ergs/s/cm^2/Hz) at 10pc
+    '''
+    filename = op.join('SSP', 'fsps_%s_%0.4f.spec' % (args.isochrone,
+                                                           metallicity))
+    if not op.exists(filename):
+        print('Tried to open %s' % filename)
+        print('Metallicity entered, %0.4f, does not match any of the %s '
+              'isochrones of the %s models' % (args.metallicity,
+                                               args.isochrone, args.ssp))
+        print('Metallicity options [')
+        for met in args.metallicity_dict[args.ssp][args.isochrone]:
+            print('%0.4f ' % met)
+        print(']')
+        sys.exit(1)
+
+    ages, wave, spec = load_fsps_file(filename,
+                                      getattr(args, 'ssp_cache_dir', None))
+    wave = np.array(wave)
+
     # exclude non-physical ages
     sel = (ages >= 6.) & (ages <= args.max_ssp_age[1]) 
     # add one additional point (if max age falls between grid points)
@@ -234,9 +532,112 @@ def read_fsps_file(args, metallicity):
 
     return 10**(ages[sel]-9), wave, spec[:, sel]
 
+class NebularEmission:
+    ''' Nebular (line and continuum) emission engine
+
+    The nebular grids are parsed once and a single interpolator (one Delaunay
+    triangulation) over the stacked continuum and line values is built, so
+    that the engine can be reused for every metallicity of the SSP grid.
+    '''
+    def __init__(self, wave, filename='nebular/ZAU_ND_pdva',
+                 sollum=3.826e33):
+        ''' Initialize this class
+
+        Parameters
+        ----------
+        wave : numpy array (1 dim)
+            wavelength for SSP models
+        filename : str
+            nebular grid files (filename + '.cont' and filename + '.lines')
+        sollum : float
+            solar luminosity in ergs / s
+        '''
+        cont_res = [np.array(x) for x in read_fsps_neb(filename + '.cont')]
+        lines_res = [np.array(x) for x in read_fsps_neb(filename + '.lines')]
+        # Make array of Z, age, U
+        V = np.array([10**cont_res[0]*0.019, cont_res[1]/1e6,
+                      cont_res[2]]).swapaxes(0, 1)
+        self.wave = wave
+        self.sollum = sollum
+        self.contwave = cont_res[4]
+        self.linewave = lines_res[4]
+        self.ncont = cont_res[3].shape[1]
+        self.interp = scint.LinearNDInterpolator(
+                          V, np.hstack([cont_res[3]*1e48, lines_res[3]*1e48]))
+        self.garray = make_gaussian_emission(wave, self.linewave)
+        self.cont_operator = make_interpolation_operator(wave, self.contwave)
+
+    def get_components(self, ages, spec, logU, metallicity):
+        ''' Continuum and line nebular emission for each age
+
+        All (age, metallicity) pairs younger than 10 Myr are evaluated
+        together and projected onto the wavelength grid with one matrix
+        product each for the continuum and the lines.
+
+        Parameters
+        ----------
+        ages : numpy array (1 dim)
+            ages of the SSP models (Gyr)
+        spec : numpy array (2 or 3 dim)
+            SSP spectrum for each age (and each metallicity), on the
+            wavelength grid self.wave
+        logU : float
+            ionization parameter
+        metallicity : float or numpy array (1 dim)
+            metallicity (Z, where Zsolar = 0.019), one value for each
+            metallicity of spec
+
+        Returns
+        -------
+        contspec, linespec : numpy arrays (same shape as spec)
+            continuum and line nebular emission in units micro-Jy at 10 pc
+            dimensions: (wavelengths, ages[, metallicities])
+        '''
+        nwave = spec.shape[0]
+        spec3 = spec.reshape(nwave, len(ages), -1)
+        metallicity = np.atleast_1d(metallicity)
+        contspec = np.zeros(spec3.shape)
+        linespec = np.zeros(spec3.shape)
+        ai, mj = np.meshgrid(np.where(ages <= 1e-2)[0],
+                             np.arange(spec3.shape[2]), indexing='ij')
+        ai, mj = ai.ravel(), mj.ravel()
+        if len(ai):
+            # The nebular grid is regular, so its triangulation contains
+            # degenerate simplices on which SSP metallicities coinciding with
+            # grid nodes lie; evaluating the points separately keeps the
+            # simplex search (and the result) independent of the batch.
+            values = np.array([self.interp(metallicity[m], ages[i]*1e3, logU)
+                               for i, m in zip(ai, mj)])
+            qq = (number_ionizing_photons(self.wave, spec3[:, ai, mj])
+                  / 1e48 * self.sollum)
+            cont = values[:, :self.ncont].swapaxes(0, 1) * qq
+            lines = values[:, self.ncont:].swapaxes(0, 1) * qq
+            contspec[:, ai, mj] = self.cont_operator.dot(cont)
+            linespec[:, ai, mj] = self.garray.dot(lines)
+        return contspec.reshape(spec.shape), linespec.reshape(spec.shape)
+
+    def evaluate(self, ages, spec, logU, metallicity):
+        ''' Line-only nebular emission and the SSP with nebular emission
+
+        Parameters
+        ----------
+        see get_components()
+
+        Returns
+        -------
+        linespec : numpy array (same shape as spec)
+            line nebular emission in units micro-Jy at 10 pc
+        nspec : numpy array (same shape as spec)
+            spec with line and continuum nebular emission added
+        '''
+        contspec, linespec = self.get_components(ages, spec, logU,
+                                                 metallicity)
+        return linespec, spec + contspec + linespec
+
+
 def get_nebular_emission(ages, wave, spec, logU, metallicity,
                          filename='nebular/ZAU_ND_pdva',
-                         sollum=3.826e33, kind='both'):
+                         sollum=3.826e33, kind='both', engine=None):
     ''' 
     ages : numpy array (1 dim)
         ages of the SSP models
@@ -248,6 +649,8 @@ def get_nebular_emission(ages, wave, spec, logU, metallicity,
         {'both', 'line', 'cont'}
         'line', 'cont' return only the line and continuum nebular emission
         'both' returns line and continuum nebular emission
+    engine : NebularEmission or None
+        previously built engine for the wave grid (built here if None)
 
     Returns
     -------
@@ -257,63 +660,21 @@ def get_nebular_emission(ages, wave, spec, logU, metallicity,
     '''
     while kind not in ['line', 'cont', 'both']:
         kind = input("Invalid entry. Please enter 'line', 'cont', or 'both'")
-    cont_file = filename + '.cont'
-    lines_file = filename + '.lines'
-    cont_res = [np.array(x) for x in read_fsps_neb(cont_file)]
-    if kind != 'cont':
-        lines_res = [np.array(x) for x in read_fsps_neb(lines_file)]
-    # Make array of Z, age, U
-    V = np.array([10**cont_res[0]*0.019, cont_res[1]/1e6,
-                  cont_res[2]]).swapaxes(0, 1)
-    if kind != 'line':
-        C = scint.LinearNDInterpolator(V, cont_res[3]*1e48)
-    if kind != 'cont':
-        L = scint.LinearNDInterpolator(V, lines_res[3]*1e48)
-        garray = make_gaussian_emission(wave, lines_res[4])
-    nspec = spec * 0.
-
-    for i, age in enumerate(ages):
-        if age <= 1e-2:
-            if kind != 'line':
-                cont = C(metallicity, age*1e3, logU)
-            if kind != 'cont':
-                lines = L(metallicity, age*1e3, logU)
-            qq = number_ionizing_photons(wave, spec[:, i]) / 1e48 * sollum
-            if kind == 'both': 
-                nspec[:, i] = (nspec[:, i] 
-                               + np.interp(wave, cont_res[4], cont*qq)
-                               + (garray * lines * qq).sum(axis=1))
-            if kind == 'line':
-                nspec[:, i] = (nspec[:, i] 
-                               + (garray * lines * qq).sum(axis=1))
-            if kind == 'cont':
-                nspec[:, i] = (nspec[:, i] 
-                               + np.interp(wave, cont_res[4], cont*qq))
-
-    return nspec
+    if engine is None:
+        engine = NebularEmission(wave, filename=filename, sollum=sollum)
+    contspec, linespec = engine.get_components(ages, spec, logU, metallicity)
+    if kind == 'line':
+        return linespec
+    if kind == 'cont':
+        return contspec
+    return contspec + linespec
 
 def add_nebular_emission(ages, wave, spec, logU, metallicity,
                          filename='nebular/ZAU_ND_pdva',
-                         sollum=3.826e33):
-    cont_file = filename + '.cont'
-    lines_file = filename + '.lines'
-    cont_res = [np.array(x) for x in read_fsps_neb(cont_file)]
-    lines_res = [np.array(x) for x in read_fsps_neb(lines_file)]
-    # Make array of Z, age, U
-    V = np.array([10**cont_res[0]*0.019, cont_res[1]/1e6,
-                  cont_res[2]]).swapaxes(0, 1)
-    C = scint.LinearNDInterpolator(V, cont_res[3]*1e48)
-    L = scint.LinearNDInterpolator(V, lines_res[3]*1e48)
-    garray = make_gaussian_emission(wave, lines_res[4])
-    nspec = spec * 1.
-    for i, age in enumerate(ages):
-        if age <= 1e-2:
-            cont = C(metallicity, age*1e3, logU)
-            lines = L(metallicity, age*1e3, logU)
-            qq = number_ionizing_photons(wave, spec[:, i]) / 1e48 * sollum
-            nspec[:, i] = (nspec[:, i] + np.interp(wave, cont_res[4], cont*qq)
-                           + (garray * lines * qq).sum(axis=1))
-    return nspec
+                         sollum=3.826e33, engine=None):
+    if engine is None:
+        engine = NebularEmission(wave, filename=filename, sollum=sollum)
+    return engine.evaluate(ages, spec, logU, metallicity)[1]
 
 def collapse_emline_SSP(args, linewave, linespec, clight=2.99792e18):
     '''Speed up construction of emission line fluxes from the CSP
@@ -339,40 +700,61 @@ def collapse_emline_SSP(args, linewave, linespec, clight=2.99792e18):
     if (not args.use_emline_flux) | (args.emline_list_dict=={}):
         return np.array([1000.,2000.]), linespec[0:2,:,:]
 
-    emlines = args.emline_list_dict.keys() 
-    emwaves = np.array(args.emline_list_dict.values())[:,0]
-    ssp_emline_collapsed = linespec[0:len(emlines),:,:]
-    # loop through emission line spectra for all ages, metallicities
+    emlines = list(args.emline_list_dict.keys())
+    emwaves = np.array(list(args.emline_list_dict.values()))[:,0]
     dims = linespec.shape
-    for i in range(dims[1]): # age array
-        # if no emission lines at this age, skip metallicity grid
-        if np.max(linespec[:,i,:]) <= 0:
-            empty = np.zeros( (len(emlines), dims[2]) )
-            ssp_emline_collapsed[:,i,:] = empty
+    ssp_emline_collapsed = np.zeros((len(emlines), dims[1], dims[2]))
+    # frequency width of each pixel, to convert flux density in micro-Jy
+    # at 10 pc to total flux (ergs/s/cm2) at 10pc
+    dnu = np.abs(np.hstack([np.diff(clight / linewave), 0.]))
+    # pixels covered by the line profiles of any age, metallicity
+    support = np.any(linespec != 0, axis=(1, 2))
+    gaps = np.where(~support)[0]
+    for k, emline in enumerate(emlines):
+        w = args.emline_list_dict[emline][0]
+        indx = np.searchsorted(linewave, w)
+        if not support[indx]:
             continue
-        for j in range(dims[2]): # metallicity array
-            spec = linespec[:,i,j]
-            lineflux = []
-            for emline in emlines:
-                w = args.emline_list_dict[emline][0]
-                indx = np.searchsorted(linewave, w)
-                if spec[indx] <= 0:
-                    lineflux.append(0.)
-                    continue
-                # find indices when target line goes to zero
-                indx_zero = np.where(spec==0)[0]
-                indx_lo = indx - np.min( indx - indx_zero[indx_zero<indx])
-                indx_hi = indx + np.min( indx_zero[indx_zero>indx] - indx)
-                dnu = np.diff( clight / linewave[indx_lo:indx_hi+2])
-                y = spec[indx_lo:indx_hi+1]
-                # convert flux density in micro-Jy at 10 pc 
-                # to total flux (ergs/s/cm2) at 10pc
-                lineflux.append(np.dot( y, np.abs(dnu) ) / 1e29)
-            ssp_emline_collapsed[:,i,j] = lineflux
+        # integration window: the line profiles blended with the target line
+        lo = gaps[gaps < indx].max() + 1 if np.any(gaps < indx) else 0
+        hi = gaps[gaps > indx].min() if np.any(gaps > indx) else dims[0]
+        seg = linespec[lo:hi]
+        # within the window, only integrate the pixels connected to the
+        # target line (other lines may have zero flux at some ages)
+        p = indx - lo
+        keep = np.ones(seg.shape, dtype=bool)
+        keep[:p+1] = np.cumprod(seg[p::-1] != 0, axis=0)[::-1]
+        keep[p:] = np.cumprod(seg[p:] != 0, axis=0)
+        flux = np.tensordot(dnu[lo:hi], seg * keep, axes=(0, 0)) / 1e29
+        ssp_emline_collapsed[k] = np.where(seg[p] > 0, flux, 0.)
 
     return np.array(emwaves), ssp_emline_collapsed
 
 
+def make_interpolation_operator(wave, xp):
+    ''' Sparse operator equivalent to np.interp(wave, xp, fp)
+
+    Parameters
+    ----------
+    wave : numpy array (1 dim)
+        wavelengths at which to interpolate
+    xp : numpy array (1 dim)
+        increasing wavelength grid of the input
+
+    Returns
+    -------
+    operator : scipy.sparse matrix (len(wave), len(xp))
+        operator.dot(fp) interpolates the columns of fp onto wave,
+        with the end values of fp used outside of xp
+    '''
+    j = np.clip(np.searchsorted(xp, wave, side='right') - 1, 0, len(xp) - 2)
+    t = np.clip((wave - xp[j]) / (xp[j+1] - xp[j]), 0., 1.)
+    rows = np.hstack([np.arange(len(wave))] * 2)
+    cols = np.hstack([j, j + 1])
+    return sparse.csr_matrix((np.hstack([1. - t, t]), (rows, cols)),
+                             shape=(len(wave), len(xp)))
+
+
 def make_gaussian_emission(wavebig, wave, stddev=1., clight=2.99792e18):
     ''' 
 
@@ -382,18 +764,24 @@ def make_gaussian_emission(wavebig, wave, stddev=1., clight=2.99792e18):
 
     Returns
     -------
-    gspec : FILL IN
-        in units per Hz
+    gspec : scipy.sparse matrix (len(wavebig), len(wave))
+        Gaussian line profile for each line (column) in units per Hz;
+        each column only has len(Gaussian1DKernel(stddev).array) nonzero
+        entries, centered on the pixel closest to the line
     '''
-    gspec = np.zeros((len(wavebig), len(wave)))
     G = Gaussian1DKernel(stddev).array
-    mid = len(G) / 2
+    mid = len(G) // 2
     dw = np.diff(wavebig)
-    for i, w in enumerate(wave):
-        xl = np.argmin(np.abs(wavebig - w))
-        if (xl > mid) and ((xl+mid) < len(wavebig)):
-            gspec[(xl-mid):(xl+mid+1), i] = G / clight * w**2 / dw[xl]
-    return gspec
+    # pixel closest to each line (first one on ties, as np.argmin)
+    j = np.clip(np.searchsorted(wavebig, wave), 1, len(wavebig) - 1)
+    xl = np.where(np.abs(wavebig[j-1] - wave) <= np.abs(wavebig[j] - wave),
+                  j - 1, j)
+    sel = np.where((xl > mid) & ((xl + mid) < len(wavebig)))[0]
+    rows = xl[sel, np.newaxis] + np.arange(-mid, mid + 1)
+    cols = sel[:, np.newaxis] + np.zeros(len(G), dtype=int)
+    vals = (G / clight * (wave[sel]**2 / dw[xl[sel]])[:, np.newaxis])
+    return sparse.csc_matrix((vals.ravel(), (rows.ravel(), cols.ravel())),
+                             shape=(len(wavebig), len(wave)))
 
 
 def number_ionizing_photons(wave, spectrum, clight=2.99792e18,
@@ -404,26 +792,192 @@ def number_ionizing_photons(wave, spectrum, clight=2.99792e18,
     ----------
     wave : numpy array (1 dim)
         wavelength grid in units of Angstroms
-    spectrum : numpy array (1 dim)
+    spectrum : numpy array (1 dim or more)
         Spectrum in f_nu (micro Janskies, i.e., 1e-29 ergs/s/cm^2/Hz) at 10pc
+        (additional dimensions hold separate spectra)
  
     Returns
     -------
-    float
+    float or numpy array
         number of photons capable of ionizing Hydrogen
         in units of 1e-29 photons / s / cm^2 at 10 pc
+        (one value per spectrum)
     '''
     nu = clight / wave 
     xlim = np.searchsorted(wave, 912., side='right')
     x1 = np.abs(np.diff(nu[:xlim])) 
-    x2 = spectrum[:xlim] / nu[:xlim] 
+    x2 = (spectrum[:xlim] /
+          nu[:xlim].reshape((-1,) + (1,) * (np.ndim(spectrum) - 1)))
     x3 = (x2[:-1] + x2[1:]) / 2. 
-    return np.sum(x1 * x3) / hplanck
+    return np.tensordot(x1, x3, axes=(0, 0)) / hplanck
+
+
+def plot_ssp_templates(args, ages, wave, spec, metallicities):
+    ''' Save a plot of the age-weighted SSP spectra
+
+    Parameters
+    ----------
+    args : class
+        The args class from mcsed.parse_args()
+    ages, wave, spec, metallicities : see read_ssp_fsps()
+    '''
+    if args.metallicity:
+        imet = np.argmin(abs(args.metallicity - metallicities))
+    else: # show SSP grid for 40% solar, if no metallicity is set
+        imet = np.argmin(abs(0.0077 - metallicities))
+    fig = plt.figure(figsize=(8, 8))
+    import seaborn as sns
+    colors = sns.color_palette("coolwarm", spec.shape[1])
+    wei = np.diff(np.hstack([0., ages]))
+#    wei = np.ones(spec.shape[1])
+    for i in np.arange(spec.shape[1]):
+        plt.plot(wave, spec[:, i, imet] * wei[i] / 1e8, color=colors[i])
+    plt.xlim([900., 40000.])
+    plt.xscale('log')
+    plt.yscale('log')
+    plt.ylim([1e-5, 20])
+#    plt.ylim([1e-5, 10.**3.5])
+    plt.xlabel('Wavelength [$\\rm{\AA}$]')
+    plt.ylabel('Relative $f_\\nu$')
+    plt.savefig('template_spectra_plot.%s' % args.output_dict['image format'])
+    plt.close(fig)
+
+
+def get_ssp_cache_inputs(args, metallicities,
+                         nebular_filename='nebular/ZAU_ND_pdva'):
+    ''' Collect every input that affects the product of read_ssp_fsps()
+
+    Parameters
+    ----------
+    args : class
+        The args class from mcsed.parse_args()
+    metallicities : numpy array (1d)
+        SSP metallicities to be read
+    nebular_filename : str
+        base name of the nebular emission grids
+
+    Returns
+    -------
+    inputs : dict
+        JSON serializable description of the processed SSP grid
+    '''
+    if args.fit_dust_em:
+        redwave = 350e4
+    else:
+        redwave = 1e5
+    emlines = sorted([[str(name), [float(v) for v in value]] for name, value
+                      in args.emline_list_dict.items()])
+
+    # identify the source files by size and modification time
+    sources = [op.join('SSP', 'fsps_%s_%0.4f.spec' % (args.isochrone, met))
+               for met in metallicities]
+    sources += [nebular_filename + '.cont', nebular_filename + '.lines']
+    source_info = {}
+    for filename in sources:
+        if op.exists(filename):
+            source_info[filename] = ssp_cache.get_file_signature(filename,
+                                                   with_hash=False)
+
+    inputs = {'ssp': args.ssp.lower(),
+              'isochrone': args.isochrone,
+              'metallicities': [float(met) for met in metallicities],
+              'logU': float(args.logU),
+              'redwave': redwave,
+              'emline_list_dict': emlines,
+              'use_emline_flux': bool(args.use_emline_flux),
+              'max_ssp_age': float(args.max_ssp_age[1]),
+              'nebular': nebular_filename,
+              'sources': source_info}
+    return inputs
+
+
+def select_ssp_metallicities(args, metallicities, sigma=0.15,
+                             Zsolar=0.019):
+    ''' Select the SSP metallicities that contribute to the model
+
+    Mcsed.get_ssp_spectrum combines the SSP metallicities with gaussian
+    weights (of width sigma in log Z).  A grid metallicity is kept if its
+    weight, relative to the largest weight, is at least
+    args.ssp_met_weight_floor for the fixed metallicity (args.metallicity)
+    or, if metallicity is a free parameter, anywhere within its prior range.
+
+    Parameters
+    ----------
+    args : class
+        The args class from mcsed.parse_args()
+    metallicities : numpy array (1d)
+        SSP grid metallicities (Z)
+    sigma : float
+        width of the gaussian metallicity weights in dex
+    Zsolar : float
+        solar metallicity
+
+    Returns
+    -------
+    metallicities : numpy array (1d)
+        selected SSP metallicities
+    '''
+    floor = getattr(args, 'ssp_met_weight_floor', 0.)
+    if not floor:
+        return metallicities
+    Z = np.log10(metallicities)
+    if args.metallicity:
+        zlims = [np.log10(args.metallicity)] * 2
+    else:
+        zlims = np.array(stellar_metallicity().met_lims) + np.log10(Zsolar)
+    # distance (in dex) from the metallicity (range) of the model
+    X = np.maximum(0., np.maximum(zlims[0] - Z, Z - zlims[1]))
+    # log of the weights relative to the largest one
+    logwei = -(X**2 - X.min()**2) / (2. * sigma**2)
+    return metallicities[logwei >= np.log(floor)]
+
+
+def build_ssp_fsps(args, metallicities):
+    ''' Read the fsps SSP grid and add nebular emission, smooth the
+    spectra, and collapse the emission line grid
+
+    Parameters
+    ----------
+    args : class
+        The args class from mcsed.parse_args()
+    metallicities : numpy array (1d)
+        SSP metallicities to be read
+
+    Returns
+    -------
+    ages, wave, spec, linewave, linespec : see read_ssp_fsps()
+    '''
+    s = []
+    for met in metallicities:
+        if args.ssp.lower() == 'fsps':
+            ages, wave, spec = read_fsps_file(args, met)
+        s.append(spec)
+    spec = np.moveaxis(np.array(s), 0, 2)
+
+    # nebular emission for all young ages and metallicities at once
+    nebular = NebularEmission(wave)
+    linespec, spec = nebular.evaluate(ages, spec, args.logU, metallicities)
+
+    # do not smooth the emission line grid
+    wave0 = wave.copy()
+    if args.fit_dust_em:
+        wave, spec = get_coarser_wavelength_fsps(wave0, spec, redwave=350e4)
+    else:
+        wave, spec = get_coarser_wavelength_fsps(wave0, spec)
+
+    # Collapse the emission line SSP grid
+    linewave, linespec = collapse_emline_SSP(args, wave0, linespec) 
+
+    return ages, wave, spec, linewave, linespec
 
 
 def read_ssp_fsps(args):
     ''' Read in SPS model and return ages, wavelength, and spectra
 
+    If args.ssp_cache_dir is set, the processed grid is stored in a
+    content-addressed cache (keyed on get_ssp_cache_inputs()) and a repeat
+    run with the same configuration skips the processing entirely.
+
     Parameters
     ----------
     args : class
@@ -449,54 +1003,27 @@ def read_ssp_fsps(args):
 
     '''
     metallicities = np.array(args.metallicity_dict[args.ssp][args.isochrone])
-
-    s, ls = [], []
-    for met in metallicities:
-        if args.ssp.lower() == 'fsps':
-            ages, wave, spec = read_fsps_file(args, met)
-        linespec = get_nebular_emission(ages, wave, spec, args.logU,
-                                        met, kind='line')
-        spec = add_nebular_emission(ages, wave, spec, args.logU,
-                                        met)
-
-        # do not smooth the emission line grid
-        wave0 = wave.copy()
-        if args.fit_dust_em:
-            wave, spec = get_coarser_wavelength_fsps(wave0, spec, redwave=350e4)
-        else:
-            wave, spec = get_coarser_wavelength_fsps(wave0, spec)
-        s.append(spec)
-        ls.append(linespec)
+    # only read the metallicities with non-negligible weight in the model
+    metallicities = select_ssp_metallicities(args, metallicities)
+
+    cache_dir = getattr(args, 'ssp_cache_dir', None)
+    names = ['ages', 'wave', 'spec', 'linewave', 'linespec']
+    arrays = None
+    if cache_dir is not None:
+        inputs = get_ssp_cache_inputs(args, metallicities)
+        entry_dir = op.join(cache_dir, 'processed', ssp_cache.make_key(inputs))
+        if ssp_cache.read_manifest(entry_dir) is not None:
+            arrays = ssp_cache.load_entry(entry_dir, names)
+
+    if arrays is None:
+        arrays = build_ssp_fsps(args, metallicities)
+        if cache_dir is not None:
+            ssp_cache.save_entry(entry_dir, dict(zip(names, arrays)),
+                                 {'inputs': inputs})
+    ages, wave, spec, linewave, linespec = arrays
 
     # save plot of SSP spectra
     if args.output_dict['template spec']:
-        if args.metallicity:
-            imet = np.argmin(abs(args.metallicity - metallicities))
-        else: # show SSP grid for 40% solar, if no metallicity is set
-            imet = np.argmin(abs(0.0077 - metallicities))
-        fig = plt.figure(figsize=(8, 8))
-        import seaborn as sns
-        colors = sns.color_palette("coolwarm", s[imet].shape[1])
-        wei = np.diff(np.hstack([0., ages]))
-#        wei = np.ones(s[imet].shape[1])
-        for i in np.arange(s[imet].shape[1]):
-            plt.plot(wave, s[imet][:, i] * wei[i] / 1e8, color=colors[i])
-        plt.xlim([900., 40000.])
-        plt.xscale('log')
-        plt.yscale('log')
-        plt.ylim([1e-5, 20])
-#        plt.ylim([1e-5, 10.**3.5])
-        plt.xlabel('Wavelength [$\\rm{\AA}$]')
-        plt.ylabel('Relative $f_\\nu$')
-        plt.savefig('template_spectra_plot.%s' % args.output_dict['image format'])
-        plt.close(fig)
-
-    spec = np.moveaxis(np.array(s), 0, 2)
-    linespec = np.moveaxis(np.array(ls), 0, 2)
-
-    # Collapse the emission line SSP grid
-    linewave, linespec = collapse_emline_SSP(args, wave0, linespec) 
-
-    return ages, wave, spec, metallicities, linewave,linespec
-
+        plot_ssp_templates(args, ages, wave, spec, metallicities)
 
+    return ages, wave, spec, metallicities, linewave, linespec
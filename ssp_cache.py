@@ -0,0 +1,266 @@
+""" MCSED - ssp_cache.py
+
+Persistent binary cache for SSP grids
+
+Each cache entry is a directory holding one .npy file per array and a
+manifest (manifest.json) describing how the entry was produced.  Arrays are
+loaded with numpy memory-mapping, so a warm start costs little more than
+opening the files.
+
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import tempfile
+import numpy as np
+
+# increment when the layout or the content of cache entries changes
+CACHE_VERSION = 1
+
+
+def hash_file(filename, blocksize=2**20):
+    ''' SHA-1 digest of a file
+
+    Parameters
+    ----------
+    filename : str
+        file to be hashed
+    blocksize : int
+        number of bytes read at a time
+
+    Returns
+    -------
+    digest : str
+        hexadecimal SHA-1 digest of the file contents
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+    return sha.hexdigest()
+
+
+def get_file_signature(filename, with_hash=True):
+    ''' Describe a source file by its size, modification time and hash
+
+    Parameters
+    ----------
+    filename : str
+        source file
+    with_hash : bool
+        if True, include the SHA-1 digest of the file contents
+
+    Returns
+    -------
+    signature : dict
+        keys: 'size', 'mtime' and (optionally) 'sha1'
+    '''
+    st = os.stat(filename)
+    signature = {'size': int(st.st_size), 'mtime': float(st.st_mtime)}
+    if with_hash:
+        signature['sha1'] = hash_file(filename)
+    return signature
+
+
+def make_key(inputs):
+    ''' Content-addressed key for a set of (JSON serializable) inputs
+
+    Parameters
+    ----------
+    inputs : dict
+        every quantity that affects the cached product
+
+    Returns
+    -------
+    key : str
+        hexadecimal SHA-1 digest of the sorted JSON representation of inputs
+    '''
+    inputs = dict(inputs)
+    inputs['cache_version'] = CACHE_VERSION
+    text = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def read_manifest(entry_dir):
+    ''' Read the manifest of a cache entry
+
+    Returns
+    -------
+    manifest : dict or None
+        None if the entry does not exist, is unreadable, or was written
+        with a different CACHE_VERSION
+    '''
+    filename = op.join(entry_dir, 'manifest.json')
+    if not op.exists(filename):
+        return None
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('cache_version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(entry_dir, manifest):
+    ''' Atomically (re)write the manifest of an existing cache entry '''
+    manifest = dict(manifest)
+    manifest['cache_version'] = CACHE_VERSION
+    filename = op.join(entry_dir, 'manifest.json')
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=1)
+    os.rename(tmpname, filename)
+
+
+def load_entry(entry_dir, names, mmap_mode='r'):
+    ''' Load the arrays of a cache entry
+
+    Parameters
+    ----------
+    entry_dir : str
+        cache entry directory
+    names : list
+        names of the arrays to load (in order)
+    mmap_mode : str or None
+        passed to numpy.load; 'r' memory-maps the arrays read-only
+
+    Returns
+    -------
+    arrays : list or None
+        None if any of the arrays cannot be read
+    '''
+    arrays = []
+    for name in names:
+        try:
+            arrays.append(np.load(op.join(entry_dir, '%s.npy' % name),
+                                  mmap_mode=mmap_mode))
+        except (IOError, OSError, ValueError):
+            return None
+    return arrays
+
+
+def save_entry(entry_dir, arrays, manifest):
+    ''' Write a cache entry
+
+    The entry is assembled in a temporary directory and renamed into place,
+    so that concurrent readers (e.g., parallel workers) never see a
+    partially written entry.  Failures to write the cache are not fatal.
+
+    Parameters
+    ----------
+    entry_dir : str
+        cache entry directory
+    arrays : dict
+        keys are array names, values are numpy arrays
+    manifest : dict
+        JSON serializable description of the entry
+
+    Returns
+    -------
+    success : bool
+    '''
+    parent = op.dirname(op.abspath(entry_dir))
+    tmpdir = '%s.%i.tmp' % (op.abspath(entry_dir), os.getpid())
+    try:
+        if not op.isdir(parent):
+            os.makedirs(parent)
+        if op.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        for name, array in arrays.items():
+            np.save(op.join(tmpdir, '%s.npy' % name), np.asarray(array))
+        write_manifest(tmpdir, manifest)
+        if op.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmpdir, entry_dir)
+    except (IOError, OSError):
+        # another process may have written the same entry concurrently
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return False
+    return True
+
+
+def signature_matches(manifest, filename, key='source'):
+    ''' Check whether a source file is unchanged since the entry was written
+
+    A matching size and modification time is accepted directly; otherwise
+    the file is hashed and compared against the recorded SHA-1 digest
+    (e.g., the file was touched or copied, but not modified).
+
+    Parameters
+    ----------
+    manifest : dict
+        manifest of the cache entry
+    filename : str
+        source file
+    key : str
+        manifest key holding the signature of the source file
+
+    Returns
+    -------
+    match : bool
+    '''
+    recorded = manifest.get(key)
+    if recorded is None:
+        return False
+    current = get_file_signature(filename, with_hash=False)
+    if current['size'] != recorded.get('size'):
+        return False
+    if current['mtime'] == recorded.get('mtime'):
+        return True
+    return hash_file(filename) == recorded.get('sha1')
+
+
+def publish_arrays(arrays, prefix='mcsed_'):
+    ''' Publish arrays to other processes through memory-mapped files
+
+    The arrays are written to a temporary directory, in shared memory
+    (/dev/shm) when available.  Processes that attach to the directory with
+    attach_arrays() map the same pages read-only instead of holding private
+    copies.  The caller removes the directory with release_arrays().
+
+    Parameters
+    ----------
+    arrays : dict
+        keys are array names, values are numpy arrays
+    prefix : str
+        prefix of the temporary directory
+
+    Returns
+    -------
+    shared_dir : str
+        directory holding the published arrays
+    '''
+    if op.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        shared_dir = tempfile.mkdtemp(prefix=prefix, dir='/dev/shm')
+    else:
+        shared_dir = tempfile.mkdtemp(prefix=prefix)
+    for name, array in arrays.items():
+        np.save(op.join(shared_dir, '%s.npy' % name), np.asarray(array))
+    write_manifest(shared_dir, {'names': sorted(arrays.keys())})
+    return shared_dir
+
+
+def attach_arrays(shared_dir, names):
+    ''' Attach (read-only) to arrays published with publish_arrays()
+
+    Returns
+    -------
+    arrays : list
+        read-only numpy memory maps, in the order of names
+    '''
+    arrays = load_entry(shared_dir, names, mmap_mode='r')
+    if arrays is None:
+        raise IOError('Could not attach to the arrays in %s' % shared_dir)
+    return arrays
+
+
+def release_arrays(shared_dir):
+    ''' Remove the directory created by publish_arrays() '''
+    shutil.rmtree(shared_dir, ignore_errors=True)